@@ -0,0 +1,245 @@
+"""
+Cache of streamed answers for the `/ask` flows.
+
+Identical prompts (same model, system prompt and user prompt, which includes the
+retrieved context or the transcript) always produced a fresh GPT-4o call. The
+answer cache keys the full streamed completion on a hash of the final prompts:
+
+- a hit replays the stored chunks immediately, without calling the model,
+- concurrent identical requests are coalesced: one upstream call is made and
+  every request streams its chunks as they arrive,
+- entries are evicted by LRU and TTL, and dropped when an episode they were
+  built from is re-transcribed or re-embedded (see cache_events.py).
+
+The upstream completion is driven by a background thread (or task, for the
+asyncio server) so a client that disconnects mid-answer does not cut the
+stream short for the other requests waiting on it.
+"""
+
+import asyncio
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_TTL = 24 * 60 * 60
+
+
+def prompt_key(model, system_prompt, user_prompt):
+    digest = hashlib.sha256()
+    for part in (model, system_prompt, user_prompt):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class _InFlight:
+    """A completion being streamed from upstream, shared by coalesced requests."""
+
+    def __init__(self, tags):
+        self.tags = tags
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.cond = threading.Condition()
+        # set for the asyncio server, which waits on an event instead
+        self.event = None
+
+
+class AnswerCache:
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        # key -> (expiry time, tuple of chunks, tags)
+        self._entries = OrderedDict()
+        # (podcastid, episodeid) -> keys of the entries built from that episode
+        self._tags = {}
+        self._inflight = {}
+        # keeps the asyncio upstream tasks referenced until they finish
+        self._tasks = set()
+
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, chunks, tags = entry
+        if expires < time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return chunks
+
+    def _remove(self, key):
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def _put(self, key, chunks, tags):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, tuple(chunks), tags)
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def _finish(self, key, inflight, tags):
+        with self._lock:
+            # an invalidation during the call removes the in-flight entry, in
+            # which case the answer is stale and must not be cached
+            if self._inflight.get(key) is inflight:
+                del self._inflight[key]
+                if inflight.error is None:
+                    self._put(key, inflight.chunks, tags)
+
+    def _lookup(self, key, tags, make_inflight):
+        """Return (cached chunks, in-flight entry, True if the caller must start it)."""
+        with self._lock:
+            chunks = self._get(key)
+            if chunks is not None:
+                self.hits += 1
+                return chunks, None, False
+
+            inflight = self._inflight.get(key)
+            if inflight is not None:
+                self.coalesced += 1
+                return None, inflight, False
+
+            self.misses += 1
+            inflight = make_inflight(tags)
+            self._inflight[key] = inflight
+            return None, inflight, True
+
+    def stream(self, key, tags, produce):
+        """
+        Yield the chunks of the answer for `key`. `produce` is called without
+        arguments on a miss and must return an iterable of text chunks.
+        `tags` is a set of (podcastid, episodeid) the prompt was built from.
+        """
+        chunks, inflight, leader = self._lookup(key, tags, _InFlight)
+        if chunks is not None:
+            yield from chunks
+            return
+
+        if leader:
+
+            def run():
+                try:
+                    for chunk in produce():
+                        with inflight.cond:
+                            inflight.chunks.append(chunk)
+                            inflight.cond.notify_all()
+                except Exception as e:
+                    inflight.error = e
+                self._finish(key, inflight, tags)
+                with inflight.cond:
+                    inflight.done = True
+                    inflight.cond.notify_all()
+
+            threading.Thread(target=run, daemon=True).start()
+
+        sent = 0
+        while True:
+            with inflight.cond:
+                while sent == len(inflight.chunks) and not inflight.done:
+                    inflight.cond.wait()
+                pending = inflight.chunks[sent:]
+                done = inflight.done
+            yield from pending
+            sent += len(pending)
+            if done:
+                break
+
+        if inflight.error is not None:
+            raise inflight.error
+
+    async def astream(self, key, tags, produce):
+        """Asyncio counterpart of `stream`; `produce` returns an async iterable."""
+
+        def make_inflight(tags):
+            inflight = _InFlight(tags)
+            inflight.event = asyncio.Event()
+            return inflight
+
+        chunks, inflight, leader = self._lookup(key, tags, make_inflight)
+        if chunks is not None:
+            for chunk in chunks:
+                yield chunk
+            return
+
+        if leader:
+
+            async def run():
+                try:
+                    async for chunk in produce():
+                        inflight.chunks.append(chunk)
+                        inflight.event.set()
+                except Exception as e:
+                    inflight.error = e
+                self._finish(key, inflight, tags)
+                inflight.done = True
+                inflight.event.set()
+
+            task = asyncio.get_running_loop().create_task(run())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        sent = 0
+        while True:
+            if sent == len(inflight.chunks) and not inflight.done:
+                inflight.event.clear()
+                await inflight.event.wait()
+                continue
+            pending = inflight.chunks[sent:]
+            for chunk in pending:
+                yield chunk
+            sent += len(pending)
+            if inflight.done and sent == len(inflight.chunks):
+                break
+
+        if inflight.error is not None:
+            raise inflight.error
+
+    def invalidate_episode(self, podcastid, episodeid):
+        """Drop every answer built from the given episode's transcript or chunks."""
+        if episodeid is None:
+            # feed metadata changes do not touch transcripts or chunks
+            return
+        tag = (int(podcastid), int(episodeid))
+        with self._lock:
+            for key in list(self._tags.get(tag, ())):
+                self._remove(key)
+            for key, inflight in list(self._inflight.items()):
+                if tag in inflight.tags:
+                    del self._inflight[key]
+
+    def stats(self):
+        requests = self.hits + self.coalesced + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "in_flight": len(self._inflight),
+            "hits": self.hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.coalesced) / requests if requests else 0.0,
+        }
+
+
+def create_answer_cache(config):
+    """Build the cache from the optional `ANSWER_CACHE_*` config keys."""
+    return AnswerCache(
+        max_entries=int(config.get("ANSWER_CACHE_SIZE", DEFAULT_MAX_ENTRIES)),
+        ttl=float(config.get("ANSWER_CACHE_TTL", DEFAULT_TTL)),
+    )
@@ -0,0 +1,152 @@
+"""
+The parts of `/ask` that server.py and async_server.py share.
+
+Both servers validate the same query string, plan the same retrieval and
+build the same prompts; they differ only in how they wait on the database and
+the OpenAI API. What is here does no I/O, so either server calls it as is.
+"""
+
+from functools import lru_cache
+from typing import NamedTuple
+
+from context_builder import count_tokens
+from prompts import fulltext_excerpts_user_prompt, fulltext_user_prompt
+from rerank import RerankSettings, rerank_settings
+from retrieval import (
+    SCOPE_EPISODE,
+    HybridParams,
+    candidate_count,
+    hybrid_params,
+    podcast_ids,
+    rrf_fuse,
+)
+
+# /ask modes, also the `mode` label of the /ask metrics
+ASK_MODES = ("norag", "fulltext", "summary", "rag")
+
+
+class AskRequest(NamedTuple):
+    question: str
+    # expected: "norag", "fulltext", "summary" or "rag"
+    request_type: str
+    # request_type, or "rag" for anything else
+    mode: str
+    # rag/summary: "podcast" (default) or "episode"
+    scope: str
+    # None for all podcasts
+    podcastids: list
+    episodeid: int
+    # rag and summary: number of chunks and weights of the two rankings
+    params: HybridParams
+    # rag and summary: reranker and candidates to rerank
+    reranking: RerankSettings
+
+
+def parse_ask_request(args, config):
+    """The `/ask` query string; raises ValueError, a 400, when it is invalid."""
+    episode_id = args.get("eid")
+    request_type = args.get("type")
+    scope = args.get("scope")
+    # one podcast (default 1), a comma-separated list of podcasts or "all"
+    podcastids = podcast_ids(args.get("pid"))
+    params = hybrid_params(args, config)
+    reranking = rerank_settings(args, config)
+
+    # episode IDs are only unique within a podcast
+    single_episode = request_type == "fulltext" or (
+        scope == SCOPE_EPISODE and episode_id
+    )
+    if single_episode and (podcastids is None or len(podcastids) != 1):
+        raise ValueError("pid must be a single podcast with eid")
+    if episode_id is not None and not episode_id.isdigit():
+        raise ValueError("eid must be an integer")
+    if request_type == "fulltext" and episode_id is None:
+        raise ValueError("fulltext needs an eid")
+
+    return AskRequest(
+        args.get("q"),
+        request_type,
+        request_type if request_type in ASK_MODES else "rag",
+        scope,
+        podcastids,
+        int(episode_id) if episode_id is not None else None,
+        params,
+        reranking,
+    )
+
+
+class RetrievalPlan(NamedTuple):
+    # None when the fused chunks are not reranked
+    reranker: object
+    # chunks asked of each search
+    candidates: int
+    # chunks kept after fusion
+    fused: int
+
+
+def plan_retrieval(params, reranking, rerankers, config):
+    reranker = rerankers.get(reranking.reranker) if reranking else None
+    if reranker is not None:
+        # fusion needs about as many candidates from each search as it keeps
+        return RetrievalPlan(reranker, reranking.candidates, reranking.candidates)
+    return RetrievalPlan(None, candidate_count(params.k, config), params.k)
+
+
+def fuse(vector_results, lexical_results, params, plan):
+    """Reciprocal-rank fusion of the vector and lexical rankings."""
+    return rrf_fuse(
+        [vector_results, lexical_results],
+        [params.vector_weight, params.lexical_weight],
+        plan.fused,
+    )
+
+
+def indexed_embeddings(memory_index, rows):
+    """
+    The embeddings of `rows` that the in-process index holds, by chunk id, and
+    the ids of the chunks it has not loaded (yet) to read from Postgres.
+    """
+    ids = [row[5] for row in rows]
+    embeddings = memory_index.vectors(ids) if memory_index is not None else {}
+    return embeddings, [id for id in ids if id not in embeddings]
+
+
+def episode_tags(rows):
+    """(podcastid, episodeid) of the episodes that `rows` come from."""
+    return {(row[4], row[0]) for row in rows}
+
+
+def summary_episodes(ask, rows):
+    """The episodes whose summaries answer a summary request."""
+    episodeids = episode_tags(rows)
+    if ask.episodeid is not None and ask.podcastids and len(ask.podcastids) == 1:
+        episodeids.add((ask.podcastids[0], ask.episodeid))
+    return episodeids
+
+
+def fulltext_prompt(title, question, context):
+    """
+    The user prompt of a fulltext request and its token count, from its
+    FulltextContext. The context was counted when it was fitted to the budget,
+    so only the rest of the prompt is tokenized.
+    """
+    # only the whole transcript has as many tokens as the transcript
+    if context.tokens == context.transcript_tokens:
+        build = fulltext_user_prompt
+    else:
+        build = fulltext_excerpts_user_prompt
+    tokens = count_tokens(build(title, question, "")) + context.tokens
+    return build(title, question, context.text), tokens
+
+
+@lru_cache(maxsize=8)
+def system_prompt_tokens(system_prompt):
+    # the same few system prompts for every request
+    return count_tokens(system_prompt)
+
+
+def chat_messages(system_prompt, user_prompt):
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
@@ -0,0 +1,141 @@
+from psycopg_pool import AsyncConnectionPool
+
+from data_repository import (
+    CHUNK_EMBEDDINGS_QUERY,
+    EPISODE_QUERY,
+    FULLTEXT_QUERY,
+    SUMMARIES_QUERY,
+    EpisodeFilters,
+    episodes_page,
+    episodes_query,
+    summaries_params,
+)
+from embedding_cache import (
+    INSERT_CACHED_EMBEDDING_QUERY,
+    SELECT_CACHED_EMBEDDING_QUERY,
+    normalize_text,
+    parse_vector,
+)
+from metrics import traced
+from models import Episode
+from retrieval import (
+    DEFAULT_PODCASTID,
+    SCOPE_PODCAST,
+    lexical_chunks_query,
+    settings_queries,
+    similar_chunks_query,
+)
+
+
+def conninfo(config):
+    """Build a libpq connection string from the database keys of config.json."""
+    return (
+        f"dbname='{config['DBNAME']}' user='{config['USER']}' "
+        f"password='{config['PASS']}' host='{config['HOST']}' port='{config['PORT']}'"
+    )
+
+
+def create_async_pool(config):
+    """
+    Create an asyncio connection pool (psycopg 3) sized by the same
+    `POOL_MIN_SIZE`/`POOL_MAX_SIZE`/`POOL_ACQUIRE_TIMEOUT` keys as db_pool.py.
+    The pool is opened by the caller with `await pool.open()`.
+    """
+    return AsyncConnectionPool(
+        conninfo(config),
+        min_size=int(config.get("POOL_MIN_SIZE", 1)),
+        max_size=int(config.get("POOL_MAX_SIZE", 10)),
+        timeout=float(config.get("POOL_ACQUIRE_TIMEOUT", 10.0)),
+        open=False,
+    )
+
+
+class AsyncDataRepository:
+    """Non-blocking counterpart of DataRepository for the asyncio server."""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    @traced("db.get_episodes")
+    async def get_episodes(self, pid, filters=EpisodeFilters()):
+        query, params = episodes_query(pid, filters)
+        async with self.pool.connection() as conn:
+            cur = await conn.execute(query, params)
+            rows = await cur.fetchall()
+
+        return episodes_page(rows, filters)
+
+    @traced("db.get_episode")
+    async def get_episode(self, pid, eid):
+        async with self.pool.connection() as conn:
+            cur = await conn.execute(EPISODE_QUERY, (pid, eid))
+            row = await cur.fetchone()
+
+        if row is None:
+            return None
+        return Episode(row[1], row[2], row[3], "", row[4])
+
+    @traced("db.get_fulltext")
+    async def get_fulltext(self, pid, eid):
+        async with self.pool.connection() as conn:
+            cur = await conn.execute(FULLTEXT_QUERY, (pid, eid))
+            return await cur.fetchone()
+
+    @traced("db.get_chunk_embeddings")
+    async def get_chunk_embeddings(self, ids):
+        async with self.pool.connection() as conn:
+            cur = await conn.execute(CHUNK_EMBEDDINGS_QUERY, (list(ids),))
+            return dict(await cur.fetchall())
+
+    @traced("db.get_summaries")
+    async def get_summaries(self, episodes):
+        async with self.pool.connection() as conn:
+            cur = await conn.execute(SUMMARIES_QUERY, summaries_params(episodes))
+            return await cur.fetchall()
+
+    @traced("db.get_similar_chunks")
+    async def get_similar_chunks(
+        self,
+        embedding,
+        k=5,
+        podcastids=DEFAULT_PODCASTID,
+        episodeid=None,
+        scope=None,
+        settings=None,
+    ):
+        async with self.pool.connection() as conn:
+            for query, params in settings_queries(**(settings or {})):
+                await conn.execute(query, params)
+
+            query, params = similar_chunks_query(
+                embedding, k, podcastids, episodeid, scope or SCOPE_PODCAST
+            )
+            cur = await conn.execute(query, params)
+            return await cur.fetchall()
+
+    @traced("db.get_lexical_chunks")
+    async def get_lexical_chunks(
+        self, text, k=5, podcastids=DEFAULT_PODCASTID, episodeid=None, scope=None
+    ):
+        query, params = lexical_chunks_query(
+            text, k, podcastids, episodeid, scope or SCOPE_PODCAST
+        )
+        async with self.pool.connection() as conn:
+            cur = await conn.execute(query, params)
+            return await cur.fetchall()
+
+    @traced("db.get_cached_embedding")
+    async def get_cached_embedding(self, key):
+        async with self.pool.connection() as conn:
+            cur = await conn.execute(SELECT_CACHED_EMBEDDING_QUERY, (key,))
+            row = await cur.fetchone()
+
+        return parse_vector(row[0]) if row else None
+
+    @traced("db.put_cached_embedding")
+    async def put_cached_embedding(self, key, model, text, embedding):
+        async with self.pool.connection() as conn:
+            await conn.execute(
+                INSERT_CACHED_EMBEDDING_QUERY,
+                (key, model, normalize_text(text), str(embedding)),
+            )
@@ -0,0 +1,467 @@
+"""
+Asyncio serving mode for the podcast server.
+
+The Flask server in server.py blocks a worker thread for the whole lifetime of
+an `/ask` request: the embedding call, the pgvector query and every token of the
+streamed chat completion. This module serves the same read endpoints with Quart
+(the asyncio implementation of the Flask API), the psycopg 3 async pool and the
+async Azure OpenAI client, so a single process can keep thousands of answer
+streams open while it waits on I/O.
+
+Endpoints:
+----------
+- **GET /podcasts/<pid>/episodes**: Lists the transcribed episodes of a podcast.
+- **GET /podcasts/<pid>/episodes/<eid>**: Returns a single episode.
+- **GET /ask**: Streams an answer as server-sent events (same parameters as server.py).
+- **GET /metrics**: Stage latencies, token counts and cache hit rates (metrics.py).
+
+Run it with an ASGI server, for example:
+```sh
+hypercorn --bind 0.0.0.0:5000 async_server:app
+```
+"""
+
+import asyncio
+import json
+import time
+
+import httpx
+from openai import AsyncAzureOpenAI
+from quart import Quart, Response, g, jsonify, render_template, request, url_for
+from quart_cors import cors
+
+from answer_cache import create_answer_cache, prompt_key
+from ask import (
+    chat_messages,
+    episode_tags,
+    fulltext_prompt,
+    fuse,
+    indexed_embeddings,
+    parse_ask_request,
+    plan_retrieval,
+    summary_episodes,
+    system_prompt_tokens,
+)
+from async_data_repository import AsyncDataRepository, create_async_pool
+from cache_events import EpisodeChangeListener
+from context_builder import (
+    count_tokens,
+    excerpt_context,
+    fulltext_settings,
+    whole_transcript,
+)
+from data_repository import episode_filters
+from db_pool import connect_kwargs
+from embedding_cache import create_embedding_cache
+from episode_cache import create_episode_cache
+from metrics import (
+    ANSWER_SECONDS,
+    COMPLETION_TOKENS,
+    CONTENT_TYPE,
+    FIRST_TOKEN_SECONDS,
+    HTTP_SECONDS,
+    PROMPT_TOKENS,
+    REGISTRY,
+    traced,
+)
+from prompts import (
+    CHAT_MODEL,
+    EMBEDDING_MODEL,
+    SYSTEM_PROMPT,
+    rag_user_prompt,
+    summary_user_prompt,
+)
+from providers import get_config
+from rerank import RERANKERS, create_reranker, default_reranker, rerank
+from retrieval import SCOPE_EPISODE, HybridParams, search_settings
+from timings import StageTimings
+from vector_index import create_memory_index
+
+app = Quart(__name__)
+app = cors(
+    app,
+    allow_origin=["http://localhost:5000"],
+    expose_headers=["Link", "X-Prompt-Tokens", "Server-Timing"],
+)
+
+# created on startup, not on import, so they bind to the serving event loop
+# and the module imports without config.json or a database
+pool = None
+db_repo = None
+client = None
+# the persistent tier is read and written through the async pool
+embedding_cache = None
+persist_embeddings = True
+answer_cache = None
+episode_cache = None
+vector_settings = None
+fulltext_budget = fulltext_spans = None
+rerankers = None
+# None unless VECTOR_ENGINE is "memory"; it reads Postgres through a psycopg2
+# pool of its own, from worker threads
+memory_index = None
+
+
+@app.before_serving
+async def startup():
+    global pool, db_repo, client, embedding_cache, persist_embeddings
+    global answer_cache, episode_cache, vector_settings, fulltext_budget
+    global fulltext_spans, rerankers, memory_index
+
+    # PODCAST_CONFIG overrides the path, e.g. for benchmarks/load.py
+    app.config.from_mapping(get_config())
+    embedding_cache = create_embedding_cache(app.config, None)
+    persist_embeddings = app.config.get("EMBEDDING_CACHE_PERSIST", True)
+    answer_cache = create_answer_cache(app.config)
+    episode_cache = create_episode_cache(app.config)
+    vector_settings = search_settings(app.config)
+    fulltext_budget, fulltext_spans = fulltext_settings(app.config)
+    rerankers = {name: create_reranker(name, app.config) for name in RERANKERS}
+    memory_index = create_memory_index(app.config)
+    app.config.setdefault("RERANKER", default_reranker(memory_index))
+
+    # cache hit rates, as gauges on /metrics
+    REGISTRY.register_stats("podcast_embedding_cache", embedding_cache.stats)
+    REGISTRY.register_stats("podcast_answer_cache", answer_cache.stats)
+    REGISTRY.register_stats("podcast_episode_cache", episode_cache.stats)
+    if memory_index is not None:
+        REGISTRY.register_stats("podcast_vector_index", memory_index.stats)
+
+    pool = create_async_pool(app.config)
+    await pool.open()
+    db_repo = AsyncDataRepository(pool)
+    REGISTRY.register_stats("podcast_db_pool", pool.get_stats)
+
+    # drop cached answers and episode responses when an ingest script writes
+    change_callbacks = [answer_cache.invalidate_episode, episode_cache.invalidate]
+    if memory_index is not None:
+        change_callbacks.append(memory_index.refresh)
+    EpisodeChangeListener(connect_kwargs(app.config), change_callbacks).start()
+
+    # every open answer stream holds one upstream connection
+    max_connections = int(app.config.get("LLM_MAX_CONNECTIONS", 1000))
+    client = AsyncAzureOpenAI(
+        api_key=app.config["LLM_API_KEY"],
+        api_version=app.config["LLM_API_VERSION"],
+        azure_endpoint=app.config["LLM_TARGET_URI"],
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+            timeout=httpx.Timeout(600.0, connect=10.0),
+        ),
+    )
+
+
+@app.after_serving
+async def shutdown():
+    await client.close()
+    await pool.close()
+
+
+@app.route("/")
+async def index() -> str:
+    """Render the main game page."""
+    return await render_template("index.html")
+
+
+@app.route("/about", methods=["GET"])
+async def about():
+    return {"app_version": "0.2.1"}, 200
+
+
+@app.before_request
+async def start_timer():
+    g.started = time.perf_counter()
+
+
+@app.after_request
+async def record_latency(response):
+    # streamed answers are measured separately, until their last token
+    HTTP_SECONDS.observe(
+        time.perf_counter() - g.started, str(request.endpoint), response.status_code
+    )
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+async def get_metrics():
+    # Prometheus text format: stage latencies, token counts and cache stats
+    return Response(REGISTRY.render(), mimetype=CONTENT_TYPE)
+
+
+@app.route("/podcasts/<int:pid>/episodes", methods=["GET"])
+async def get_all_episodes(pid):
+    try:
+        filters = episode_filters(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    key = ("episodes", pid, filters)
+    cached = episode_cache.get(pid, key)
+    if cached is None:
+        version = episode_cache.version(pid)
+        # retrieve one page of episode details from the DB
+        episodes, next_after = await db_repo.get_episodes(pid, filters)
+        headers = {}
+        if next_after is not None:
+            # the next page keeps the same filters
+            args = {**request.args.to_dict(), "after": next_after}
+            headers["Link"] = (
+                f'<{url_for("get_all_episodes", pid=pid, **args)}>; rel="next"'
+            )
+        body = json.dumps(episodes).encode("utf-8")
+        cached = episode_cache.put(pid, key, version, body, headers)
+
+    # 304 when the client's ETag / Last-Modified is still current
+    return episode_cache.respond(Response, cached, request.headers)
+
+
+@app.route("/podcasts/<int:pid>/episodes/<int:eid>", methods=["GET"])
+async def get_episode(pid, eid):
+    key = ("episode", pid, eid)
+    cached = episode_cache.get(pid, key)
+    if cached is None:
+        version = episode_cache.version(pid)
+        # retrieve the episode details with the ID from the DB
+        episode = await db_repo.get_episode(pid, eid)
+        if episode is None:
+            return jsonify({"error": "episode not found"}), 404
+        body = json.dumps(episode).encode("utf-8")
+        cached = episode_cache.put(pid, key, version, body)
+
+    return episode_cache.respond(Response, cached, request.headers)
+
+
+async def create_embedding(text):
+    response = await client.embeddings.create(input=[text], model=EMBEDDING_MODEL)
+    return response.data[0].embedding
+
+
+async def embed_question(text):
+    # Generate embedding from the input text, unless it is already cached
+    if persist_embeddings:
+        return await embedding_cache.aget_or_create(
+            EMBEDDING_MODEL,
+            text,
+            create_embedding,
+            db_repo.get_cached_embedding,
+            db_repo.put_cached_embedding,
+        )
+    return await embedding_cache.aget_or_create(
+        EMBEDDING_MODEL, text, create_embedding
+    )
+
+
+async def select_vector(text, k, podcastids, episodeid, scope, timings):
+    with timings.stage("embed"):
+        embedding = await embed_question(text)
+
+    # nearest chunks through the ANN index, or within one episode
+    with timings.stage("vector"):
+        if memory_index is not None:
+            return await asyncio.to_thread(
+                memory_index.search, embedding, k, podcastids, episodeid, scope
+            )
+        return await db_repo.get_similar_chunks(
+            embedding, k, podcastids, episodeid, scope, vector_settings
+        )
+
+
+async def select_lexical(text, k, podcastids, episodeid, scope, timings):
+    with timings.stage("lexical"):
+        return await db_repo.get_lexical_chunks(text, k, podcastids, episodeid, scope)
+
+
+async def no_results():
+    return []
+
+
+@traced("select_embeddings")
+async def select_embeddings(
+    text,
+    podcastids,
+    episodeid=None,
+    scope=None,
+    params=HybridParams(),
+    reranking=None,
+    timings=None,
+):
+    """
+    The top `params.k` chunks for `text`. With `reranking` (RerankSettings),
+    `reranking.candidates` chunks are fused and reranked down to k.
+    """
+    timings = timings if timings is not None else StageTimings()
+    plan = plan_retrieval(params, reranking, rerankers, app.config)
+    candidates = plan.candidates
+
+    # the lexical search runs concurrently with embedding and vector search
+    vector_results, lexical_results = await asyncio.gather(
+        (
+            select_vector(text, candidates, podcastids, episodeid, scope, timings)
+            if params.vector_weight > 0
+            else no_results()
+        ),
+        (
+            select_lexical(text, candidates, podcastids, episodeid, scope, timings)
+            if params.lexical_weight > 0
+            else no_results()
+        ),
+    )
+
+    with timings.stage("fusion"):
+        results = fuse(vector_results, lexical_results, params, plan)
+
+    if plan.reranker is not None:
+        # already cached if the vector search ran
+        with timings.stage("embed"):
+            embedding = await embed_question(text)
+        with timings.stage("chunk_embeddings"):
+            embeddings, missing = indexed_embeddings(memory_index, results)
+            if missing:
+                embeddings.update(await db_repo.get_chunk_embeddings(missing))
+        # reranking tokenizes the chunks to fit them in the budget
+        with timings.stage("rerank"):
+            results = await asyncio.to_thread(
+                rerank,
+                plan.reranker,
+                text,
+                embedding,
+                results,
+                embeddings,
+                params.k,
+                reranking.token_budget,
+            )
+
+    return results
+
+
+@app.route("/ask", methods=["GET"])
+async def ask():
+    started = g.started
+    try:
+        ask = parse_ask_request(request.args, app.config)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    question, podcastids, mode = ask.question, ask.podcastids, ask.mode
+
+    system_prompt = SYSTEM_PROMPT
+    user_prompt = ""
+    # counted while the prompt is built, when it is
+    user_tokens = None
+    # episodes the prompt was built from, to invalidate cached answers
+    tags = set()
+    # latency per retrieval stage, returned in the Server-Timing header
+    timings = StageTimings()
+
+    if ask.request_type == "norag":
+        user_prompt = question
+    elif ask.request_type == "fulltext":
+        # retrieve transcript from DB for context
+        # (the transcript is only loaded here, from its own table)
+        fulltext = await db_repo.get_fulltext(podcastids[0], ask.episodeid)
+        if fulltext is None:
+            return jsonify({"error": "episode not found or not transcribed"}), 404
+        title, transcripttext = fulltext
+
+        # tokenizing a long transcript would hold up the event loop
+        with timings.stage("transcript_tokens"):
+            context = await asyncio.to_thread(whole_transcript, transcripttext)
+        if context.tokens > fulltext_budget:
+            # too long: the episode's chunks most relevant to the question
+            chunks = await select_embeddings(
+                question,
+                podcastids,
+                ask.episodeid,
+                SCOPE_EPISODE,
+                ask.params._replace(k=fulltext_spans),
+                timings=timings,
+            )
+            with timings.stage("excerpts"):
+                context = await asyncio.to_thread(
+                    excerpt_context, chunks, fulltext_budget, context
+                )
+        user_prompt, user_tokens = await asyncio.to_thread(
+            fulltext_prompt, title, question, context
+        )
+        app.logger.info(
+            f"fulltext {ask.episodeid}: {context.tokens} of "
+            f"{context.transcript_tokens} transcript tokens, {context.spans} spans"
+        )
+        tags = {(podcastids[0], ask.episodeid)}
+
+    elif ask.request_type == "summary":
+        # precomputed summaries of the episodes the top chunks come from
+        embeddings = await select_embeddings(
+            question,
+            podcastids,
+            ask.episodeid,
+            ask.scope,
+            ask.params,
+            ask.reranking,
+            timings,
+        )
+        tags = summary_episodes(ask, embeddings)
+        summaries = await db_repo.get_summaries(tags)
+        user_prompt = summary_user_prompt(question, summaries, embeddings)
+
+    else:  # default request type is "rag"
+        # retrieve transcript from DB for context
+        embeddings = await select_embeddings(
+            question,
+            podcastids,
+            ask.episodeid,
+            ask.scope,
+            ask.params,
+            ask.reranking,
+            timings,
+        )
+        user_prompt = rag_user_prompt(question, embeddings)
+        tags = episode_tags(embeddings)
+
+    # tokenizing in the event loop would hold up the other requests
+    with timings.stage("prompt_tokens"):
+        if user_tokens is None:
+            user_tokens = await asyncio.to_thread(count_tokens, user_prompt)
+        prompt_tokens = system_prompt_tokens(system_prompt) + user_tokens
+    PROMPT_TOKENS.observe(prompt_tokens, mode)
+
+    async def generate_answer(sprompt, uprompt):
+        async def complete():
+            response = await client.chat.completions.create(
+                model=CHAT_MODEL, messages=chat_messages(sprompt, uprompt), stream=True
+            )
+            parts = []
+            async for chunk in response:
+                content = chunk.choices[0].delta.content or ""
+                parts.append(content)
+                yield content
+            completion_tokens = await asyncio.to_thread(count_tokens, "".join(parts))
+            COMPLETION_TOKENS.inc(mode, amount=completion_tokens)
+
+        # replay a cached answer or join an identical request in flight
+        key = prompt_key(CHAT_MODEL, sprompt, uprompt)
+        first = True
+        async for content in answer_cache.astream(key, tags, complete):
+            if first:
+                FIRST_TOKEN_SECONDS.observe(time.perf_counter() - started, mode)
+                first = False
+            yield f"data: {content}\n\n"
+        ANSWER_SECONDS.observe(time.perf_counter() - started, mode)
+
+    response = Response(
+        generate_answer(system_prompt, user_prompt),
+        mimetype="text/event-stream",
+        headers={
+            "X-Prompt-Tokens": str(prompt_tokens),
+            "Server-Timing": timings.server_timing(),
+        },
+    )
+    # answers can stream for longer than Quart's default response timeout
+    response.timeout = None
+    return response
+
+
+if __name__ == "__main__":
+    app.run(host="0.0.0.0")
@@ -0,0 +1,150 @@
+"""
+Microbenchmark of the transcript chunker.
+
+Runs chunker.chunk_transcript on a transcript file or, without a file, on a
+synthetic transcript of `--phrases` phrases. The file is either an Azure batch
+transcription result or the `[[offset, speaker, text], ...]` phrase array that
+transcribe_ep.py writes to `transcript_json.txt` with `DEBUG_DUMPS`. The
+previous quadratic `chunktext` is timed alongside for comparison, and every
+chunk is re-encoded to check the token ceiling.
+
+```sh
+python -m benchmarks.chunker --phrases 5000
+python -m benchmarks.chunker transcript_json.txt --max-tokens 819 --overlap 80
+```
+"""
+
+import argparse
+import json
+import random
+import statistics
+import time
+
+from chunker import (
+    DEFAULT_MAX_TOKENS,
+    TERMINATING_CHARS,
+    chunk_transcript,
+    get_tokenizer,
+)
+
+WORDS = (
+    "podcast developer cloud the a to of and we really think about that's "
+    "kubernetes azure python model transcript embedding question answer "
+    "you know so basically right um like I mean"
+).split()
+
+
+def synthetic_transcript(phrases, seed=42):
+    rng = random.Random(seed)
+    recognized = []
+    for i in range(phrases):
+        text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 30)))
+        text = text.capitalize() + rng.choice([".", ".", "?", ",", ""])
+        recognized.append(
+            {
+                "offset": f"PT{i * 4.2:.2f}S",
+                "speaker": rng.choice([1, 1, 2]),
+                "nBest": [{"display": text}],
+            }
+        )
+    return {"recognizedPhrases": recognized}
+
+
+def from_phrase_array(phrases):
+    """The batch result shape of a stored phrase array, for both chunkers."""
+    return {
+        "recognizedPhrases": [
+            {"offset": offset, "speaker": speaker, "nBest": [{"display": text}]}
+            for offset, speaker, text in phrases
+        ]
+    }
+
+
+def legacy_chunktext(transcript_json, max_tokens):
+    """The chunktext() this module replaced, kept here as the baseline."""
+    tokenizer = get_tokenizer()
+    timecodes = []
+    chunks = []
+    running_token_length = 0
+    curr_timecode = "PT0.00S"
+    sentence_boundary_index = 0
+    curr_chunk = ""
+    i = 0
+    while i < len(transcript_json["recognizedPhrases"]):
+        phrase = transcript_json["recognizedPhrases"][i]["nBest"][0]["display"]
+        if running_token_length + len(tokenizer.encode(phrase)) > max_tokens:
+            chunks.append(curr_chunk)
+            timecodes.append(curr_timecode)
+            i = sentence_boundary_index + 1
+            curr_chunk = transcript_json["recognizedPhrases"][i]["nBest"][0]["display"]
+            running_token_length = len(tokenizer.encode(curr_chunk))
+            curr_timecode = transcript_json["recognizedPhrases"][i]["offset"]
+        else:
+            curr_chunk += " " + phrase
+            running_token_length += len(tokenizer.encode(phrase))
+            for chr in TERMINATING_CHARS:
+                if phrase.endswith(chr):
+                    sentence_boundary_index = i
+            i += 1
+
+    return (timecodes, chunks)
+
+
+def best_of(repeat, fn):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - started)
+    return result, min(timings), statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the transcript chunker.")
+    parser.add_argument("transcript", nargs="?", help="transcript JSON file")
+    parser.add_argument("--phrases", type=int, default=2000)
+    parser.add_argument("--max-tokens", type=int, default=DEFAULT_MAX_TOKENS)
+    parser.add_argument("--overlap", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--skip-legacy", action="store_true")
+    args = parser.parse_args()
+
+    if args.transcript:
+        with open(args.transcript) as transcript_file:
+            transcript = json.load(transcript_file)
+        if isinstance(transcript, list):
+            transcript = from_phrase_array(transcript)
+    else:
+        transcript = synthetic_transcript(args.phrases)
+
+    tokenizer = get_tokenizer()
+    phrases = len(transcript["recognizedPhrases"])
+    # warm up the tokenizer so its load time is not measured
+    tokenizer.encode("warm up")
+
+    chunks, best, median = best_of(
+        args.repeat,
+        lambda: chunk_transcript(transcript, args.max_tokens, args.overlap),
+    )
+    tokens = sum(c.tokens for c in chunks)
+    print(
+        f"chunk_transcript: {phrases} phrases -> {len(chunks)} chunks, "
+        f"best {best * 1000:.1f}ms, median {median * 1000:.1f}ms, "
+        f"{tokens / best:,.0f} tokens/sec"
+    )
+
+    over = [c for c in chunks if len(tokenizer.encode(c.text)) > args.max_tokens]
+    print(f"chunks over {args.max_tokens} tokens after re-encoding: {len(over)}")
+
+    if not args.skip_legacy:
+        (_, legacy), best, median = best_of(
+            args.repeat, lambda: legacy_chunktext(transcript, args.max_tokens)
+        )
+        print(
+            f"legacy chunktext: {phrases} phrases -> {len(legacy)} chunks, "
+            f"best {best * 1000:.1f}ms, median {median * 1000:.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
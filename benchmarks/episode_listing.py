@@ -0,0 +1,52 @@
+"""
+Latency of the keyset-paginated episode listing at increasing depth.
+
+Walks every page of a podcast's episodes through DataRepository, following
+the `after` cursor, and reports the latency of the first and last pages and
+the spread across all of them. With keyset pagination the deepest page should
+cost about the same as the first.
+
+```sh
+python -m benchmarks.episode_listing --podcastid 1 --limit 20 --transcribed any
+```
+"""
+
+import argparse
+import statistics
+import time
+
+from data_repository import DataRepository, episode_filters
+from providers import get_db_pool
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the episode listing.")
+    parser.add_argument("--podcastid", type=int, default=1)
+    parser.add_argument("--limit", default="20")
+    parser.add_argument("--transcribed", default="any")
+    args = parser.parse_args()
+
+    repo = DataRepository(get_db_pool())
+    filters = episode_filters({"limit": args.limit, "transcribed": args.transcribed})
+
+    latencies = []
+    episodes = 0
+    while True:
+        started = time.perf_counter()
+        page, after = repo.get_episodes(args.podcastid, filters)
+        latencies.append(time.perf_counter() - started)
+        episodes += len(page)
+        if after is None:
+            break
+        filters = filters._replace(after=after)
+
+    print(
+        f"{episodes} episodes in {len(latencies)} pages: "
+        f"first {latencies[0] * 1000:.2f}ms, last {latencies[-1] * 1000:.2f}ms, "
+        f"median {statistics.median(latencies) * 1000:.2f}ms, "
+        f"max {max(latencies) * 1000:.2f}ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Microbenchmarks of the database writes of the ingest scripts.
+
+- `rss`: rssconvert.write_to_postgresql on feed files. The first run inserts
+  every item, the second only finds that nothing changed.
+- `embeddings`: gen-embeddings-simple.replace_embeddings for an episode of
+  `--chunks` synthetic chunks, against one INSERT per row as the baseline.
+
+Both write to a scratch podcast (`--podcastid`, default 9999) in the database
+config.json names, and delete its rows afterwards. The chunker has its own
+benchmark, benchmarks/chunker.py.
+
+```sh
+python -m benchmarks.ingest rss caskey.rss gvtxUiIf.rss
+python -m benchmarks.ingest embeddings --chunks 500 --repeat 5
+```
+"""
+
+import argparse
+import importlib
+import random
+import statistics
+import time
+
+from providers import get_db_pool
+from rssconvert import read_items, write_to_postgresql
+
+SCRATCH_PODCASTID = 9999
+SCRATCH_EPISODEID = 1
+DIMENSIONS = 1536
+
+
+def delete_podcast(pool, podcastid):
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        for table in ("simple_embeddings", "episodes", "feeds"):
+            cursor.execute(f"DELETE FROM {table} WHERE podcastid = %s;", (podcastid,))
+        cursor.close()
+
+
+def bench_rss(pool, podcastid, feeds):
+    for path in feeds:
+        delete_podcast(pool, podcastid)
+        for run in ("insert", "unchanged"):
+            started = time.perf_counter()
+            count = write_to_postgresql(podcastid, read_items(path, path), pool)
+            seconds = time.perf_counter() - started
+            print(
+                f"{path} {run:<9} {count} items in {seconds * 1000:.0f}ms, "
+                f"{count / seconds:.0f} items/s"
+            )
+    delete_podcast(pool, podcastid)
+
+
+def synthetic_chunks(count, seed=0):
+    rng = random.Random(seed)
+    timecodes = [f"PT{i * 30}.00S" for i in range(count)]
+    chunks = [f"Chunk {i}: " + "words " * rng.randint(100, 600) for i in range(count)]
+    embeddings = [
+        [rng.uniform(-0.05, 0.05) for _ in range(DIMENSIONS)] for _ in range(count)
+    ]
+    return timecodes, chunks, embeddings
+
+
+def insert_row_by_row(pool, podcastid, episodeid, timecodes, chunks, embeddings):
+    """One INSERT per chunk, as the script did before multi-row inserts."""
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "DELETE FROM simple_embeddings WHERE podcastid = %s AND episodeid = %s;",
+            (podcastid, episodeid),
+        )
+        for timecode, chunk, embedding in zip(timecodes, chunks, embeddings):
+            cursor.execute(
+                """
+                INSERT INTO simple_embeddings
+                    (podcastid, episodeid, timecode, chunk, embedding)
+                VALUES (%s, %s, %s, %s, %s::vector);
+                """,
+                (podcastid, episodeid, timecode, chunk, str(embedding)),
+            )
+        cursor.close()
+
+
+def bench_embeddings(pool, podcastid, count, repeat):
+    # a script module, not a package module
+    embed_module = importlib.import_module("gen-embeddings-simple")
+
+    timecodes, chunks, embeddings = synthetic_chunks(count)
+    for name, insert in (
+        ("row by row", lambda *rows: insert_row_by_row(pool, *rows)),
+        ("multi-row", embed_module.replace_embeddings),
+    ):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            insert(podcastid, SCRATCH_EPISODEID, timecodes, chunks, embeddings)
+            timings.append(time.perf_counter() - started)
+        median = statistics.median(timings)
+        print(
+            f"{name:<10} {count} chunks: best {min(timings) * 1000:.0f}ms, "
+            f"median {median * 1000:.0f}ms, {count / median:.0f} chunks/s"
+        )
+    delete_podcast(pool, podcastid)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ingest writes.")
+    parser.add_argument("benchmark", choices=["rss", "embeddings"])
+    parser.add_argument("feeds", nargs="*", default=["caskey.rss", "gvtxUiIf.rss"])
+    parser.add_argument("--podcastid", type=int, default=SCRATCH_PODCASTID)
+    parser.add_argument("--chunks", type=int, default=300)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    pool = get_db_pool()
+
+    if args.benchmark == "rss":
+        bench_rss(pool, args.podcastid, args.feeds)
+    else:
+        bench_embeddings(pool, args.podcastid, args.chunks, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
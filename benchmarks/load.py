@@ -0,0 +1,236 @@
+"""
+End-to-end load test of the server against a local Postgres and the fake
+OpenAI API.
+
+Starts fakes.openai_api and the server, either server.py with Flask's threaded
+server or async_server.py with hypercorn. The server gets a copy of config.json
+whose `LLM_TARGET_URI` points at the fake, passed in `PODCAST_CONFIG`. The
+database is the one config.json names, with real episodes and embeddings. Each
+scenario then sends `--requests` requests from `--concurrency` threads:
+
+- `norag`, `fulltext`, `rag`, `summary`: `/ask` in that mode. Questions are the
+  sample questions of the podcast's episodes. Each one gets a unique suffix,
+  unless `--warm` is given, so the embedding and answer caches miss as they do
+  for new questions.
+- `episodes`, `episode`: one page of the episode listing, one episode.
+
+For every scenario the report gives requests/sec, the p50 and p99 of the full
+response time, and the time to the first byte of the body. For `/ask` that is
+the first server-sent event.
+
+```sh
+python -m benchmarks.load --server flask --concurrency 16 --requests 200
+python -m benchmarks.load --server async --scenarios rag,fulltext --tokens 300
+python -m benchmarks.load --url http://localhost:5000 --scenarios episodes,episode
+```
+With `--url`, an already running server is measured as it is configured.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import NamedTuple
+
+import requests
+
+from embedding_cache import questions_from_column
+from fakes import openai_api
+
+ASK_SCENARIOS = ("norag", "fulltext", "rag", "summary")
+SCENARIOS = ASK_SCENARIOS + ("episodes", "episode")
+FALLBACK_QUESTIONS = [
+    "What does the guest say about testing in production?",
+    "Which cloud services were discussed?",
+    "How did they get started in software development?",
+]
+STARTUP_TIMEOUT = 60
+
+
+class Result(NamedTuple):
+    ok: bool
+    seconds: float
+    first_byte: float
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a non-empty list."""
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, round(p / 100 * len(values)) - 1))]
+
+
+def fetch(session, url):
+    started = time.perf_counter()
+    first_byte = None
+    try:
+        with session.get(url, stream=True, timeout=120) as response:
+            for chunk in response.iter_content(chunk_size=None):
+                if first_byte is None and chunk:
+                    first_byte = time.perf_counter() - started
+            ok = response.status_code in (200, 304)
+    except requests.RequestException:
+        ok = False
+    seconds = time.perf_counter() - started
+    return Result(ok, seconds, first_byte if first_byte is not None else seconds)
+
+
+def run_scenario(urls, requests_count, concurrency):
+    """Send `requests_count` requests, cycling through `urls`."""
+    results = []
+    lock = threading.Lock()
+    counter = itertools.count()
+
+    def worker():
+        session = requests.Session()
+        while True:
+            i = next(counter)
+            if i >= requests_count:
+                break
+            result = fetch(session, urls[i % len(urls)])
+            with lock:
+                results.append(result)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - started
+
+
+def scenario_urls(base, scenario, pid, episodes, warm, count):
+    eids = [episode["id"] for episode in episodes] or [1]
+    questions = [
+        question
+        for episode in episodes
+        for question in questions_from_column(episode.get("sample_questions"))
+    ] or FALLBACK_QUESTIONS
+
+    if scenario == "episodes":
+        return [f"{base}/podcasts/{pid}/episodes?limit=20"]
+    if scenario == "episode":
+        return [f"{base}/podcasts/{pid}/episodes/{eid}" for eid in eids]
+
+    urls = []
+    for i in range(count if not warm else len(questions)):
+        question = questions[i % len(questions)]
+        if not warm:
+            question = f"{question} ({i})"
+        params = {"q": question, "type": scenario, "pid": pid}
+        if scenario == "fulltext":
+            params["eid"] = eids[i % len(eids)]
+        urls.append(requests.Request("GET", f"{base}/ask", params=params).prepare().url)
+    return urls
+
+
+def start_server(kind, port, llm_url):
+    with open("config.json") as config_file:
+        config = json.load(config_file)
+    config["LLM_TARGET_URI"] = llm_url
+
+    config_path = os.path.join(tempfile.mkdtemp(), "config.json")
+    with open(config_path, "w") as f:
+        json.dump(config, f)
+
+    if kind == "flask":
+        command = ["-m", "flask", "--app", "server", "run", "--port", str(port)]
+        command += ["--no-reload", "--no-debugger", "--with-threads"]
+    else:
+        command = ["-m", "hypercorn", "--bind", f"127.0.0.1:{port}", "async_server:app"]
+    process = subprocess.Popen(
+        [sys.executable, *command], env={**os.environ, "PODCAST_CONFIG": config_path}
+    )
+
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f"http://127.0.0.1:{port}/about", timeout=1).ok:
+                return process
+        except requests.RequestException:
+            pass
+        if process.poll() is not None:
+            break
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError(f"{kind} server did not start on port {port}")
+
+
+def report(scenario, results, seconds):
+    ok = [result for result in results if result.ok]
+    if not ok:
+        print(f"{scenario:<9} {len(results)} requests, all failed")
+        return
+    latencies = [result.seconds * 1000 for result in ok]
+    first_bytes = [result.first_byte * 1000 for result in ok]
+    print(
+        f"{scenario:<9} {len(results):>5} req {len(results) - len(ok):>3} err "
+        f"{len(results) / seconds:>8.1f} req/s | "
+        f"p50 {percentile(latencies, 50):>8.1f}ms "
+        f"p99 {percentile(latencies, 99):>8.1f}ms | "
+        f"first byte p50 {percentile(first_bytes, 50):>7.1f}ms "
+        f"p99 {percentile(first_bytes, 99):>7.1f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the podcast server.")
+    parser.add_argument("--server", choices=["flask", "async"], default="flask")
+    parser.add_argument("--url", help="measure a running server instead")
+    parser.add_argument("--port", type=int, default=5050)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--podcastid", type=int, default=1)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warm", action="store_true", help="repeat questions")
+    # fake OpenAI API
+    parser.add_argument("--llm-port", type=int, default=8090)
+    parser.add_argument("--first-token-latency", type=float, default=0.3)
+    parser.add_argument("--token-latency", type=float, default=0.02)
+    parser.add_argument("--tokens", type=int, default=100)
+    parser.add_argument("--embedding-latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    scenarios = args.scenarios.split(",")
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    process = None
+    base = args.url
+    if base is None:
+        openai_api.serve(
+            args.llm_port,
+            args.first_token_latency,
+            args.token_latency,
+            args.tokens,
+            args.embedding_latency,
+        )
+        process = start_server(
+            args.server, args.port, f"http://127.0.0.1:{args.llm_port}"
+        )
+        base = f"http://127.0.0.1:{args.port}"
+
+    try:
+        episodes = requests.get(
+            f"{base}/podcasts/{args.podcastid}/episodes?limit=100", timeout=30
+        ).json()
+        for scenario in scenarios:
+            urls = scenario_urls(
+                base, scenario, args.podcastid, episodes, args.warm, args.requests
+            )
+            results, seconds = run_scenario(urls, args.requests, args.concurrency)
+            report(scenario, results, seconds)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
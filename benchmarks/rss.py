@@ -0,0 +1,104 @@
+"""
+Streaming RSS reader (feed_reader.py) versus feedparser.
+
+For every feed file, reports the time to parse all items, the time until the
+first item is available and the peak Python memory while parsing. The episode
+fields rssconvert.py writes are compared between the two parsers.
+
+```sh
+python -m benchmarks.rss caskey.rss gvtxUiIf.rss
+```
+"""
+
+import argparse
+import statistics
+import time
+import tracemalloc
+
+import feedparser
+
+from feed_reader import iter_items
+from rssconvert import episode_fields, item_authors
+
+
+def run_feedparser(path):
+    return feedparser.parse(path)["items"]
+
+
+def run_streaming(path):
+    return list(iter_items(path))
+
+
+def first_item(parse, path):
+    started = time.perf_counter()
+    if parse is run_feedparser:
+        next(iter(feedparser.parse(path)["items"]))
+    else:
+        next(iter_items(path))
+    return time.perf_counter() - started
+
+
+def measure(parse, path, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        items = parse(path)
+        timings.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    if parse is run_feedparser:
+        parse(path)
+    else:
+        # consume without keeping the items, as the DB writer does
+        for _ in iter_items(path):
+            pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return items, min(timings), statistics.median(timings), peak
+
+
+def mismatches(expected, actual):
+    authors_expected = item_authors(expected[0] if expected else None)
+    authors_actual = item_authors(actual[0] if actual else None)
+    fields = ("title", "summary", "url", "authors", "published", "duration", "guid")
+    counts = dict.fromkeys(fields, 0)
+    for a, b in zip(expected, actual):
+        for field, x, y in zip(
+            fields,
+            episode_fields(a, authors_expected),
+            episode_fields(b, authors_actual),
+        ):
+            counts[field] += x != y
+    return {field: n for field, n in counts.items() if n}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the RSS readers.")
+    parser.add_argument("feeds", nargs="*", default=["caskey.rss", "gvtxUiIf.rss"])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for path in args.feeds:
+        results = {}
+        for name, parse in (
+            ("feedparser", run_feedparser),
+            ("streaming", run_streaming),
+        ):
+            items, best, median, peak = measure(parse, path, args.repeat)
+            results[name] = items
+            print(
+                f"{path} {name:<10} {len(items)} items, "
+                f"best {best * 1000:.0f}ms, median {median * 1000:.0f}ms, "
+                f"first item {first_item(parse, path) * 1000:.1f}ms, "
+                f"peak {peak / 1024 / 1024:.1f}MiB"
+            )
+        # feedparser re-serializes summary HTML, so small differences are expected
+        print(
+            f"{path} fields differing from feedparser: "
+            f"{mismatches(results['feedparser'], results['streaming']) or 'none'}"
+        )
+
+
+if __name__ == "__main__":
+    main()
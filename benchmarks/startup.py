@@ -0,0 +1,129 @@
+"""
+Import-time budget of the scripts and servers.
+
+Every module is imported in a fresh interpreter with `python -X importtime`,
+`--repeat` times, and the fastest run is kept. The report gives the
+cumulative import time against the module's budget in `IMPORT_BUDGET_MS`,
+and its `--top` slowest direct imports. The exit status is 1 when a module is
+over budget or fails to import, so the check can run in CI. Other modules can
+be named on the command line and are reported without a budget.
+
+The scripts import nothing that needs config.json, a database or the network
+until they run, and neither do the servers, which build their pool and caches
+on startup. The servers import their web framework and the OpenAI SDK, so
+they are only measured with `--servers`, against a budget of their own.
+
+```sh
+python -m benchmarks.startup
+python -m benchmarks.startup --servers --repeat 5
+python -m benchmarks.startup rssconvert summarize_episodes --top 10
+```
+"""
+
+import argparse
+import subprocess
+import sys
+from typing import NamedTuple
+
+# cumulative milliseconds, with room for a slower machine
+IMPORT_BUDGET_MS = {
+    "rssconvert": 150,
+    "transcribe_ep": 150,
+    "gen-embeddings-simple": 150,
+    "transcription_orchestrator": 150,
+    "ingest_queue": 150,
+}
+SERVER_BUDGET_MS = {
+    "server": 1500,
+    "async_server": 1500,
+}
+
+
+class ImportTime(NamedTuple):
+    cumulative_us: int
+    # (microseconds, name) of the direct imports, slowest first
+    imports: list
+
+
+def parse_importtime(output, module):
+    """The target's cumulative time and its direct imports, from stderr."""
+    cumulative = None
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, total, name = line[len("import time:") :].split("|")
+        if not total.strip().isdigit():
+            # the header line
+            continue
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0 and name.strip() == module:
+            cumulative = int(total)
+        elif depth == 1:
+            imports.append((int(total), name.strip()))
+    if cumulative is None:
+        return None
+    # the direct imports are listed before the module that imports them
+    return ImportTime(cumulative, sorted(imports, reverse=True))
+
+
+def measure(module, repeat):
+    best = None
+    for _ in range(repeat):
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-X",
+                "importtime",
+                "-c",
+                f"__import__({module!r})",
+            ],
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            error = result.stderr.strip().splitlines()
+            raise RuntimeError(error[-1] if error else "import failed")
+        timing = parse_importtime(result.stderr, module)
+        if timing is None:
+            raise RuntimeError("no import time reported")
+        if best is None or timing.cumulative_us < best.cumulative_us:
+            best = timing
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the import-time budget.")
+    parser.add_argument("modules", nargs="*", help="default: every budgeted module")
+    parser.add_argument("--servers", action="store_true", help="include the servers")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--top", type=int, default=5)
+    args = parser.parse_args()
+
+    budgets = {**IMPORT_BUDGET_MS, **SERVER_BUDGET_MS}
+    modules = args.modules or list(IMPORT_BUDGET_MS)
+    if args.servers and not args.modules:
+        modules += list(SERVER_BUDGET_MS)
+
+    failed = False
+    for module in modules:
+        budget = budgets.get(module)
+        try:
+            timing = measure(module, args.repeat)
+        except RuntimeError as e:
+            print(f"{module:<28} failed: {e}")
+            failed = True
+            continue
+        ms = timing.cumulative_us / 1000
+        over = budget is not None and ms > budget
+        failed = failed or over
+        limit = f"budget {budget}ms" if budget is not None else "no budget"
+        print(f"{module:<28} {ms:>7.1f}ms  {limit}{'  OVER' if over else ''}")
+        for us, name in timing.imports[: args.top]:
+            print(f"    {us / 1000:>7.1f}ms  {name}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
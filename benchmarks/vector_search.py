@@ -0,0 +1,134 @@
+"""
+Recall@k versus latency of the ANN index on simple_embeddings.
+
+Query vectors are stored chunk embeddings with a little noise added. For each
+query the exact top-k (sequential scan, index scans disabled) is compared with
+the ANN top-k at every `hnsw.ef_search` / `ivfflat.probes` value given.
+
+Run from the repository root, with the index built by retrieval.py:
+```sh
+python -m benchmarks.vector_search --queries 100 --k 5 --ef-search 10,20,40,80,160
+python -m benchmarks.vector_search --probes 1,5,10,20
+```
+"""
+
+import argparse
+import math
+import random
+import statistics
+import time
+
+import psycopg2
+
+from db_pool import connect_kwargs
+from embedding_cache import parse_vector
+from providers import get_config
+from retrieval import distance_operator, settings_queries
+
+NEAREST_IDS_QUERY = """
+    SELECT id FROM simple_embeddings
+    WHERE podcastid = %s
+    ORDER BY embedding {op} %s::vector
+    LIMIT %s;
+    """
+
+
+def sample_queries(cursor, podcastid, count, noise, seed):
+    cursor.execute(
+        """
+        SELECT embedding FROM simple_embeddings
+        WHERE podcastid = %s
+        ORDER BY random()
+        LIMIT %s;
+        """,
+        (podcastid, count),
+    )
+    rng = random.Random(seed)
+    queries = []
+    for row in cursor.fetchall():
+        vector = [x + rng.gauss(0.0, noise) for x in parse_vector(row[0])]
+        norm = math.sqrt(sum(x * x for x in vector))
+        queries.append([x / norm for x in vector])
+    return queries
+
+
+def nearest_ids(conn, podcastid, vector, k, settings):
+    cursor = conn.cursor()
+    for query, params in settings:
+        cursor.execute(query, params)
+
+    started = time.perf_counter()
+    cursor.execute(
+        NEAREST_IDS_QUERY.format(op=distance_operator()), (podcastid, str(vector), k)
+    )
+    ids = [row[0] for row in cursor.fetchall()]
+    elapsed = time.perf_counter() - started
+
+    cursor.close()
+    conn.rollback()
+    return ids, elapsed
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def report(label, recalls, latencies):
+    print(
+        f"{label:<20} recall@k={statistics.mean(recalls):.3f} "
+        f"mean={statistics.mean(latencies) * 1000:.2f}ms "
+        f"p50={percentile(latencies, 50) * 1000:.2f}ms "
+        f"p95={percentile(latencies, 95) * 1000:.2f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--podcastid", type=int, default=1)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--noise", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--ef-search", default="10,20,40,80,160")
+    parser.add_argument("--probes", default="")
+    args = parser.parse_args()
+
+    config = get_config()
+
+    conn = psycopg2.connect(**connect_kwargs(config))
+    cursor = conn.cursor()
+    queries = sample_queries(
+        cursor, args.podcastid, args.queries, args.noise, args.seed
+    )
+    cursor.close()
+    conn.rollback()
+
+    # ground truth: force a sequential scan and sort
+    exact_settings = [
+        ("SELECT set_config('enable_indexscan', 'off', true);", ()),
+        ("SELECT set_config('enable_bitmapscan', 'off', true);", ()),
+    ]
+    exact, exact_latencies = [], []
+    for vector in queries:
+        ids, elapsed = nearest_ids(conn, args.podcastid, vector, args.k, exact_settings)
+        exact.append(set(ids))
+        exact_latencies.append(elapsed)
+    report("exact scan", [1.0] * len(queries), exact_latencies)
+
+    runs = [("ef_search", int(v)) for v in args.ef_search.split(",") if v]
+    runs += [("probes", int(v)) for v in args.probes.split(",") if v]
+    for knob, value in runs:
+        settings = settings_queries(**{knob: value})
+        recalls, latencies = [], []
+        for vector, truth in zip(queries, exact):
+            ids, elapsed = nearest_ids(conn, args.podcastid, vector, args.k, settings)
+            recalls.append(len(truth.intersection(ids)) / max(1, len(truth)))
+            latencies.append(elapsed)
+        report(f"{knob}={value}", recalls, latencies)
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Change notifications from the ingest scripts to the running servers.
+
+transcribe_ep.py and gen-embeddings-simple.py run in their own processes. When
+they rewrite an episode's transcript or embeddings they call
+`notify_episode_changed` inside their transaction, which issues a Postgres
+NOTIFY on the `episode_changed` channel once it commits. rssconvert.py calls
+`notify_podcast_changed` after upserting a feed's episodes, which can touch any
+episode of the podcast. Each server process runs an `EpisodeChangeListener`
+that LISTENs on that channel and hands the (podcastid, episodeid) to its
+caches; episodeid is None for podcast-wide changes.
+"""
+
+import logging
+import select
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+EPISODE_CHANNEL = "episode_changed"
+
+
+def notify_episode_changed(cursor, podcastid, episodeid):
+    """Queue a change notification, delivered when the cursor's transaction commits."""
+    cursor.execute(
+        "SELECT pg_notify(%s, %s);", (EPISODE_CHANNEL, f"{podcastid}:{episodeid}")
+    )
+
+
+def notify_podcast_changed(cursor, podcastid):
+    """Like `notify_episode_changed`, for changes to any episode of the podcast."""
+    cursor.execute("SELECT pg_notify(%s, %s);", (EPISODE_CHANNEL, f"{podcastid}:*"))
+
+
+def parse_payload(payload):
+    podcastid, episodeid = payload.split(":", 1)
+    if episodeid == "*":
+        return int(podcastid), None
+    return int(podcastid), int(episodeid)
+
+
+class EpisodeChangeListener(threading.Thread):
+    """
+    Background thread that calls every callback with (podcastid, episodeid)
+    for each `episode_changed` notification, reconnecting if the dedicated
+    connection drops.
+    """
+
+    def __init__(self, connect_kwargs, callbacks, reconnect_delay=5.0):
+        super().__init__(name="episode-change-listener", daemon=True)
+        self.connect_kwargs = connect_kwargs
+        self.callbacks = list(callbacks)
+        self.reconnect_delay = reconnect_delay
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _dispatch(self, payload):
+        try:
+            podcastid, episodeid = parse_payload(payload)
+        except ValueError:
+            logging.warning(f"Ignoring malformed {EPISODE_CHANNEL} payload {payload!r}")
+            return
+        for callback in self.callbacks:
+            try:
+                callback(podcastid, episodeid)
+            except Exception:
+                logging.exception(f"{EPISODE_CHANNEL} callback failed")
+
+    def _listen(self):
+        conn = psycopg2.connect(**self.connect_kwargs)
+        try:
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cursor = conn.cursor()
+            cursor.execute(f"LISTEN {EPISODE_CHANNEL};")
+
+            while not self._stopped.is_set():
+                # wake up periodically to notice stop()
+                if select.select([conn], [], [], 5.0) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    self._dispatch(conn.notifies.pop(0).payload)
+        finally:
+            conn.close()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self._listen()
+            except psycopg2.Error as e:
+                logging.warning(f"{EPISODE_CHANNEL} listener disconnected: {e}")
+                time.sleep(self.reconnect_delay)
@@ -0,0 +1,182 @@
+"""
+Splits an Azure batch transcription into chunks for embedding.
+
+The transcript JSON has one `recognizedPhrases` entry per utterance, each with
+an ISO 8601 `offset`, an optional diarization `speaker` and the recognized text
+in `nBest[0].display`. Chunks are runs of consecutive phrases:
+
+- every phrase is tokenized exactly once, in one `encode_batch` call,
+- a chunk never exceeds `max_tokens`; a phrase that is longer on its own is
+  split on token boundaries,
+- a full chunk is cut after the last sentence end (or speaker change) it
+  contains, and the next chunk starts with up to `overlap_tokens` of the
+  previous one,
+- the whole transcript is covered in a single pass: the window end and the
+  candidate cut points only ever move forward.
+
+Token counts are computed per phrase with the leading space that joins it to
+the previous one. tiktoken splits text on that space before merging tokens, so
+the counts add up to the token count of the joined chunk.
+"""
+
+import threading
+from typing import NamedTuple
+
+from transcripts import phrase_array
+
+TIKTOKEN_MODEL_NAME = "cl100k_base"
+TIKTOKEN_MAX_TOKENS = 8192
+DEFAULT_MAX_TOKENS = TIKTOKEN_MAX_TOKENS // 10
+# Characters that are considered sentence terminators
+TERMINATING_CHARS = (".", "?", "!")
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+
+def get_tokenizer():
+    """The shared tiktoken encoding, loaded on first use."""
+    global _tokenizer
+    if _tokenizer is None:
+        with _tokenizer_lock:
+            if _tokenizer is None:
+                # imported here so importing the chunker stays cheap
+                import tiktoken
+
+                _tokenizer = tiktoken.get_encoding(TIKTOKEN_MODEL_NAME)
+    return _tokenizer
+
+
+class Chunk(NamedTuple):
+    timecode: str
+    text: str
+    tokens: int
+
+
+def chunk_transcript(
+    transcript_json,
+    max_tokens=DEFAULT_MAX_TOKENS,
+    overlap_tokens=0,
+    speaker_boundaries=True,
+    tokenizer=None,
+):
+    """
+    Return the list of `Chunk`s covering an Azure batch transcription result.
+    See `chunk_phrases` for the arguments.
+    """
+    return chunk_phrases(
+        phrase_array(transcript_json),
+        max_tokens,
+        overlap_tokens,
+        speaker_boundaries,
+        tokenizer,
+    )
+
+
+def chunk_phrases(
+    phrases,
+    max_tokens=DEFAULT_MAX_TOKENS,
+    overlap_tokens=0,
+    speaker_boundaries=True,
+    tokenizer=None,
+):
+    """
+    Return the list of `Chunk`s covering the transcript.
+
+    Args:
+        phrases: (offset, speaker, text) per recognized phrase, in order, as
+            stored in the transcripts table.
+        max_tokens (int): Hard ceiling on the tokens of every chunk.
+        overlap_tokens (int): Tokens of trailing phrases repeated at the start of
+            the next chunk. Must be smaller than `max_tokens`.
+        speaker_boundaries (bool): Also allow cuts where the speaker changes.
+        tokenizer: tiktoken encoding, the shared cl100k_base one by default.
+    """
+    if max_tokens < 1 or not 0 <= overlap_tokens < max_tokens:
+        raise ValueError(f"invalid max_tokens={max_tokens} overlap={overlap_tokens}")
+
+    tokenizer = tokenizer or get_tokenizer()
+    phrases = [
+        (offset or "PT0S", speaker, text.strip())
+        for offset, speaker, text in phrases
+        if text and text.strip()
+    ]
+    n = len(phrases)
+    if n == 0:
+        return []
+
+    encoded = tokenizer.encode_batch([" " + text for _, _, text in phrases])
+
+    # prefix[i] is the number of tokens in phrases[:i]
+    prefix = [0] * (n + 1)
+    for i, tokens in enumerate(encoded):
+        prefix[i + 1] = prefix[i] + len(tokens)
+
+    # positions where a chunk may end (exclusive), in increasing order
+    cuts = []
+    for i, (_, speaker, text) in enumerate(phrases):
+        if (
+            speaker_boundaries
+            and i > 0
+            and speaker is not None
+            and speaker != phrases[i - 1][1]
+        ):
+            if not cuts or cuts[-1] != i:
+                cuts.append(i)
+        if text.endswith(TERMINATING_CHARS):
+            cuts.append(i + 1)
+
+    chunks = []
+    start = 0
+    end = 0
+    cut = 0  # index into cuts of the first cut position > end
+
+    while start < n:
+        end = max(end, start)
+        while end < n and prefix[end + 1] - prefix[start] <= max_tokens:
+            end += 1
+        while cut < len(cuts) and cuts[cut] <= end:
+            cut += 1
+
+        if end == start:
+            # a single phrase over the ceiling: split it on token boundaries
+            offset, _, _ = phrases[start]
+            tokens = encoded[start]
+            for i in range(0, len(tokens), max_tokens):
+                piece = tokens[i : i + max_tokens]
+                chunks.append(Chunk(offset, tokenizer.decode(piece).strip(), len(piece)))
+            start += 1
+            continue
+
+        stop = end
+        if end < n and cut > 0 and cuts[cut - 1] > start:
+            # end the chunk on the last sentence or speaker boundary in it
+            stop = cuts[cut - 1]
+
+        chunks.append(
+            Chunk(
+                phrases[start][0],
+                " ".join(text for _, _, text in phrases[start:stop]),
+                prefix[stop] - prefix[start],
+            )
+        )
+        if stop >= n:
+            break
+
+        # step back over the trailing phrases that fit in the overlap, while
+        # always moving forward
+        next_start = stop
+        while (
+            next_start - 1 > start
+            and prefix[stop] - prefix[next_start - 1] <= overlap_tokens
+        ):
+            next_start -= 1
+        start = next_start
+
+    return chunks
+
+
+# Chunk text with timestamp at a sentence boundary that is just less than max token size
+def chunktext(transcript_json, max_tokens=DEFAULT_MAX_TOKENS):
+    chunks = chunk_transcript(transcript_json, max_tokens)
+    return ([c.timecode for c in chunks], [c.text for c in chunks])
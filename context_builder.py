@@ -0,0 +1,89 @@
+"""
+Token-budgeted context for the `fulltext` mode of `/ask`.
+
+A multi-hour episode's transcript can be longer than the chat model's context,
+and even when it fits, every token of it adds to the prompt latency and cost.
+The transcript is counted with the tokenizer the chunks were built with
+(chunker.py). When it fits in the budget (`FULLTEXT_TOKEN_BUDGET` in
+config.json) it is sent whole. When it does not, the context is assembled from
+the episode's own chunks: the caller ranks them against the question with the
+RAG retrieval scoped to the episode, the most relevant ones are taken until the
+budget is used up, and they are put back in transcript order.
+"""
+
+from typing import NamedTuple
+
+from chunker import get_tokenizer
+
+DEFAULT_FULLTEXT_BUDGET = 12000
+# chunks ranked for an episode that does not fit the budget
+DEFAULT_FULLTEXT_SPANS = 50
+
+
+class FulltextContext(NamedTuple):
+    text: str
+    tokens: int
+    transcript_tokens: int
+    # 0 when the whole transcript is used
+    spans: int
+
+
+def count_tokens(text, tokenizer=None):
+    tokenizer = tokenizer or get_tokenizer()
+    # transcripts are plain text; do not reject "<|endoftext|>" and friends
+    return len(tokenizer.encode(text, disallowed_special=()))
+
+
+def fulltext_settings(config):
+    """The budget and span count from the optional config.json keys."""
+    return (
+        int(config.get("FULLTEXT_TOKEN_BUDGET", DEFAULT_FULLTEXT_BUDGET)),
+        int(config.get("FULLTEXT_SPANS", DEFAULT_FULLTEXT_SPANS)),
+    )
+
+
+def whole_transcript(transcripttext, tokenizer=None):
+    """The context of the whole transcript; check `tokens` against the budget."""
+    tokens = count_tokens(transcripttext, tokenizer)
+    return FulltextContext(transcripttext, tokens, tokens, 0)
+
+
+def format_span(row):
+    # rows of (episodeid, title, timecode, chunk), as returned by retrieval.py
+    return f"[{row[2]}] {row[3]}\n"
+
+
+def excerpt_context(chunks, budget, transcript, tokenizer=None):
+    """
+    Build the context from `chunks`, ranked best first, within `budget` tokens.
+    `transcript` is the over-budget `whole_transcript`; its beginning is used
+    when the episode has no chunks yet.
+    """
+    tokenizer = tokenizer or get_tokenizer()
+
+    selected = []
+    used = 0
+    spans = [format_span(row) for row in chunks]
+    counts = [
+        len(encoded)
+        for encoded in tokenizer.encode_batch(spans, disallowed_special=())
+    ]
+    for row, count in zip(chunks, counts):
+        # smaller chunks further down may still fit
+        if used + count <= budget:
+            selected.append(row)
+            used += count
+
+    if not selected:
+        tokens = tokenizer.encode(transcript.text, disallowed_special=())
+        text = tokenizer.decode(tokens[:budget])
+        return FulltextContext(
+            text, count_tokens(text, tokenizer), transcript.tokens, 0
+        )
+
+    # read in transcript order, not in relevance order
+    selected.sort(key=lambda row: (row[0], row[2]))
+    text = "".join(format_span(row) for row in selected)
+    return FulltextContext(
+        text, count_tokens(text, tokenizer), transcript.tokens, len(selected)
+    )
@@ -5,6 +5,9 @@ CREATE DATABASE multocasto;
 -- Use the created database
 \c multocasto;
 
+-- pgvector provides the VECTOR type and the ANN index methods
+CREATE EXTENSION IF NOT EXISTS vector;
+
 -- Create a table named podcasts with two columns: ID and NAME
 CREATE TABLE IF NOT EXISTS podcasts (
     id SERIAL PRIMARY KEY,
@@ -33,17 +36,177 @@ CREATE TABLE IF NOT EXISTS episodes (
     duration INTERVAL,
     questions JSONB,
     transcribed BOOLEAN,
-    transcript JSONB,
-    transcripttext TEXT
+    guid TEXT
 );
 
+-- Databases created before rssconvert.py upserted episodes: add the feed item
+-- guid, and make (podcastid, episodeid) unique. Re-runs of the old script
+-- duplicated episodes; keep one row per key, the transcribed one if any, else
+-- the oldest
+ALTER TABLE episodes ADD COLUMN IF NOT EXISTS guid TEXT;
+DELETE FROM episodes AS duplicate
+USING episodes AS kept
+WHERE duplicate.podcastid = kept.podcastid
+AND duplicate.episodeid = kept.episodeid
+AND (kept.transcribed IS TRUE, duplicate.id) > (duplicate.transcribed IS TRUE, kept.id);
+CREATE UNIQUE INDEX IF NOT EXISTS episodes_podcast_episode
+    ON episodes (podcastid, episodeid);
+
+-- Episode listing (data_repository.py): keyset pages walk episodeid backwards,
+-- by default over transcribed episodes only; published ranges use the second index
+CREATE INDEX IF NOT EXISTS episodes_podcast_transcribed_episode
+    ON episodes (podcastid, transcribed, episodeid DESC);
+CREATE INDEX IF NOT EXISTS episodes_podcast_published
+    ON episodes (podcastid, published, episodeid);
+
+-- Transcripts, kept out of episodes so metadata scans do not read them.
+-- phrases is [[offset, speaker, display], ...], text the flat lexical transcript
+CREATE TABLE IF NOT EXISTS transcripts (
+   podcastid INT NOT NULL,
+   episodeid INT NOT NULL,
+   phrases JSONB NOT NULL,
+   text TEXT NOT NULL,
+   updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+   PRIMARY KEY (podcastid, episodeid)
+ );
+
+-- Databases created before the transcripts table: move the transcripts over
+-- and drop the inline columns
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'episodes' AND column_name = 'transcript'
+    ) THEN
+        INSERT INTO transcripts (podcastid, episodeid, phrases, text)
+        SELECT podcastid, episodeid,
+            (
+                SELECT COALESCE(jsonb_agg(
+                    jsonb_build_array(
+                        phrase->'offset', phrase->'speaker', phrase->'nBest'->0->'display'
+                    ) ORDER BY position), '[]'::jsonb)
+                FROM jsonb_array_elements(transcript->'recognizedPhrases')
+                    WITH ORDINALITY AS phrases(phrase, position)
+            ),
+            COALESCE(transcripttext, '')
+        FROM episodes
+        WHERE transcript IS NOT NULL
+        ON CONFLICT (podcastid, episodeid) DO NOTHING;
+
+        ALTER TABLE episodes DROP COLUMN transcript, DROP COLUMN transcripttext;
+    END IF;
+END $$;
+
+-- RSS feeds synced incrementally by rssconvert.py --sync
+CREATE TABLE IF NOT EXISTS feeds (
+   podcastid INT PRIMARY KEY,
+   feed_url TEXT NOT NULL,
+   etag TEXT,
+   last_modified TEXT,
+   last_guid TEXT,
+   synced_at TIMESTAMPTZ
+ );
+
 CREATE TABLE IF NOT EXISTS simple_embeddings (
    id SERIAL PRIMARY KEY,
    podcastid INT,
    episodeid INT,
    timecode INTERVAL,
    chunk TEXT,
-   embedding VECTOR(1536)
+   embedding VECTOR(1536),
+   chunk_tsv TSVECTOR GENERATED ALWAYS AS (to_tsvector('english', coalesce(chunk, ''))) STORED
+ );
+
+-- Lexical half of hybrid RAG, see retrieval.py (tables created before it get the column here)
+ALTER TABLE simple_embeddings ADD COLUMN IF NOT EXISTS chunk_tsv TSVECTOR
+    GENERATED ALWAYS AS (to_tsvector('english', coalesce(chunk, ''))) STORED;
+-- podcastid is in the GIN index (btree_gin) so per-podcast searches do not
+-- read the matches of every other show
+CREATE EXTENSION IF NOT EXISTS btree_gin;
+CREATE INDEX IF NOT EXISTS simple_embeddings_podcast_chunk_tsv
+    ON simple_embeddings USING gin (podcastid, chunk_tsv);
+DROP INDEX IF EXISTS simple_embeddings_chunk_tsv;
+
+-- Per-podcast and per-episode filters (episode-scoped RAG is an exact scan of these rows)
+CREATE INDEX IF NOT EXISTS simple_embeddings_podcast_episode
+    ON simple_embeddings (podcastid, episodeid);
+
+-- ANN index for RAG; cosine matches text-embedding-ada-002, see retrieval.py.
+-- Switch to IVFFlat or rebuild with: python ./retrieval.py index hnsw|ivfflat
+-- Per-podcast partial indexes: python ./retrieval.py index hnsw <podcastid> ...
+CREATE INDEX IF NOT EXISTS simple_embeddings_embedding_hnsw
+    ON simple_embeddings USING hnsw (embedding vector_cosine_ops)
+    WITH (m = 16, ef_construction = 64);
+
+-- Map-reduce summaries for the summary mode of /ask, see summarize_episodes.py.
+-- Chunk summaries are keyed on md5(chunk), so re-embedding keeps unchanged ones
+CREATE TABLE IF NOT EXISTS chunk_summaries (
+   podcastid INT NOT NULL,
+   episodeid INT NOT NULL,
+   chunk_hash CHAR(32) NOT NULL,
+   summary TEXT NOT NULL,
+   created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+   PRIMARY KEY (podcastid, episodeid, chunk_hash)
+ );
+
+-- source_hash identifies the chunks the summary was built from
+CREATE TABLE IF NOT EXISTS episode_summaries (
+   podcastid INT NOT NULL,
+   episodeid INT NOT NULL,
+   summary TEXT NOT NULL,
+   source_hash CHAR(32) NOT NULL,
+   created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+   PRIMARY KEY (podcastid, episodeid)
+ );
+
+-- Query embeddings keyed on sha256(model + normalized text), see embedding_cache.py
+CREATE TABLE IF NOT EXISTS embedding_cache (
+   key CHAR(64) PRIMARY KEY,
+   model VARCHAR(100) NOT NULL,
+   text TEXT NOT NULL,
+   embedding VECTOR(1536) NOT NULL,
+   created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+ );
+
+-- One row per episode submitted for batch transcription, see transcription_orchestrator.py.
+-- status is Submitted, Stored or Failed; Submitted rows are resumed after a restart
+CREATE TABLE IF NOT EXISTS transcription_jobs (
+   podcastid INT NOT NULL,
+   episodeid INT NOT NULL,
+   transcription_id VARCHAR(64) NOT NULL,
+   content_url TEXT NOT NULL,
+   status VARCHAR(16) NOT NULL,
+   error TEXT,
+   submitted_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+   completed_at TIMESTAMPTZ,
+   PRIMARY KEY (podcastid, episodeid)
+ );
+
+CREATE INDEX IF NOT EXISTS transcription_jobs_status
+    ON transcription_jobs (status);
+
+-- Ingest pipeline jobs, see ingest_queue.py. stage is feed, transcribe,
+-- questions or embed (episodeid 0 for feeds); status is Queued, Running, Done
+-- or Failed. A Running job belongs to the worker that claimed it at claimed_at
+-- for as long as it keeps renewing locked_until
+CREATE TABLE IF NOT EXISTS ingest_jobs (
+   id BIGSERIAL PRIMARY KEY,
+   stage VARCHAR(16) NOT NULL,
+   podcastid INT NOT NULL,
+   episodeid INT NOT NULL,
+   status VARCHAR(16) NOT NULL DEFAULT 'Queued',
+   attempts INT NOT NULL DEFAULT 0,
+   run_after TIMESTAMPTZ NOT NULL DEFAULT now(),
+   locked_until TIMESTAMPTZ,
+   claimed_at TIMESTAMPTZ,
+   error TEXT,
+   created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+   updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+   UNIQUE (stage, podcastid, episodeid)
  );
 
+ALTER TABLE ingest_jobs ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMPTZ;
 
+-- Workers claim the due jobs of a stage from this index
+CREATE INDEX IF NOT EXISTS ingest_jobs_due
+    ON ingest_jobs (stage, run_after) WHERE status IN ('Queued', 'Running');
@@ -1,61 +1,223 @@
-import psycopg2
+from datetime import date
+from typing import NamedTuple, Optional
 
+from metrics import traced
 from models import Episode
 
+# title and transcript text, only read to build fulltext prompts
+FULLTEXT_QUERY = """
+    SELECT episodes.title, transcripts.text
+    FROM episodes
+    JOIN transcripts
+    ON transcripts.podcastid = episodes.podcastid
+    AND transcripts.episodeid = episodes.episodeid
+    WHERE episodes.podcastid = %s AND episodes.episodeid = %s;
+    """
+
+# precomputed summaries of the given (podcastid, episodeid) pairs, for the
+# summary mode of /ask
+SUMMARIES_QUERY = """
+    SELECT episodes.episodeid, episodes.title, episode_summaries.summary,
+           episodes.podcastid
+    FROM episodes
+    JOIN episode_summaries
+    ON episode_summaries.podcastid = episodes.podcastid
+    AND episode_summaries.episodeid = episodes.episodeid
+    WHERE (episodes.podcastid, episodes.episodeid) IN (
+        SELECT * FROM unnest(%s::int[], %s::int[])
+    )
+    ORDER BY episodes.podcastid, episodes.episodeid;
+    """
+
+
+def summaries_params(episodes):
+    """Query parameters for (podcastid, episodeid) pairs."""
+    episodes = sorted(episodes)
+    return [pid for pid, _ in episodes], [eid for _, eid in episodes]
+
+
+# embeddings of reranking candidates, as pgvector text
+CHUNK_EMBEDDINGS_QUERY = """
+    SELECT id, embedding::text FROM simple_embeddings WHERE id = ANY(%s);
+    """
+
+DEFAULT_PAGE_SIZE = 5
+MAX_PAGE_SIZE = 100
+
+HAS_EMBEDDINGS = """EXISTS (
+        SELECT 1 FROM simple_embeddings
+        WHERE simple_embeddings.podcastid = episodes.podcastid
+        AND simple_embeddings.episodeid = episodes.episodeid
+    )"""
+
+EPISODE_QUERY = "SELECT id, episodeid, title, summary,  questions FROM episodes WHERE podcastid = %s and episodeid = %s and transcribed=true ORDER BY episodeid DESC;"
+
+
+class EpisodeFilters(NamedTuple):
+    """One page of the episode listing, newest episode first."""
+
+    after: Optional[int] = None  # last episodeid of the previous page
+    limit: int = DEFAULT_PAGE_SIZE
+    transcribed: Optional[bool] = True  # None lists both
+    embedded: Optional[bool] = None
+    published_from: Optional[date] = None
+    published_to: Optional[date] = None
+
+
+def _flag(value):
+    if value in ("true", "1"):
+        return True
+    if value in ("false", "0"):
+        return False
+    if value in ("any", "all"):
+        return None
+    raise ValueError(f"expected true, false or any, got {value!r}")
+
+
+def episode_filters(args):
+    """
+    Parse the query string of /podcasts/<pid>/episodes: `after`, `limit`,
+    `transcribed`, `embedded`, `published_from` and `published_to`. Raises
+    ValueError on invalid values.
+    """
+    filters = EpisodeFilters()
+    if "after" in args:
+        filters = filters._replace(after=int(args["after"]))
+    if "limit" in args:
+        limit = int(args["limit"])
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+        filters = filters._replace(limit=limit)
+    if "transcribed" in args:
+        filters = filters._replace(transcribed=_flag(args["transcribed"]))
+    if "embedded" in args:
+        filters = filters._replace(embedded=_flag(args["embedded"]))
+    if "published_from" in args:
+        filters = filters._replace(
+            published_from=date.fromisoformat(args["published_from"])
+        )
+    if "published_to" in args:
+        filters = filters._replace(
+            published_to=date.fromisoformat(args["published_to"])
+        )
+    return filters
+
+
+def episodes_query(pid, filters):
+    """
+    Return (query, params) for one page of episodes. Paging is keyset on
+    episodeid, so a deep page costs the same as the first one; one extra row
+    is fetched to tell whether there is a next page.
+    """
+    conditions = ["podcastid = %s"]
+    params = [pid]
+    if filters.after is not None:
+        conditions.append("episodeid < %s")
+        params.append(filters.after)
+    if filters.transcribed is not None:
+        conditions.append("transcribed = %s")
+        params.append(filters.transcribed)
+    if filters.embedded is not None:
+        conditions.append(
+            HAS_EMBEDDINGS if filters.embedded else "NOT " + HAS_EMBEDDINGS
+        )
+    if filters.published_from is not None:
+        conditions.append("published >= %s")
+        params.append(filters.published_from)
+    if filters.published_to is not None:
+        conditions.append("published <= %s")
+        params.append(filters.published_to)
+
+    query = f"""
+        SELECT id, episodeid, title, summary, questions FROM episodes
+        WHERE {" AND ".join(conditions)}
+        ORDER BY episodeid DESC
+        LIMIT %s;
+        """
+    params.append(filters.limit + 1)
+    return query, params
+
+
+def episodes_page(rows, filters):
+    """The page's episodes and the `after` cursor of the next page (or None)."""
+    episodes = [Episode(row[1], row[2], row[3], "", row[4]) for row in rows]
+    if len(episodes) > filters.limit:
+        episodes = episodes[: filters.limit]
+        return episodes, episodes[-1].id
+    return episodes, None
+
 
 class DataRepository:
-    def __init__(self, config):
-        self.config = config
+    def __init__(self, pool):
+        self.pool = pool
 
-    def get_episodes(self, pid):
-        conn = self._get_conn()
+    @traced("db.get_episodes")
+    def get_episodes(self, pid, filters=EpisodeFilters()):
+        """One page of episodes and the cursor of the next page (or None)."""
+        query, params = episodes_query(pid, filters)
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
 
-        cur = conn.cursor()
+            cur.execute(query, params)
+            rows = cur.fetchall()
 
-        pid = 1
-        print("going to fetch episodes")
-        cur.execute(
-            f"SELECT id, episodeid, title, summary, questions FROM episodes WHERE podcastid = {pid} and transcribed=true ORDER BY episodeid DESC LIMIT 5;"
-        )
-        print("fetched episodes")
-        rows = cur.fetchall()
-        print("rows fetched")
+            cur.close()
 
-        episodes = []
-        for row in rows:
-            episode = Episode(row[1], row[2], row[3], "", row[4])
-            # print(episode)
-            episodes.append(episode)
+        return episodes_page(rows, filters)
 
-        cur.close()
-        conn.close()
+    @traced("db.get_episode")
+    def get_episode(self, pid, eid):
+        """The episode, or None if the podcast has no such episode."""
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
 
-        return episodes
+            cur.execute(EPISODE_QUERY, (pid, eid))
+            row = cur.fetchone()
 
-    def get_episode(self, pid, eid):
-        conn = self._get_conn()
+            cur.close()
 
-        cur = conn.cursor()
+        if row is None:
+            return None
+        return Episode(row[1], row[2], row[3], "", row[4])
 
-        pid = 1
-        cur.execute(
-            f"SELECT id, episodeid, title, summary,  questions FROM episodes WHERE podcastid = {pid} and episodeid = {eid} and transcribed=true ORDER BY episodeid DESC;"
-        )
-        row = cur.fetchone()
+    @traced("db.get_fulltext")
+    def get_fulltext(self, pid, eid):
+        """(title, transcript text) of an episode, or None if not transcribed."""
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
 
-        episode = Episode(row[1], row[2], row[3], "", row[4])
-        # print(episode)
+            cur.execute(FULLTEXT_QUERY, (pid, eid))
+            row = cur.fetchone()
 
-        cur.close()
-        conn.close()
+            cur.close()
 
-        return episode
+        return row
 
-    def _get_conn(self):
-        return psycopg2.connect(
-            database=self.config["DB_NAME"],
-            host=self.config["DB_HOST"],
-            user=self.config["DB_USER"],
-            password=self.config["DB_PASSWORD"],
-            port=self.config["DB_PORT"],
-        )
+    @traced("db.get_chunk_embeddings")
+    def get_chunk_embeddings(self, ids):
+        """{chunk id: pgvector text} for the reranker."""
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
+
+            cur.execute(CHUNK_EMBEDDINGS_QUERY, (list(ids),))
+            rows = cur.fetchall()
+
+            cur.close()
+
+        return dict(rows)
+
+    @traced("db.get_summaries")
+    def get_summaries(self, episodes):
+        """
+        (episodeid, title, summary, podcastid) of the given (podcastid, episodeid)
+        pairs that are summarized.
+        """
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
+
+            cur.execute(SUMMARIES_QUERY, summaries_params(episodes))
+            rows = cur.fetchall()
+
+            cur.close()
+
+        return rows
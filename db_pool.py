@@ -0,0 +1,296 @@
+"""
+A process-wide, bounded, thread-safe PostgreSQL connection pool.
+
+Every query path in the server used to open a brand new psycopg2 connection,
+paying TCP and authentication setup on each request. The pool keeps between
+`POOL_MIN_SIZE` and `POOL_MAX_SIZE` connections open, hands them out to
+threads, health checks them before reuse and makes callers wait at most
+`POOL_ACQUIRE_TIMEOUT` seconds for a free connection.
+
+Usage:
+------
+    with get_pool(config).connection() as conn:
+        cursor = conn.cursor()
+        ...
+
+The connection is committed when the block exits normally and rolled back when
+it raises, then returned to the pool. A process forked from one that has a pool
+(e.g. a server worker) gets an empty pool and opens its own connections.
+"""
+
+import os
+import threading
+import time
+import weakref
+from collections import deque
+from contextlib import contextmanager
+
+import psycopg2
+
+DEFAULT_MIN_SIZE = 1
+DEFAULT_MAX_SIZE = 10
+DEFAULT_ACQUIRE_TIMEOUT = 10.0
+# connections idle for longer than this are pinged before being handed out
+DEFAULT_HEALTH_CHECK_AFTER = 30.0
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available within the acquire timeout."""
+
+
+class ConnectionPool:
+    def __init__(
+        self,
+        connect_kwargs,
+        min_size=DEFAULT_MIN_SIZE,
+        max_size=DEFAULT_MAX_SIZE,
+        acquire_timeout=DEFAULT_ACQUIRE_TIMEOUT,
+        health_check_after=DEFAULT_HEALTH_CHECK_AFTER,
+    ):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f"invalid pool size min={min_size} max={max_size}")
+
+        self.connect_kwargs = connect_kwargs
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.health_check_after = health_check_after
+
+        self._cond = threading.Condition()
+        # idle connections as (connection, time it was returned to the pool)
+        self._idle = deque()
+        self._size = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._closed = False
+
+        self._acquired = 0
+        self._timeouts = 0
+        self._discarded = 0
+        self._acquire_seconds_total = 0.0
+        self._acquire_seconds_max = 0.0
+        # connections of the parent process, see _after_fork
+        self._inherited = []
+        _pools.add(self)
+
+        for _ in range(min_size):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._size += 1
+
+    def _connect(self):
+        return psycopg2.connect(**self.connect_kwargs)
+
+    def _is_healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.health_check_after:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1;")
+            cursor.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _after_fork(self):
+        # The sockets are shared with the parent; closing them here would end
+        # its sessions. Keep them referenced so they are never closed, and
+        # start over with new connections and a lock no other thread holds.
+        self._inherited.extend(conn for conn, _ in self._idle)
+        self._cond = threading.Condition()
+        self._idle = deque()
+        self._size = 0
+        self._in_use = 0
+        self._waiting = 0
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def acquire(self, timeout=None):
+        """
+        Take a connection out of the pool, opening a new one if the pool has not
+        reached `max_size`. Blocks for up to `timeout` seconds (the pool's
+        `acquire_timeout` by default) and raises `PoolTimeout` after that.
+        """
+        timeout = self.acquire_timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+
+        with self._cond:
+            self._waiting += 1
+            try:
+                while True:
+                    if self._closed:
+                        raise PoolTimeout("connection pool is closed")
+                    if self._idle or self._size < self.max_size:
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeout(
+                            f"no database connection available after {timeout}s"
+                        )
+                    self._cond.wait(remaining)
+
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                else:
+                    conn, idle_since = None, None
+                    # reserve the slot before connecting outside the lock
+                    self._size += 1
+                self._in_use += 1
+            finally:
+                self._waiting -= 1
+
+        # connect and health check outside the lock so a slow server does not
+        # stall every other thread
+        try:
+            if conn is not None and not self._is_healthy(conn, idle_since):
+                self._discard(conn)
+                with self._cond:
+                    self._discarded += 1
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        elapsed = time.monotonic() - started
+        with self._cond:
+            self._acquired += 1
+            self._acquire_seconds_total += elapsed
+            self._acquire_seconds_max = max(self._acquire_seconds_max, elapsed)
+
+        return conn
+
+    def release(self, conn, discard=False):
+        """Return a connection to the pool, closing it if it is broken or unwanted."""
+        if not discard and not conn.closed:
+            try:
+                # never hand out a connection in the middle of a transaction
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+
+        with self._cond:
+            self._in_use -= 1
+            if discard or conn.closed or self._closed:
+                self._size -= 1
+                self._discarded += 1
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """Context manager that commits on success, rolls back on error and releases."""
+        conn = self.acquire(timeout)
+        discard = False
+        try:
+            yield conn
+            conn.commit()
+        except (psycopg2.InterfaceError, psycopg2.OperationalError):
+            # the connection itself is likely broken, do not reuse it
+            discard = True
+            raise
+        except BaseException:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+            raise
+        finally:
+            self.release(conn, discard=discard)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "waiting": self._waiting,
+                "acquired_total": self._acquired,
+                "timeouts_total": self._timeouts,
+                "discarded_total": self._discarded,
+                "acquire_seconds_avg": (
+                    self._acquire_seconds_total / self._acquired
+                    if self._acquired
+                    else 0.0
+                ),
+                "acquire_seconds_max": self._acquire_seconds_max,
+            }
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._size -= 1
+                self._discard(conn)
+            self._cond.notify_all()
+
+
+def connect_kwargs(config):
+    """Map the database keys of config.json onto psycopg2.connect() arguments."""
+    return {
+        "database": config["DBNAME"],
+        "host": config["HOST"],
+        "user": config["USER"],
+        "password": config["PASS"],
+        "port": config["PORT"],
+    }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+# every pool of the process, reset in a forked child
+_pools = weakref.WeakSet()
+
+
+def _reset_after_fork():
+    global _pool_lock
+    _pool_lock = threading.Lock()
+    for pool in list(_pools):
+        pool._after_fork()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_pool(config):
+    """
+    Return the process-wide pool, creating it from `config` on first use.
+
+    Pool sizing is read from the optional `POOL_MIN_SIZE`, `POOL_MAX_SIZE`,
+    `POOL_ACQUIRE_TIMEOUT` and `POOL_HEALTH_CHECK_AFTER` config keys.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    connect_kwargs(config),
+                    min_size=int(config.get("POOL_MIN_SIZE", DEFAULT_MIN_SIZE)),
+                    max_size=int(config.get("POOL_MAX_SIZE", DEFAULT_MAX_SIZE)),
+                    acquire_timeout=float(
+                        config.get("POOL_ACQUIRE_TIMEOUT", DEFAULT_ACQUIRE_TIMEOUT)
+                    ),
+                    health_check_after=float(
+                        config.get(
+                            "POOL_HEALTH_CHECK_AFTER", DEFAULT_HEALTH_CHECK_AFTER
+                        )
+                    ),
+                )
+    return _pool
@@ -0,0 +1,278 @@
+"""
+Content-addressed cache for query embeddings.
+
+Every `/ask?type=rag` request embeds the question before searching
+`simple_embeddings`, and the suggested questions shown in the UI are clicked
+over and over. The cache keys an embedding on the model name plus the
+normalized question text and keeps it in two tiers:
+
+1. an in-process LRU with a maximum number of entries and a TTL, and
+2. an optional persistent tier in the `embedding_cache` table, shared by all
+   server processes and surviving restarts.
+
+The suggested questions of every episode can be embedded ahead of time with:
+```sh
+python ./embedding_cache.py [podcastid] [episodeid]
+```
+"""
+
+import hashlib
+import json
+import sys
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+
+DEFAULT_MAX_ENTRIES = 5000
+DEFAULT_TTL = 24 * 60 * 60
+# number of questions sent per embeddings call when precomputing
+PRECOMPUTE_BATCH_SIZE = 256
+
+SELECT_CACHED_EMBEDDING_QUERY = """
+    SELECT embedding FROM embedding_cache WHERE key = %s;
+    """
+
+INSERT_CACHED_EMBEDDING_QUERY = """
+    INSERT INTO embedding_cache (key, model, text, embedding)
+    VALUES (%s, %s, %s, %s::vector)
+    ON CONFLICT (key) DO NOTHING;
+    """
+
+
+def normalize_text(text):
+    """Unicode-normalize, collapse runs of whitespace and trim the text."""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def cache_key(model, text):
+    key = f"{model}\n{normalize_text(text)}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def parse_vector(value):
+    """pgvector returns '[0.1,0.2,...]' without an adapter, which is valid JSON."""
+    return json.loads(value) if isinstance(value, str) else list(value)
+
+
+class EmbeddingCache:
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL, pool=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # persistent tier, disabled when no connection pool is given
+        self.pool = pool
+
+        self._lock = threading.Lock()
+        # key -> (expiry time, float32 embedding); float32 is what pgvector
+        # stores, and takes a quarter of the memory of a list of floats
+        self._entries = OrderedDict()
+
+        self.memory_hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+
+    def get_memory(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, vector = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return vector.tolist()
+
+    def put_memory(self, key, embedding):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, array("f", embedding))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _get_persistent(self, key):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(SELECT_CACHED_EMBEDDING_QUERY, (key,))
+            row = cursor.fetchone()
+            cursor.close()
+
+        return parse_vector(row[0]) if row else None
+
+    def _put_persistent(self, rows):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(INSERT_CACHED_EMBEDDING_QUERY, rows)
+            cursor.close()
+
+    def _persistent_hit(self, key, embedding):
+        if embedding is not None:
+            self.persistent_hits += 1
+            self.put_memory(key, embedding)
+        return embedding
+
+    def _memory_hit(self, key):
+        embedding = self.get_memory(key)
+        if embedding is not None:
+            self.memory_hits += 1
+        return embedding
+
+    def get(self, model, text):
+        key = cache_key(model, text)
+
+        embedding = self._memory_hit(key)
+        if embedding is None and self.pool is not None:
+            embedding = self._persistent_hit(key, self._get_persistent(key))
+        if embedding is None:
+            self.misses += 1
+        return embedding
+
+    def put_many(self, model, texts, embeddings):
+        rows = []
+        for text, embedding in zip(texts, embeddings):
+            key = cache_key(model, text)
+            self.put_memory(key, embedding)
+            rows.append((key, model, normalize_text(text), str(embedding)))
+
+        if self.pool is not None and rows:
+            self._put_persistent(rows)
+
+    def get_or_create(self, client, model, text):
+        """Return the cached embedding of `text`, calling the embeddings API on a miss."""
+        embedding = self.get(model, text)
+        if embedding is None:
+            embedding = (
+                client.embeddings.create(input=[text], model=model).data[0].embedding
+            )
+            self.put_many(model, [text], [embedding])
+
+        return embedding
+
+    async def aget_or_create(self, model, text, embed, load=None, store=None):
+        """
+        `get_or_create` for asyncio callers, whose persistent tier is behind an
+        async pool: `embed(text)` calls the embeddings API, `load(key)` and
+        `store(key, model, text, embedding)` read and write the persistent
+        tier, all three coroutines. Without `load` and `store` only the
+        in-process tier is used.
+        """
+        key = cache_key(model, text)
+
+        embedding = self._memory_hit(key)
+        if embedding is None and load is not None:
+            embedding = self._persistent_hit(key, await load(key))
+        if embedding is not None:
+            return embedding
+
+        self.misses += 1
+        embedding = await embed(text)
+        self.put_memory(key, embedding)
+        if store is not None:
+            await store(key, model, text, embedding)
+
+        return embedding
+
+    def stats(self):
+        lookups = self.memory_hits + self.persistent_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "memory_hits": self.memory_hits,
+            "persistent_hits": self.persistent_hits,
+            "misses": self.misses,
+            "hit_rate": (
+                (self.memory_hits + self.persistent_hits) / lookups if lookups else 0.0
+            ),
+        }
+
+
+def questions_from_column(questions):
+    """
+    `episodes.questions` holds the JSON text returned by the questions prompt,
+    e.g. '{"questions": ["Question1", "Question2"]}'. Return the list of questions.
+    """
+    if questions is None:
+        return []
+    if isinstance(questions, str):
+        try:
+            questions = json.loads(questions)
+        except json.JSONDecodeError:
+            return []
+    if isinstance(questions, dict):
+        questions = questions.get("questions", [])
+    return [q for q in questions if isinstance(q, str)]
+
+
+def precompute_question_embeddings(
+    cache, client, model, podcastid=None, episodeid=None
+):
+    """
+    Embed every stored suggested question that is not cached yet, in batched
+    embeddings calls, so that clicking a suggestion never waits on the API.
+    Returns the number of questions that were embedded.
+    """
+    query = "SELECT questions FROM episodes WHERE questions IS NOT NULL"
+    params = []
+    if podcastid is not None:
+        query += " AND podcastid = %s"
+        params.append(podcastid)
+    if episodeid is not None:
+        query += " AND episodeid = %s"
+        params.append(episodeid)
+
+    with cache.pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(query + ";", params)
+        rows = cursor.fetchall()
+        cursor.close()
+
+    # de-duplicate on the cache key
+    questions = {}
+    for row in rows:
+        for question in questions_from_column(row[0]):
+            questions.setdefault(cache_key(model, question), question)
+
+    # skip what the persistent tier already holds
+    with cache.pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT key FROM embedding_cache WHERE key = ANY(%s);",
+            (list(questions.keys()),),
+        )
+        for row in cursor.fetchall():
+            questions.pop(row[0].strip(), None)
+        cursor.close()
+
+    texts = list(questions.values())
+    for start in range(0, len(texts), PRECOMPUTE_BATCH_SIZE):
+        batch = texts[start : start + PRECOMPUTE_BATCH_SIZE]
+        response = client.embeddings.create(input=batch, model=model)
+        cache.put_many(model, batch, [d.embedding for d in response.data])
+
+    return len(texts)
+
+
+def create_embedding_cache(config, pool):
+    """Build the cache from the optional `EMBEDDING_CACHE_*` config keys."""
+    return EmbeddingCache(
+        max_entries=int(config.get("EMBEDDING_CACHE_SIZE", DEFAULT_MAX_ENTRIES)),
+        ttl=float(config.get("EMBEDDING_CACHE_TTL", DEFAULT_TTL)),
+        pool=pool if config.get("EMBEDDING_CACHE_PERSIST", True) else None,
+    )
+
+
+# precompute the embeddings of the suggested questions already in the DB
+if __name__ == "__main__":
+    from prompts import EMBEDDING_MODEL
+    from providers import get_db_pool, get_openai_client
+
+    podcastid = sys.argv[1] if len(sys.argv) > 1 else None
+    episodeid = sys.argv[2] if len(sys.argv) > 2 else None
+
+    cache = EmbeddingCache(pool=get_db_pool())
+
+    count = precompute_question_embeddings(
+        cache, get_openai_client(), EMBEDDING_MODEL, podcastid, episodeid
+    )
+    print(f"embedded {count} suggested questions")
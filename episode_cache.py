@@ -0,0 +1,165 @@
+"""
+Read-through cache and HTTP validators for the episode endpoints.
+
+`/podcasts/<pid>/episodes` and `/podcasts/<pid>/episodes/<eid>` only change
+when rssconvert.py, transcribe_ep.py or gen-embeddings-simple.py write to the
+database. Their serialized responses are cached per podcast:
+
+- every podcast has a version counter, bumped by the `episode_changed`
+  notifications those scripts send (see cache_events.py); an entry is only
+  served while the version it was loaded at is current,
+- responses carry an ETag (a hash of the body) and a Last-Modified time (the
+  last change notification this process saw for the podcast), and conditional
+  requests that still match are answered with 304 and no body.
+
+The same response bytes are served by the Flask and the asyncio server.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+DEFAULT_MAX_ENTRIES = 2000
+DEFAULT_TTL = 60 * 60
+DEFAULT_MAX_AGE = 0
+
+
+class CachedResponse:
+    def __init__(self, body, headers, last_modified):
+        self.body = body
+        self.headers = headers
+        self.etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        self.last_modified = last_modified
+
+
+def _utcnow():
+    # HTTP dates have a resolution of one second
+    return datetime.now(timezone.utc).replace(microsecond=0)
+
+
+class EpisodeCache:
+    def __init__(
+        self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL, max_age=DEFAULT_MAX_AGE
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_age = max_age
+
+        self._lock = threading.Lock()
+        # key -> (podcastid, version, expiry time, CachedResponse)
+        self._entries = OrderedDict()
+        # podcastid -> (version, last modified)
+        self._versions = {}
+        self._started = _utcnow()
+
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def version(self, podcastid):
+        """Read before loading from the DB, and passed back to `put`."""
+        with self._lock:
+            return self._versions.get(podcastid, (0, self._started))[0]
+
+    def get(self, podcastid, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                pid, version, expires, response = entry
+                current = self._versions.get(pid, (0, self._started))[0]
+                if version == current and expires >= time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return response
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, podcastid, key, version, body, headers=None):
+        """
+        Cache a response loaded at `version`. It is still returned but not
+        cached if the podcast changed while it was being loaded.
+        """
+        with self._lock:
+            current, last_modified = self._versions.get(
+                podcastid, (0, self._started)
+            )
+            response = CachedResponse(body, dict(headers or {}), last_modified)
+            if version == current:
+                self._entries[key] = (
+                    podcastid,
+                    version,
+                    time.monotonic() + self.ttl,
+                    response,
+                )
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            return response
+
+    def invalidate(self, podcastid, episodeid=None):
+        """Callback for EpisodeChangeListener: any change invalidates the podcast."""
+        with self._lock:
+            version, _ = self._versions.get(int(podcastid), (0, self._started))
+            self._versions[int(podcastid)] = (version + 1, _utcnow())
+
+    def is_not_modified(self, response, request_headers):
+        """Evaluate If-None-Match, or else If-Modified-Since, against `response`."""
+        if_none_match = request_headers.get("If-None-Match")
+        if if_none_match is not None:
+            tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+            matched = "*" in tags or response.etag in tags
+        else:
+            if_modified_since = request_headers.get("If-Modified-Since")
+            if not if_modified_since:
+                return False
+            try:
+                since = parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=timezone.utc)
+            matched = response.last_modified <= since
+
+        if matched:
+            with self._lock:
+                self.not_modified += 1
+        return matched
+
+    def respond(self, response_class, response, request_headers):
+        """A 200 with the cached body, or a 304, as a Flask or Quart response."""
+        headers = {
+            "ETag": response.etag,
+            "Last-Modified": format_datetime(response.last_modified, usegmt=True),
+            "Cache-Control": f"public, max-age={self.max_age}, must-revalidate",
+        }
+        if self.is_not_modified(response, request_headers):
+            return response_class(b"", status=304, headers=headers)
+
+        headers.update(response.headers)
+        return response_class(
+            response.body, status=200, headers=headers, mimetype="application/json"
+        )
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified,
+            "hit_rate": self.hits / requests if requests else 0.0,
+        }
+
+
+def create_episode_cache(config):
+    """Build the cache from the optional `EPISODE_CACHE_*` config keys."""
+    return EpisodeCache(
+        max_entries=int(config.get("EPISODE_CACHE_SIZE", DEFAULT_MAX_ENTRIES)),
+        ttl=float(config.get("EPISODE_CACHE_TTL", DEFAULT_TTL)),
+        max_age=int(config.get("EPISODE_CACHE_MAX_AGE", DEFAULT_MAX_AGE)),
+    )
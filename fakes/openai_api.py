@@ -0,0 +1,243 @@
+"""
+Local fake of the Azure OpenAI REST API, for benchmarks and load tests.
+
+Serves the two deployment endpoints the servers and scripts call:
+
+- `/openai/deployments/<name>/embeddings`: deterministic unit vectors of
+  `--dimensions` floats, seeded with the md5 of each input, so the same text
+  always gets the same embedding,
+- `/openai/deployments/<name>/chat/completions`: a canned answer of `--tokens`
+  words, streamed as server-sent events (`stream: true`) or returned whole.
+
+The first token is sent `--first-token-latency` seconds after the request and
+every following one `--token-latency` seconds after the previous, so answers
+take as long to stream as the real model. Embeddings take
+`--embedding-latency` seconds.
+
+```sh
+python -m fakes.openai_api --port 8090 --first-token-latency 0.4 --token-latency 0.02
+```
+and set `"LLM_TARGET_URI": "http://localhost:8090"` in config.json.
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import math
+import random
+import re
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+DIMENSIONS = 1536
+WORDS = "the episode covers cloud tooling and how the guests ship code faster".split()
+
+
+def fake_embedding(text, dimensions=DIMENSIONS):
+    rng = random.Random(hashlib.md5(text.encode("utf-8")).digest())
+    vector = [rng.gauss(0.0, 1.0) for _ in range(dimensions)]
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+def encode_embedding(embedding, encoding_format):
+    # the openai SDK asks for base64 (little-endian float32) unless told otherwise
+    if encoding_format == "base64":
+        packed = struct.pack(f"<{len(embedding)}f", *embedding)
+        return base64.b64encode(packed).decode("ascii")
+    return embedding
+
+
+def fake_answer(tokens):
+    return [WORDS[i % len(WORDS)] + " " for i in range(tokens)]
+
+
+class FakeOpenAIService:
+    def __init__(
+        self,
+        first_token_latency=0.3,
+        token_latency=0.02,
+        tokens=100,
+        embedding_latency=0.05,
+        dimensions=DIMENSIONS,
+    ):
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.tokens = tokens
+        self.embedding_latency = embedding_latency
+        self.dimensions = dimensions
+        self.requests = {"embeddings": 0, "chat": 0}
+        self.lock = threading.Lock()
+
+    def count(self, kind):
+        with self.lock:
+            self.requests[kind] += 1
+
+
+class Handler(BaseHTTPRequestHandler):
+    # server-sent events are written as they are produced
+    protocol_version = "HTTP/1.1"
+    service = None
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if not self.headers.get("api-key") and not self.headers.get("Authorization"):
+            return self._send(401, {"error": {"code": "401", "message": "no key"}})
+
+        match = re.fullmatch(
+            r"/openai/deployments/([^/]+)/(embeddings|chat/completions)",
+            urlparse(self.path).path,
+        )
+        if not match:
+            return self._send(404, {"error": {"code": "404", "message": "not found"}})
+        if match.group(2) == "embeddings":
+            return self._embeddings(match.group(1), body)
+        if body.get("stream"):
+            return self._stream(match.group(1))
+        return self._completion(match.group(1))
+
+    def _embeddings(self, model, body):
+        self.service.count("embeddings")
+        inputs = body.get("input", [])
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        encoding_format = body.get("encoding_format", "float")
+        time.sleep(self.service.embedding_latency)
+        self._send(
+            200,
+            {
+                "object": "list",
+                "model": model,
+                "data": [
+                    {
+                        "object": "embedding",
+                        "index": i,
+                        "embedding": encode_embedding(
+                            fake_embedding(text, self.service.dimensions),
+                            encoding_format,
+                        ),
+                    }
+                    for i, text in enumerate(inputs)
+                ],
+                "usage": {
+                    "prompt_tokens": sum(len(text.split()) for text in inputs),
+                    "total_tokens": sum(len(text.split()) for text in inputs),
+                },
+            },
+        )
+
+    def _completion(self, model):
+        self.service.count("chat")
+        words = fake_answer(self.service.tokens)
+        time.sleep(
+            self.service.first_token_latency
+            + self.service.token_latency * (len(words) - 1)
+        )
+        self._send(
+            200,
+            {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": "".join(words)},
+                        "finish_reason": "stop",
+                    }
+                ],
+            },
+        )
+
+    def _event(self, model, delta, finish_reason=None):
+        chunk = {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        self._write_chunk(f"data: {json.dumps(chunk)}\n\n")
+
+    def _write_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _stream(self, model):
+        self.service.count("chat")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        time.sleep(self.service.first_token_latency)
+        self._event(model, {"role": "assistant", "content": ""})
+        for i, word in enumerate(fake_answer(self.service.tokens)):
+            if i:
+                time.sleep(self.service.token_latency)
+            self._event(model, {"content": word})
+        self._event(model, {}, "stop")
+        self._write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(
+    port=8090,
+    first_token_latency=0.3,
+    token_latency=0.02,
+    tokens=100,
+    embedding_latency=0.05,
+    dimensions=DIMENSIONS,
+):
+    """Start the fake in a daemon thread and return the server."""
+    handler = type("FakeOpenAIHandler", (Handler,), {})
+    handler.service = FakeOpenAIService(
+        first_token_latency, token_latency, tokens, embedding_latency, dimensions
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Azure OpenAI API.")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--first-token-latency", type=float, default=0.3)
+    parser.add_argument("--token-latency", type=float, default=0.02)
+    parser.add_argument("--tokens", type=int, default=100)
+    parser.add_argument("--embedding-latency", type=float, default=0.05)
+    parser.add_argument("--dimensions", type=int, default=DIMENSIONS)
+    args = parser.parse_args()
+
+    server = serve(
+        args.port,
+        args.first_token_latency,
+        args.token_latency,
+        args.tokens,
+        args.embedding_latency,
+        args.dimensions,
+    )
+    print(f"Fake OpenAI API on http://127.0.0.1:{args.port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,219 @@
+"""
+Local fake of the Azure batch transcription REST API (v3.2).
+
+Serves the endpoints transcription_orchestrator.py uses: creating a
+transcription, polling its status, listing its result files (two per page, to
+exercise `@nextLink`) and downloading synthetic results in the service's JSON
+format, with `source` set to the submitted content URL. A job is NotStarted for
+`--start-delay` seconds, Running for `--run-time` seconds and then Succeeded.
+Content URLs containing "fail" produce no result file, like audio the service
+could not decode.
+
+```sh
+python -m fakes.speech_api --port 8089 --run-time 5
+```
+and set `"SPEECH_ENDPOINT": "http://localhost:8089"` in config.json.
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+PAGE_SIZE = 2
+WORDS = "so today we talk about the cloud and how developers ship code faster".split()
+
+
+def synthetic_result(source, phrases=50, seed=0):
+    rng = random.Random(seed)
+    recognized = []
+    texts = []
+    for i in range(phrases):
+        text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 20)))
+        text = text.capitalize() + "."
+        texts.append(text)
+        recognized.append(
+            {
+                "recognitionStatus": "Success",
+                "channel": 0,
+                "speaker": 1 + (i // 5) % 2,
+                "offset": f"PT{i * 4.5:.2f}S",
+                "duration": "PT4.2S",
+                "offsetInTicks": int(i * 4.5 * 10_000_000),
+                "durationInTicks": 42_000_000,
+                "nBest": [
+                    {
+                        "confidence": 0.9,
+                        "lexical": text.lower().rstrip("."),
+                        "display": text,
+                    }
+                ],
+            }
+        )
+    combined = " ".join(texts)
+    return {
+        "source": source,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "durationInTicks": int(phrases * 4.5 * 10_000_000),
+        "duration": f"PT{phrases * 4.5:.2f}S",
+        "combinedRecognizedPhrases": [
+            {"channel": 0, "lexical": combined.lower(), "display": combined}
+        ],
+        "recognizedPhrases": recognized,
+    }
+
+
+class FakeSpeechService:
+    def __init__(self, start_delay=1.0, run_time=3.0, phrases=50):
+        self.start_delay = start_delay
+        self.run_time = run_time
+        self.phrases = phrases
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def create(self, content_urls):
+        transcription_id = str(uuid.uuid4())
+        with self.lock:
+            self.jobs[transcription_id] = (time.monotonic(), list(content_urls))
+        return transcription_id
+
+    def status(self, transcription_id):
+        created, _ = self.jobs[transcription_id]
+        elapsed = time.monotonic() - created
+        if elapsed < self.start_delay:
+            return "NotStarted"
+        if elapsed < self.start_delay + self.run_time:
+            return "Running"
+        return "Succeeded"
+
+
+class Handler(BaseHTTPRequestHandler):
+    service = None
+
+    def _send(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _base(self):
+        return f"http://{self.headers['Host']}"
+
+    def _authorized(self):
+        if self.headers.get("Ocp-Apim-Subscription-Key"):
+            return True
+        self._send(401, {"code": "Unauthorized"})
+        return False
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        if urlparse(self.path).path.rstrip("/") != "/transcriptions":
+            return self._send(404, {"code": "NotFound"})
+
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        transcription_id = self.service.create(body.get("contentUrls", []))
+        location = f"{self._base()}/transcriptions/{transcription_id}"
+        self._send(
+            201,
+            {"self": location, "status": "NotStarted"},
+            {"Location": location},
+        )
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        result = re.fullmatch(r"/results/([^/]+)/(\d+)", url.path)
+        if result:
+            # result files are fetched from "blob storage" without the API key
+            return self._result(result.group(1), int(result.group(2)))
+
+        if not self._authorized():
+            return
+        match = re.fullmatch(r"/transcriptions/([^/]+)(/files)?/?", url.path)
+        if not match or match.group(1) not in self.service.jobs:
+            return self._send(404, {"code": "NotFound"})
+
+        transcription_id = match.group(1)
+        status = self.service.status(transcription_id)
+        if not match.group(2):
+            return self._send(
+                200,
+                {
+                    "self": f"{self._base()}/transcriptions/{transcription_id}",
+                    "status": status,
+                },
+            )
+        skip = int(parse_qs(url.query).get("skip", ["0"])[0])
+        self._files(transcription_id, status, skip)
+
+    def _files(self, transcription_id, status, skip):
+        _, urls = self.service.jobs[transcription_id]
+        files = []
+        if status == "Succeeded":
+            files = [
+                {
+                    "kind": "Transcription",
+                    "name": f"contenturl_{i}.json",
+                    "links": {
+                        "contentUrl": f"{self._base()}/results/{transcription_id}/{i}"
+                    },
+                }
+                for i, source in enumerate(urls)
+                if "fail" not in source
+            ]
+            files.append(
+                {"kind": "TranscriptionReport", "name": "report.json", "links": {}}
+            )
+
+        page = {"values": files[skip : skip + PAGE_SIZE]}
+        if skip + PAGE_SIZE < len(files):
+            page["@nextLink"] = (
+                f"{self._base()}/transcriptions/{transcription_id}/files"
+                f"?skip={skip + PAGE_SIZE}"
+            )
+        self._send(200, page)
+
+    def _result(self, transcription_id, index):
+        job = self.service.jobs.get(transcription_id)
+        if job is None or index >= len(job[1]):
+            return self._send(404, {"code": "NotFound"})
+        source = job[1][index]
+        self._send(200, synthetic_result(source, self.service.phrases, seed=index))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=8089, start_delay=1.0, run_time=3.0, phrases=50):
+    """Start the fake in a daemon thread and return the server."""
+    handler = type("FakeSpeechHandler", (Handler,), {})
+    handler.service = FakeSpeechService(start_delay, run_time, phrases)
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Azure batch transcription API.")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--start-delay", type=float, default=1.0)
+    parser.add_argument("--run-time", type=float, default=3.0)
+    parser.add_argument("--phrases", type=int, default=50)
+    args = parser.parse_args()
+
+    server = serve(args.port, args.start_delay, args.run_time, args.phrases)
+    print(f"Fake speech API on http://127.0.0.1:{args.port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,106 @@
+"""
+Streaming reader for podcast RSS feeds.
+
+feedparser builds the whole feed in memory before returning the first item,
+which for feeds with hundreds of episodes means a large memory spike and a long
+wait before anything can be written. `iter_items` walks the XML with
+ElementTree.iterparse and yields one item at a time, dropping each `<item>`
+element once it has been read, so memory stays flat whatever the feed size.
+
+Only RSS 2.0 with the iTunes extensions is understood, and only the fields
+rssconvert.py uses. Items are dicts with the same keys feedparser produces for
+them (`id`, `title`, `summary`, `links`, `author`, `published`,
+`itunes_duration`), so they can be passed to the same writer. Other formats,
+e.g. Atom, raise `UnsupportedFeed` before the first item.
+"""
+
+import re
+import xml.etree.ElementTree as ET
+
+ITUNES = "{http://www.itunes.com/dtds/podcast-1.0.dtd}"
+DC = "{http://purl.org/dc/elements/1.1/}"
+
+# "scott@hanselman.com (Scott Hanselman)"
+EMAIL_NAME = re.compile(r"^\S+@\S+\s+\((.+)\)$")
+
+
+class UnsupportedFeed(ValueError):
+    pass
+
+
+def _text(elem, tag):
+    child = elem.find(tag)
+    if child is None or child.text is None:
+        return None
+    return child.text.strip()
+
+
+def _author(elem):
+    author = _text(elem, "author")
+    if author:
+        match = EMAIL_NAME.match(author)
+        return match.group(1) if match else author
+    return _text(elem, ITUNES + "author") or _text(elem, DC + "creator")
+
+
+def parse_item(elem):
+    """The feedparser-compatible dict for one `<item>` element."""
+    item = {
+        "title": _text(elem, "title") or "",
+        "summary": (
+            _text(elem, ITUNES + "summary") or _text(elem, "description") or ""
+        ),
+        "links": [],
+    }
+
+    link = _text(elem, "link")
+    if link:
+        item["links"].append({"rel": "alternate", "type": "text/html", "href": link})
+    enclosure = elem.find("enclosure")
+    if enclosure is not None and enclosure.get("url"):
+        item["links"].append(
+            {
+                "rel": "enclosure",
+                "type": enclosure.get("type", ""),
+                "length": enclosure.get("length", ""),
+                "href": enclosure.get("url"),
+            }
+        )
+    if link:
+        item["link"] = link
+
+    for key, value in (
+        ("id", _text(elem, "guid")),
+        ("author", _author(elem)),
+        ("published", _text(elem, "pubDate")),
+        ("itunes_duration", _text(elem, ITUNES + "duration")),
+    ):
+        if value:
+            item[key] = value
+
+    return item
+
+
+def iter_items(source):
+    """
+    Yield the items of an RSS feed in document order (newest first for
+    podcast feeds). `source` is a file name or a binary file-like object, such
+    as the raw stream of an HTTP response.
+    """
+    channel = None
+    depth = 0
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            if depth == 0 and elem.tag != "rss":
+                raise UnsupportedFeed(f"not an RSS feed: <{elem.tag}>")
+            if elem.tag == "channel":
+                channel = elem
+            depth += 1
+            continue
+
+        depth -= 1
+        if elem.tag == "item":
+            yield parse_item(elem)
+            # free the item once it has been consumed
+            if channel is not None:
+                channel.remove(elem)
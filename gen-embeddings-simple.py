@@ -1,199 +1,302 @@
 """
 This module will generate embeddings using the default document chunking.
 
-Methods:
----------
-- **GET /podcasts**: Retrieves a list of all podcasts available on the server.
-
-Returns:
---------
-A JSON response containing details of each podcast, including title, host, and 
-release date.
+Many episodes can be embedded in one run. The chunks of every episode are
+packed into token-bounded batches that are sent to the embeddings API by a
+bounded pool of threads, backing off together when the API rate limits. The
+rows of each episode are then replaced in a single transaction with a
+multi-row insert, and throughput is reported in chunks/sec and tokens/sec.
+
+Usage:
+------
+```sh
+python ./gen-embeddings-simple.py <episodeid> [<episodeid> ...]
+python ./gen-embeddings-simple.py --all
+```
+`--all` embeds every transcribed episode that has no embeddings yet.
 """
 
-import json
+import argparse
 import logging
+import random
 import sys
+import threading
 import time
-from enum import Enum
-from io import StringIO
-
-import psycopg2
-import requests
-import swagger_client
-import tiktoken
-from azure.cognitiveservices.speech import AudioConfig, SpeechConfig, SpeechRecognizer
-from flask import Flask, Response, jsonify, render_template, request
-from openai import AzureOpenAI
-from psycopg2 import sql
-
-
-class EpisodeAttributes(Enum):
-    ID = 0
-    PODCASTID = 1
-    EPISODEID = 2
-    TITLE = 3
-    SUMMARY = 4
-    URL = 5
-    AUTHORS = 6
-    PUBLISHED = 7
-    DURATION = 8
-    QUESTIONS = 9
-    TRANSCRIBED = 10
-    TRANSCRIPT = 11
-    TRANSCRIPTTEXT = 12
-
-
-logging.basicConfig(
-    stream=sys.stdout,
-    level=logging.DEBUG,
-    format="%(asctime)s %(message)s",
-    datefmt="%m/%d/%Y %I:%M:%S %p %Z",
-)
-
-# Read configuration from JSON file
-with open("config.json") as config_file:
-    config = json.load(config_file)
-
-
-def select_from_episodes_with_episodeid(episodeid):
-
-    connection_string = f"dbname='{config["DBNAME"]}' user='{config["USER"]}' password='{config["PASS"]}' host='{config["HOST"]}' port='{config["PORT"]}'"
-
-    # Connect to the PostgreSQL database
-    conn = psycopg2.connect(connection_string)
-    cursor = conn.cursor()
-
-    # Prepare and execute an SQL SELECT statement
-    select_query = sql.SQL("SELECT * FROM episodes WHERE episodeid = %s;").format(
-        sql.Identifier("episodes")
-    )
+from concurrent.futures import ThreadPoolExecutor
 
-    cursor.execute(select_query, (episodeid,))
+from psycopg2.extras import execute_values
 
-    # Fetch and print the result of the SELECT statement
-    result = cursor.fetchall()
+from cache_events import notify_episode_changed
+from chunker import DEFAULT_MAX_TOKENS, chunk_phrases
+from providers import get_db_pool, get_openai_client
 
-    # Close the cursor and the connection
-    cursor.close()
-    conn.close()
 
-    return result[0]
+def select_transcript(podcastid, episodeid):
+    """The [offset, speaker, text] phrases of an episode's transcript."""
+    with get_db_pool().connection() as conn:
+        cursor = conn.cursor()
 
+        cursor.execute(
+            "SELECT phrases FROM transcripts WHERE podcastid = %s AND episodeid = %s;",
+            (podcastid, episodeid),
+        )
+        result = cursor.fetchone()
 
-def insert_embedding(podcastid, episodeid, timecode, chunk, embedding):
+        cursor.close()
 
-    connection_string = f"dbname='{config["DBNAME"]}' user='{config["USER"]}' password='{config["PASS"]}' host='{config["HOST"]}' port='{config["PORT"]}'"
+    return result[0] if result else None
 
-    # Connect to the PostgreSQL database
-    conn = psycopg2.connect(connection_string)
-    cursor = conn.cursor()
 
-    # Prepare and execute an SQL SELECT statement
-    insert_query = sql.SQL(
-        """
-        INSERT INTO simple_embeddings(podcastid, episodeid, timecode, chunk, embedding)
-        VALUES (%s, %s, %s, %s, %s);
-        """
-    ).format(sql.Identifier("simple_embeddings"))
+def select_episodes_to_embed(podcastid):
+    """Episode IDs that are transcribed but have no embeddings yet."""
+    with get_db_pool().connection() as conn:
+        cursor = conn.cursor()
 
-    cursor.execute(
-        insert_query,
-        (
-            podcastid,
-            episodeid,
-            timecode,
-            chunk,
-            embedding,
-        ),
-    )
-    conn.commit()
-
-    # Close the cursor and the connection
-    cursor.close()
-    conn.close()
-
-
-client = AzureOpenAI(
-    api_key=config["LLM_API_KEY"],
-    api_version=config["LLM_API_VERSION"],
-    azure_endpoint=config["LLM_TARGET_URI"],
-)
-
-TIKTOKEN_MODEL_NAME = "cl100k_base"
-TIKTOKEN_MAX_TOKENS = 8192
-# Characters that are considered sentence terminators
-TERMINATING_CHARS = [".", "?"]
-
-tokenizer = tiktoken.get_encoding(TIKTOKEN_MODEL_NAME)
-
-
-# Chunk text with timestamp at a sentence boundary that is just less than max token size
-def chunktext(transcript_json, max_tokens=TIKTOKEN_MAX_TOKENS / 10):
-
-    timecodes = []
-    chunks = []
-    running_token_length = 0
-    curr_timecode = "PT0.00S"
-    sentence_boundary_index = 0
-    curr_chunk = ""
-    i = 0
-    while i < len(transcript_json["recognizedPhrases"]):
-        phrase = transcript_json["recognizedPhrases"][i]["nBest"][0]["display"]
-        if running_token_length + len(tokenizer.encode(phrase)) > max_tokens:
-            chunks.append(curr_chunk)
-            timecodes.append(curr_timecode)
-            i = sentence_boundary_index + 1  # move just past last sentence bounday
-            curr_chunk = transcript_json["recognizedPhrases"][i]["nBest"][0]["display"]
-            running_token_length = len(tokenizer.encode(curr_chunk))
-            curr_timecode = transcript_json["recognizedPhrases"][i]["offset"]
-        else:
-            curr_chunk += " " + phrase
-            running_token_length += len(tokenizer.encode(phrase))
-            for chr in TERMINATING_CHARS:
-                if phrase.endswith(chr):
-                    sentence_boundary_index = i
-            i += 1
-
-    return (timecodes, chunks)
+        cursor.execute(
+            """
+            SELECT episodeid FROM episodes
+            WHERE podcastid = %s AND transcribed = TRUE AND NOT EXISTS (
+                SELECT 1 FROM simple_embeddings
+                WHERE simple_embeddings.podcastid = episodes.podcastid
+                AND simple_embeddings.episodeid = episodes.episodeid
+            )
+            ORDER BY episodeid;
+            """,
+            (podcastid,),
+        )
+        result = [row[0] for row in cursor.fetchall()]
 
+        cursor.close()
 
-def generate_embeddings(
-    chunks, model="text-embedding-ada-002"
-):  # model = "deployment_name"
-    return client.embeddings.create(input=chunks, model=model)
+    return result
 
 
-if __name__ == "__main__":
+def replace_embeddings(podcastid, episodeid, timecodes, chunks, embeddings):
+    """Replace all rows of an episode with a multi-row insert in one transaction."""
+    with get_db_pool().connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute(
+            "DELETE FROM simple_embeddings WHERE podcastid = %s AND episodeid = %s;",
+            (podcastid, episodeid),
+        )
+        execute_values(
+            cursor,
+            """
+            INSERT INTO simple_embeddings(podcastid, episodeid, timecode, chunk, embedding)
+            VALUES %s;
+            """,
+            [
+                (podcastid, episodeid, timecode, chunk, str(embedding))
+                for timecode, chunk, embedding in zip(timecodes, chunks, embeddings)
+            ],
+            template="(%s, %s, %s, %s, %s::vector)",
+            page_size=500,
+        )
+
+        # tell the servers to drop answers built from the old chunks
+        notify_episode_changed(cursor, podcastid, episodeid)
 
-    # accept episodeid and question as input
-    episodeid = sys.argv[1]
+        cursor.close()
 
-    records = select_from_episodes_with_episodeid(episodeid)
 
-    # retrieve transcript from DB for context
-    record = select_from_episodes_with_episodeid(episodeid)
-    transcript = record[EpisodeAttributes.TRANSCRIPT.value]
-    transcripttext = record[EpisodeAttributes.TRANSCRIPTTEXT.value]
+def generate_embeddings(
+    chunks, model="text-embedding-ada-002"
+):  # model = "deployment_name"
+    return get_openai_client().embeddings.create(input=chunks, model=model)
+
+
+# Limits of a single embeddings request and of the work in flight
+MAX_BATCH_TOKENS = 16000
+MAX_BATCH_INPUTS = 256
+DEFAULT_CONCURRENCY = 4
+MAX_RETRIES = 6
+
+
+def pack_batches(
+    token_counts, max_tokens=MAX_BATCH_TOKENS, max_inputs=MAX_BATCH_INPUTS
+):
+    """Group consecutive chunk indices into batches bounded by tokens and inputs."""
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for i, count in enumerate(token_counts):
+        if batch and (batch_tokens + count > max_tokens or len(batch) >= max_inputs):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(i)
+        batch_tokens += count
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class RateLimitGate:
+    """Makes every worker pause when any of them is told to back off."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._resume_at = 0.0
+
+    def wait(self):
+        while True:
+            with self._lock:
+                delay = self._resume_at - time.monotonic()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def back_off(self, delay):
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + delay)
+
+
+def retry_after(error):
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def embed_batch(gate, texts, max_retries=MAX_RETRIES):
+    # openai is imported with the client, not when this module is
+    from openai import (
+        APIConnectionError,
+        APITimeoutError,
+        InternalServerError,
+        RateLimitError,
+    )
 
-    print(len(tokenizer.encode(transcripttext)))
-    timecodes_and_chunks = chunktext(transcript)
+    retryable = (
+        RateLimitError,
+        APIConnectionError,
+        APITimeoutError,
+        InternalServerError,
+    )
+    delay = 1.0
+    for attempt in range(max_retries + 1):
+        gate.wait()
+        try:
+            return [d.embedding for d in generate_embeddings(texts).data]
+        except retryable as e:
+            if attempt == max_retries:
+                raise
+            # honour the server's hint, otherwise exponential backoff with jitter
+            pause = retry_after(e) or delay * (1 + random.random())
+            logging.info(f"Embeddings call failed ({e}), retrying in {pause:.1f}s")
+            if isinstance(e, RateLimitError):
+                gate.back_off(pause)
+            else:
+                time.sleep(pause)
+            delay = min(delay * 2, 60.0)
+
+
+def embed_episodes(
+    podcastid,
+    episodeids,
+    concurrency=DEFAULT_CONCURRENCY,
+    max_batch_tokens=MAX_BATCH_TOKENS,
+    max_chunk_tokens=DEFAULT_MAX_TOKENS,
+    overlap_tokens=0,
+):
+    gate = RateLimitGate()
+    total_chunks = 0
+    total_tokens = 0
+    failed = []
+    started = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # episodes whose batches are submitted but not yet written, oldest first
+        pending = []
+
+        def write_oldest():
+            nonlocal total_chunks, total_tokens
+            episodeid, timecodes, chunks, tokens, futures = pending.pop(0)
+            try:
+                embeddings = [e for future in futures for e in future.result()]
+            except Exception as e:
+                logging.error(f"Episode {episodeid} failed: {e}")
+                failed.append(episodeid)
+                return
+            replace_embeddings(podcastid, episodeid, timecodes, chunks, embeddings)
+            total_chunks += len(chunks)
+            total_tokens += tokens
+            elapsed = time.monotonic() - started
+            logging.info(
+                f"Episode {episodeid}: {len(chunks)} chunks written, "
+                f"{total_chunks / elapsed:.1f} chunks/sec, "
+                f"{total_tokens / elapsed:.0f} tokens/sec overall"
+            )
+
+        for episodeid in episodeids:
+            transcript = select_transcript(podcastid, episodeid)
+            if not transcript:
+                logging.info(f"Episode {episodeid} has no transcript, skipping")
+                continue
+
+            chunked = chunk_phrases(transcript, max_chunk_tokens, overlap_tokens)
+            timecodes = [c.timecode for c in chunked]
+            chunks = [c.text for c in chunked]
+            token_counts = [c.tokens for c in chunked]
+
+            futures = [
+                executor.submit(embed_batch, gate, [chunks[i] for i in batch])
+                for batch in pack_batches(token_counts, max_batch_tokens)
+            ]
+            pending.append((episodeid, timecodes, chunks, sum(token_counts), futures))
+
+            # keep a bounded number of episodes in memory
+            while len(pending) > concurrency:
+                write_oldest()
+
+        while pending:
+            write_oldest()
+
+    elapsed = time.monotonic() - started
+    logging.info(
+        f"Embedded {total_chunks} chunks ({total_tokens} tokens) in {elapsed:.1f}s: "
+        f"{total_chunks / elapsed:.1f} chunks/sec, "
+        f"{total_tokens / elapsed:.0f} tokens/sec"
+    )
+    return failed
 
-    embeddings = generate_embeddings(timecodes_and_chunks[1])
 
-    for i in range(0, len(embeddings.data)):
-        insert_embedding(
-            1,
-            episodeid,
-            timecodes_and_chunks[0][i],
-            timecodes_and_chunks[1][i],
-            embeddings.data[i].embedding,
-        )
-        print(
-            timecodes_and_chunks[0][i],
-            timecodes_and_chunks[1][i][0:20],
-            embeddings.data[i].embedding[0:3],
-        )
+if __name__ == "__main__":
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.DEBUG,
+        format="%(asctime)s %(message)s",
+        datefmt="%m/%d/%Y %I:%M:%S %p %Z",
+    )
 
-    # print(embeddings)
-    # return client.embeddings.create(input = [text], model=model).data[0].embedding
+    parser = argparse.ArgumentParser(description="Embed transcribed episodes.")
+    parser.add_argument("episodeids", nargs="*", type=int)
+    parser.add_argument(
+        "--all", action="store_true", help="embed every episode not embedded yet"
+    )
+    parser.add_argument("--podcastid", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--batch-tokens", type=int, default=MAX_BATCH_TOKENS)
+    parser.add_argument("--max-tokens", type=int, default=DEFAULT_MAX_TOKENS)
+    parser.add_argument("--overlap", type=int, default=0)
+    args = parser.parse_args()
+
+    episodeids = args.episodeids
+    if args.all:
+        episodeids = select_episodes_to_embed(args.podcastid)
+
+    failed = embed_episodes(
+        args.podcastid,
+        episodeids,
+        args.concurrency,
+        args.batch_tokens,
+        args.max_tokens,
+        args.overlap,
+    )
+    if failed:
+        logging.error(f"Episodes not embedded: {failed}")
+        sys.exit(1)
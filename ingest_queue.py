@@ -0,0 +1,626 @@
+"""
+Postgres job queue and worker for the ingest pipeline.
+
+Getting an episode live takes four stages, each one a job in the
+`ingest_jobs` table:
+
+- `feed`: sync a registered feed (rssconvert.sync_feed) and queue every
+  episode with audio that is not transcribed yet,
+- `transcribe`: submit the episode to batch transcription, poll it and store
+  the transcript (transcription_orchestrator.py),
+- `questions`: generate the quiz questions (transcribe_ep.store_questions),
+- `embed`: chunk and embed the transcript (gen-embeddings-simple.py).
+
+A finished job queues the next stage of its episode. A job is identified by
+(stage, podcastid, episodeid), with episodeid 0 for feeds, so queueing an
+episode twice is a no-op, and every stage can be re-run: it skips the work
+that is already done or replaces its earlier result.
+
+Workers claim due jobs with `FOR UPDATE SKIP LOCKED` and hold them for a lease
+of `INGEST_LEASE` seconds, so any number of workers on any number of hosts can
+share the queue, and the jobs of a worker that died are picked up again once
+their lease runs out. Each worker runs up to `INGEST_CONCURRENCY[stage]` jobs
+of a stage at a time. A failed job is retried with exponential backoff up to
+`INGEST_MAX_ATTEMPTS` times and then left Failed. While a transcription is
+running its job is rescheduled instead of holding a thread. Feed jobs repeat
+every `INGEST_FEED_INTERVAL` seconds, and start over after that interval
+when they run out of attempts. A worker renews the leases of its running jobs
+every third of a lease, so a long job is not claimed a second time.
+
+Usage:
+------
+```sh
+python ./ingest_queue.py enqueue feed [podcastid ...]
+python ./ingest_queue.py enqueue transcribe <podcastid> <episodeid> [...] [--force]
+python ./ingest_queue.py worker [--stages transcribe,questions]
+python ./ingest_queue.py status
+```
+`enqueue feed` without podcast IDs queues every registered feed. `--force`
+makes jobs that are not running due now, including Done and Failed ones.
+"""
+
+import argparse
+import importlib
+import logging
+import random
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+from providers import get_config, get_db_pool
+
+STAGES = ("feed", "transcribe", "questions", "embed")
+# jobs per stage that one worker runs at a time
+DEFAULT_CONCURRENCY = {"feed": 2, "transcribe": 8, "questions": 2, "embed": 2}
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_RETRY_DELAY = 30.0
+MAX_RETRY_DELAY = 3600.0
+DEFAULT_LEASE = 1800.0
+DEFAULT_FEED_INTERVAL = 3600.0
+DEFAULT_POLL_INTERVAL = 2.0
+TRANSCRIPTION_POLL_INTERVAL = 30.0
+FEED_EPISODEID = 0
+
+# not forced: a job that is already queued, running, done or failed is kept
+ENQUEUE_QUERY = """
+INSERT INTO ingest_jobs (stage, podcastid, episodeid, run_after)
+VALUES (%s, %s, %s, now() + %s * interval '1 second')
+ON CONFLICT (stage, podcastid, episodeid) DO NOTHING;
+"""
+# forced: the job is due now and starts over, unless it is running
+FORCE_ENQUEUE_QUERY = """
+INSERT INTO ingest_jobs (stage, podcastid, episodeid, run_after)
+VALUES (%s, %s, %s, now() + %s * interval '1 second')
+ON CONFLICT (stage, podcastid, episodeid) DO UPDATE
+SET status = 'Queued', attempts = 0, error = NULL,
+    run_after = EXCLUDED.run_after, updated_at = now()
+WHERE ingest_jobs.status <> 'Running';
+"""
+# due queued jobs, and running jobs whose worker lost its lease. claimed_at
+# identifies the claim; locked_until is pushed back while the job runs
+CLAIM_QUERY = """
+UPDATE ingest_jobs
+SET status = 'Running', attempts = attempts + 1, claimed_at = clock_timestamp(),
+    locked_until = now() + %s * interval '1 second', updated_at = now()
+WHERE id IN (
+    SELECT id FROM ingest_jobs
+    WHERE stage = %s AND status IN ('Queued', 'Running') AND run_after <= now()
+    AND (status = 'Queued' OR locked_until < now())
+    ORDER BY run_after
+    LIMIT %s
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING id, stage, podcastid, episodeid, attempts, claimed_at;
+"""
+# every update of a claimed job checks that the claim is still this worker's
+RENEW_QUERY = """
+UPDATE ingest_jobs
+SET locked_until = now() + %s * interval '1 second'
+WHERE id = %s AND status = 'Running' AND claimed_at = %s;
+"""
+FINISH_QUERY = """
+UPDATE ingest_jobs
+SET status = %s, error = %s, attempts = attempts + %s,
+    run_after = now() + %s * interval '1 second',
+    locked_until = NULL, updated_at = now()
+WHERE id = %s AND status = 'Running' AND claimed_at = %s;
+"""
+STATUS_QUERY = """
+SELECT stage, status, count(*), min(run_after)
+FROM ingest_jobs
+GROUP BY stage, status;
+"""
+
+
+class Job(NamedTuple):
+    id: int
+    stage: str
+    podcastid: int
+    episodeid: int
+    attempts: int
+    claimed_at: object
+
+
+class Pending(Exception):
+    """Raised by a stage whose work is not finished; the job runs again later."""
+
+    def __init__(self, delay):
+        super().__init__(f"pending, next check in {delay:.0f}s")
+        self.delay = delay
+
+
+def enqueue(cursor, stage, podcastid, episodeid=FEED_EPISODEID, delay=0, force=False):
+    """Queue a job in the cursor's transaction. Returns whether a row changed."""
+    query = FORCE_ENQUEUE_QUERY if force else ENQUEUE_QUERY
+    cursor.execute(query, (stage, podcastid, episodeid, delay))
+    return cursor.rowcount > 0
+
+
+def retry_delay(attempts, base=DEFAULT_RETRY_DELAY):
+    # exponential backoff with jitter, so failed jobs do not retry in lockstep
+    delay = base * 2 ** (attempts - 1) * (1 + random.random() / 2)
+    return min(delay, MAX_RETRY_DELAY)
+
+
+class JobQueue:
+    def __init__(
+        self,
+        pool,
+        max_attempts=DEFAULT_MAX_ATTEMPTS,
+        retry_delay=DEFAULT_RETRY_DELAY,
+        lease=DEFAULT_LEASE,
+    ):
+        self.pool = pool
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease = lease
+
+    def enqueue(self, stage, podcastid, episodeids=(FEED_EPISODEID,), force=False):
+        """Queue jobs of a stage. Returns how many were queued."""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            queued = sum(
+                enqueue(cursor, stage, podcastid, episodeid, force=force)
+                for episodeid in episodeids
+            )
+            cursor.close()
+        return queued
+
+    def claim(self, stage, limit):
+        """Lease up to `limit` due jobs of a stage to this worker."""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(CLAIM_QUERY, (self.lease, stage, limit))
+            jobs = [Job(*row) for row in cursor.fetchall()]
+            cursor.close()
+        return jobs
+
+    def _finish(self, cursor, job, status, error=None, delay=0, attempts=0):
+        cursor.execute(
+            FINISH_QUERY,
+            (status, error, attempts, delay, job.id, job.claimed_at),
+        )
+        if cursor.rowcount == 0:
+            logging.warning(f"Lost the lease of {job.stage} job {job.id}")
+        return cursor.rowcount > 0
+
+    def complete(self, job, next_stage, episodeids, repeat_after=None, force=False):
+        """
+        Mark a job done and queue `next_stage` for `episodeids` in the same
+        transaction. With `repeat_after` the job is queued again instead.
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            if repeat_after is None:
+                finished = self._finish(cursor, job, "Done")
+            else:
+                # attempts count the failures of one run, not of every repeat
+                finished = self._finish(
+                    cursor, job, "Queued", delay=repeat_after, attempts=-job.attempts
+                )
+            if finished and next_stage is not None:
+                for episodeid in episodeids:
+                    enqueue(cursor, next_stage, job.podcastid, episodeid, force=force)
+            cursor.close()
+
+    def renew(self, jobs):
+        """Extend the leases of running jobs. Returns the ids of those lost."""
+        lost = []
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            for job in jobs:
+                cursor.execute(RENEW_QUERY, (self.lease, job.id, job.claimed_at))
+                if cursor.rowcount == 0:
+                    lost.append(job.id)
+            cursor.close()
+        return lost
+
+    def reschedule(self, job, delay):
+        """Run a pending job again after `delay` seconds, as the same attempt."""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            self._finish(cursor, job, "Queued", delay=delay, attempts=-1)
+            cursor.close()
+
+    def fail(self, job, error, repeat_after=None):
+        """
+        Retry a failed job with backoff, or give up after `max_attempts`. A job
+        with `repeat_after` is then not left Failed but starts over after that
+        many seconds.
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            if job.attempts >= self.max_attempts and repeat_after is not None:
+                self._finish(
+                    cursor, job, "Queued", error, repeat_after, attempts=-job.attempts
+                )
+            elif job.attempts >= self.max_attempts:
+                self._finish(cursor, job, "Failed", error)
+            else:
+                delay = retry_delay(job.attempts, self.retry_delay)
+                self._finish(cursor, job, "Queued", error, delay)
+            cursor.close()
+        return job.attempts >= self.max_attempts
+
+    def status(self):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(STATUS_QUERY)
+            rows = cursor.fetchall()
+            cursor.close()
+        return rows
+
+
+class Pipeline:
+    """The stages. Each takes a job's IDs and returns the episodes of the next."""
+
+    def __init__(self, config, pool):
+        self.config = config
+        self.pool = pool
+        self.feed_interval = float(
+            config.get("INGEST_FEED_INTERVAL", DEFAULT_FEED_INTERVAL)
+        )
+        self._orchestrator = None
+        self._lock = threading.Lock()
+        # result downloads of finished transcriptions
+        self._downloads = ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix="ingest-download"
+        )
+
+    @property
+    def orchestrator(self):
+        # the stages that never transcribe do not need the speech config
+        with self._lock:
+            if self._orchestrator is None:
+                from transcription_orchestrator import TranscriptionOrchestrator
+
+                self._orchestrator = TranscriptionOrchestrator(
+                    self.config, pool=self.pool, generate_questions=False
+                )
+        return self._orchestrator
+
+    def _fetchall(self, query, params):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+            cursor.close()
+        return rows
+
+    def feed(self, podcastid, episodeid):
+        from rssconvert import sync_feed
+
+        rows = self._fetchall(
+            """
+            SELECT feed_url, etag, last_modified, last_guid
+            FROM feeds WHERE podcastid = %s;
+            """,
+            (podcastid,),
+        )
+        if not rows:
+            raise LookupError(f"Podcast {podcastid} has no registered feed")
+        sync_feed(self.pool, podcastid, *rows[0])
+
+        rows = self._fetchall(
+            """
+            SELECT episodeid FROM episodes
+            WHERE podcastid = %s AND transcribed IS NOT TRUE
+            AND COALESCE(url, '') <> ''
+            ORDER BY episodeid;
+            """,
+            (podcastid,),
+        )
+        return [row[0] for row in rows]
+
+    def transcribe(self, podcastid, episodeid):
+        from transcription_orchestrator import Job as TranscriptionJob
+
+        rows = self._fetchall(
+            """
+            SELECT episodes.title, episodes.url, episodes.transcribed,
+                   transcription_jobs.transcription_id, transcription_jobs.status
+            FROM episodes
+            LEFT JOIN transcription_jobs
+            ON transcription_jobs.podcastid = episodes.podcastid
+            AND transcription_jobs.episodeid = episodes.episodeid
+            WHERE episodes.podcastid = %s AND episodes.episodeid = %s;
+            """,
+            (podcastid, episodeid),
+        )
+        if not rows:
+            raise LookupError(f"No episode {podcastid}/{episodeid}")
+        title, url, transcribed, transcription_id, status = rows[0]
+        if transcribed:
+            return [episodeid]
+
+        if status != "Submitted":
+            # never submitted, or the last transcription failed
+            self.orchestrator.submit(podcastid, [(episodeid, title, url)])
+            raise Pending(TRANSCRIPTION_POLL_INTERVAL)
+
+        job = TranscriptionJob(transcription_id, {url: (podcastid, episodeid, title)})
+        status = self.orchestrator.check(job)
+        if status == "Failed":
+            raise RuntimeError(f"Transcription {transcription_id} failed")
+        if job.poll_errors:
+            # uses up an attempt, so a poll that keeps failing is not pending forever
+            raise RuntimeError(f"Polling transcription {transcription_id} failed")
+        if status != "Succeeded":
+            raise Pending(TRANSCRIPTION_POLL_INTERVAL)
+
+        self.orchestrator.collect(job, self._downloads)
+        rows = self._fetchall(
+            """
+            SELECT status FROM transcription_jobs
+            WHERE podcastid = %s AND episodeid = %s;
+            """,
+            (podcastid, episodeid),
+        )
+        if not rows or rows[0][0] != "Stored":
+            raise RuntimeError(f"Transcription {transcription_id} has no result")
+        return [episodeid]
+
+    def questions(self, podcastid, episodeid):
+        from transcribe_ep import store_questions
+
+        store_questions(self.config, podcastid, episodeid)
+        return [episodeid]
+
+    def embed(self, podcastid, episodeid):
+        # a script module, not a package module
+        embed_module = importlib.import_module("gen-embeddings-simple")
+
+        failed = embed_module.embed_episodes(podcastid, [episodeid])
+        if failed:
+            raise RuntimeError(f"Embedding episode {podcastid}/{episodeid} failed")
+        return []
+
+    def run(self, stage, podcastid, episodeid):
+        return getattr(self, stage)(podcastid, episodeid)
+
+    def repeat_after(self, stage):
+        return self.feed_interval if stage == "feed" else None
+
+
+class IngestWorker:
+    def __init__(
+        self,
+        queue,
+        pipeline,
+        stages=STAGES,
+        concurrency=None,
+        poll_interval=DEFAULT_POLL_INTERVAL,
+    ):
+        self.queue = queue
+        self.pipeline = pipeline
+        self.stages = stages
+        self.concurrency = {**DEFAULT_CONCURRENCY, **(concurrency or {})}
+        self.poll_interval = poll_interval
+        self.running = {stage: 0 for stage in stages}
+        # id -> Job of the jobs this worker runs, whose leases it renews
+        self._active = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+
+    def stop(self):
+        """Stop claiming jobs; `run` returns once the running ones finish."""
+        self._stopping.set()
+        self._wake.set()
+
+    def _run_job(self, job):
+        started = time.monotonic()
+        label = f"{job.stage} {job.podcastid}/{job.episodeid}"
+        try:
+            try:
+                if job.attempts > self.queue.max_attempts:
+                    # claimed again after its worker died on every attempt
+                    raise RuntimeError("too many attempts")
+                episodeids = self.pipeline.run(job.stage, job.podcastid, job.episodeid)
+            except Pending as e:
+                logging.info(f"{label}: {e}")
+                self.queue.reschedule(job, e.delay)
+            except Exception as e:
+                logging.exception(f"{label}: attempt {job.attempts} failed")
+                repeat_after = self.pipeline.repeat_after(job.stage)
+                if self.queue.fail(job, f"{type(e).__name__}: {e}", repeat_after):
+                    retry = f", retrying in {repeat_after}s" if repeat_after else ""
+                    logging.error(
+                        f"{label}: giving up after {job.attempts} attempts{retry}"
+                    )
+            else:
+                index = STAGES.index(job.stage)
+                next_stage = STAGES[index + 1] if index + 1 < len(STAGES) else None
+                # a re-run of an episode's stage makes the later ones stale; a
+                # feed sync only queues the episodes that are new to the queue
+                self.queue.complete(
+                    job,
+                    next_stage,
+                    episodeids,
+                    self.pipeline.repeat_after(job.stage),
+                    force=job.stage != "feed",
+                )
+                logging.info(f"{label}: done in {time.monotonic() - started:.1f}s")
+        except Exception:
+            # the queue is unreachable; the job is claimed again after its lease
+            logging.exception(f"{label}: could not record the result")
+        finally:
+            with self._lock:
+                self.running[job.stage] -= 1
+                self._active.pop(job.id, None)
+            # a finished job frees a slot and may have queued the next stage
+            self._wake.set()
+
+    def _claim(self, executors):
+        claimed = 0
+        for stage in self.stages:
+            with self._lock:
+                free = self.concurrency[stage] - self.running[stage]
+            if free <= 0:
+                continue
+            for job in self.queue.claim(stage, free):
+                with self._lock:
+                    self.running[stage] += 1
+                    self._active[job.id] = job
+                executors[stage].submit(self._run_job, job)
+                claimed += 1
+        return claimed
+
+    def _renew(self, renewed_at):
+        """Renew the leases of the running jobs every third of a lease."""
+        if time.monotonic() - renewed_at < self.queue.lease / 3:
+            return renewed_at
+        with self._lock:
+            jobs = list(self._active.values())
+        try:
+            lost = self.queue.renew(jobs) if jobs else []
+        except Exception:
+            logging.exception("Renewing leases failed")
+            return renewed_at
+        for job_id in lost:
+            # another worker may run it too now; its result is not recorded
+            logging.warning(f"Lost the lease of job {job_id} while running it")
+        return time.monotonic()
+
+    def _wait(self):
+        self._wake.wait(self.poll_interval)
+        self._wake.clear()
+
+    def run(self):
+        executors = {
+            stage: ThreadPoolExecutor(
+                max_workers=self.concurrency[stage],
+                thread_name_prefix=f"ingest-{stage}",
+            )
+            for stage in self.stages
+        }
+        logging.info(
+            "Ingest worker running "
+            + ", ".join(f"{stage} x{self.concurrency[stage]}" for stage in self.stages)
+        )
+        renewed_at = time.monotonic()
+        try:
+            while not self._stopping.is_set():
+                renewed_at = self._renew(renewed_at)
+                try:
+                    claimed = self._claim(executors)
+                except Exception:
+                    logging.exception("Claiming jobs failed")
+                    claimed = 0
+                if not claimed:
+                    self._wait()
+        finally:
+            logging.info("Ingest worker stopping, waiting for running jobs")
+            # the leases of the jobs still running are kept until they finish
+            while self._active:
+                renewed_at = self._renew(renewed_at)
+                self._wait()
+            for executor in executors.values():
+                executor.shutdown(wait=True)
+
+
+def create_job_queue(config, pool):
+    """Build the queue from the optional `INGEST_*` config keys."""
+    return JobQueue(
+        pool,
+        max_attempts=int(config.get("INGEST_MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS)),
+        retry_delay=float(config.get("INGEST_RETRY_DELAY", DEFAULT_RETRY_DELAY)),
+        lease=float(config.get("INGEST_LEASE", DEFAULT_LEASE)),
+    )
+
+
+def parse_concurrency(values):
+    """`stage=n` pairs from the command line."""
+    concurrency = {}
+    for value in values:
+        stage, _, count = value.partition("=")
+        if stage not in STAGES or not count.isdigit():
+            raise ValueError(f"expected <stage>=<count>, got {value!r}")
+        concurrency[stage] = int(count)
+    return concurrency
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest pipeline job queue.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    enqueue_parser = commands.add_parser("enqueue", help="queue jobs")
+    enqueue_parser.add_argument("stage", choices=STAGES)
+    enqueue_parser.add_argument("ids", nargs="*", type=int)
+    enqueue_parser.add_argument("--force", action="store_true")
+
+    worker_parser = commands.add_parser("worker", help="run jobs")
+    worker_parser.add_argument("--stages", default=",".join(STAGES))
+    worker_parser.add_argument(
+        "--concurrency", nargs="*", default=[], help="per stage, e.g. embed=4"
+    )
+
+    commands.add_parser("status", help="count jobs by stage and status")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.INFO,
+        format="%(asctime)s %(message)s",
+        datefmt="%m/%d/%Y %I:%M:%S %p %Z",
+    )
+
+    config = get_config()
+    pool = get_db_pool()
+    queue = create_job_queue(config, pool)
+
+    if args.command == "enqueue":
+        if args.stage == "feed":
+            podcastids = args.ids
+            if not podcastids:
+                with pool.connection() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute("SELECT podcastid FROM feeds ORDER BY podcastid;")
+                    podcastids = [row[0] for row in cursor.fetchall()]
+                    cursor.close()
+            queued = sum(
+                queue.enqueue("feed", pid, force=args.force) for pid in podcastids
+            )
+        elif len(args.ids) < 2:
+            parser.error(f"{args.stage} needs a podcastid and episodeids")
+        else:
+            queued = queue.enqueue(
+                args.stage, args.ids[0], args.ids[1:], force=args.force
+            )
+        print(f"Queued {queued} {args.stage} jobs")
+
+    elif args.command == "status":
+        for stage, status, count, due in sorted(queue.status()):
+            print(f"{stage:<11} {status:<8} {count:>6}  next due {due:%Y-%m-%d %H:%M}")
+
+    else:
+        stages = tuple(args.stages.split(","))
+        unknown = set(stages) - set(STAGES)
+        if unknown:
+            parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+        try:
+            concurrency = parse_concurrency(args.concurrency)
+        except ValueError as e:
+            parser.error(str(e))
+        concurrency = {
+            **config.get("INGEST_CONCURRENCY", {}),
+            **concurrency,
+        }
+        worker = IngestWorker(
+            queue,
+            Pipeline(config, pool),
+            stages,
+            concurrency,
+            float(config.get("INGEST_POLL_INTERVAL", DEFAULT_POLL_INTERVAL)),
+        )
+        # finish the running jobs on SIGTERM or Ctrl+C
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *_: worker.stop())
+        worker.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""
+Tracing spans and Prometheus-style metrics for the servers.
+
+`span(name)` times a block of code. On exit it records the duration in the
+`podcast_stage_seconds` histogram under the `stage` label. With the "trace"
+logger at DEBUG it also logs the span with the names of its enclosing spans,
+e.g. `select_embeddings/vector 12.3ms`. `traced(name)` wraps a function
+or coroutine function in a span. The cost is two clock reads and a histogram
+update per span, so spans stay on in production.
+
+`GET /metrics` serves `REGISTRY.render()` in the Prometheus text format: the
+histograms and counters below, plus the `stats()` of the caches and the
+connection pool as gauges. Metrics are per process.
+"""
+
+import bisect
+import contextvars
+import functools
+import inspect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# seconds, from a cached embedding lookup to a long streamed answer
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+)  # fmt: skip
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000)
+
+trace_logger = logging.getLogger("trace")
+# names of the enclosing spans, per thread and per asyncio task
+_span_path = contextvars.ContextVar("span_path", default=())
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # label values -> [per-bucket counts (not cumulative), sum, count]
+        self._series = {}
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                counts = [0] * (len(self.buckets) + 1)
+                series = self._series[labels] = [counts, 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted(
+                (labels, (list(counts), total, count))
+                for labels, (counts, total, count) in self._series.items()
+            )
+        names = self.label_names + ("le",)
+        for labels, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                le = _labels(names, labels + (bound,))
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            suffix = _labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        # prefix -> function returning a stats() dict
+        self._stats = {}
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(name, help, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_stats(self, prefix, stats):
+        """Export the numeric values of `stats()` as `<prefix>_<key>` gauges."""
+        self._stats[prefix] = stats
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for prefix, stats in self._stats.items():
+            for key, value in (stats() or {}).items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                lines.append(f"# TYPE {prefix}_{key} gauge")
+                lines.append(f"{prefix}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "podcast_stage_seconds", "Latency of traced stages.", ["stage"]
+)
+HTTP_SECONDS = REGISTRY.histogram(
+    "podcast_http_seconds",
+    "Latency until the response headers, per endpoint.",
+    ["endpoint", "status"],
+)
+FIRST_TOKEN_SECONDS = REGISTRY.histogram(
+    "podcast_ask_first_token_seconds",
+    "Latency of /ask until the first answer token is sent.",
+    ["mode"],
+)
+ANSWER_SECONDS = REGISTRY.histogram(
+    "podcast_ask_answer_seconds",
+    "Latency of /ask until the answer stream ends.",
+    ["mode"],
+)
+PROMPT_TOKENS = REGISTRY.histogram(
+    "podcast_prompt_tokens", "Tokens in /ask prompts.", ["mode"], TOKEN_BUCKETS
+)
+COMPLETION_TOKENS = REGISTRY.counter(
+    "podcast_completion_tokens_total",
+    "Tokens generated by the chat model (cached answers excluded).",
+    ["mode"],
+)
+
+
+@contextmanager
+def span(name, timings=None):
+    """Time the block as stage `name`; also add it to `timings`, if given."""
+    path = _span_path.get() + (name,)
+    token = _span_path.set(path)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        _span_path.reset(token)
+        STAGE_SECONDS.observe(seconds, name)
+        if timings is not None:
+            timings.add(name, seconds)
+        if trace_logger.isEnabledFor(logging.DEBUG):
+            trace_logger.debug(f"{'/'.join(path)} {seconds * 1000:.1f}ms")
+
+
+def traced(name):
+    """Decorator: run each call of the function in `span(name)`."""
+
+    def decorate(function):
+        if inspect.iscoroutinefunction(function):
+
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await function(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
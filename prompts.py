@@ -0,0 +1,100 @@
+"""
+Prompts used to answer questions in the `/ask` flows.
+
+They are shared by the threaded Flask server (server.py) and the asyncio
+server (async_server.py) so that both serving modes send identical prompts.
+"""
+
+from string import Template
+
+CHAT_MODEL = "gpt-4o"
+EMBEDDING_MODEL = "text-embedding-ada-002"
+
+SYSTEM_PROMPT = """
+    You are a helpful assistant that answers user questions. You will use any context
+    provided, if available, and answer the questions as truthfully as possible. You
+    will provide your response in 200 words or less.
+    """
+
+FULLTEXT_USER_PROMPT = """
+        The input enclosed in backticks is the transcript of a podcast with the title "%s".
+        Based on this transcript and in keeping with your role as a helpful assistant,
+        please answer the question "%s" from a user. You will ignore any parts of the
+        transcript that are not relevant to the core topic such as ad reads.
+        `%s`
+        """
+
+FULLTEXT_EXCERPTS_USER_PROMPT = """
+        The input enclosed in backticks is a set of excerpts, in order and each starting
+        with its timecode, from the transcript of a podcast with the title "%s". Based on
+        these excerpts and in keeping with your role as a helpful assistant, please answer
+        the question "%s" from a user. You will ignore any parts of the excerpts that are
+        not relevant to the core topic such as ad reads.
+        `%s`
+        """
+
+RAG_USER_PROMPT = """
+        Based on the context enclosed in backticks below and in keeping with your role as
+        a helpful assistant, please answer the question "%s" from a user. Along with the
+        response, you will also return the episodes and timecodes from where you got context
+        inputs. You will ignore any parts of the context that are not relevant to the question
+        such as ad reads.
+        `%s`
+        """
+
+SUMMARY_USER_PROMPT = """
+        Based on the episode summaries and the transcript excerpts enclosed in backticks
+        below and in keeping with your role as a helpful assistant, please answer the
+        question "%s" from a user. Use the summaries for the overall picture and the
+        excerpts for details. Along with the response, you will also return the episodes
+        and timecodes from where you got context inputs.
+        `%s`
+        """
+
+SUMMARY_TMPL = Template(
+    "Episode ID ${eid} with the title ${title} is summarized as #${summary}#\n"
+)
+
+CONTEXT_TMPL = Template(
+    "Episode ID ${eid} with the title ${title} at the timecode ${timecode} provides the context #${context}#\n"
+)
+
+
+def fulltext_user_prompt(title, question, transcripttext):
+    return FULLTEXT_USER_PROMPT % (title, question, transcripttext)
+
+
+def fulltext_excerpts_user_prompt(title, question, excerpts):
+    return FULLTEXT_EXCERPTS_USER_PROMPT % (title, question, excerpts)
+
+
+def rag_user_prompt(question, embeddings):
+    """
+    Build the RAG prompt from rows of (episodeid, title, timecode, chunk) as
+    returned by the embeddings search.
+    """
+    context = ""
+
+    for val in embeddings:
+        context += CONTEXT_TMPL.substitute(
+            eid=val[0], title=val[1], timecode=str(val[2]), context=val[3]
+        )
+
+    return RAG_USER_PROMPT % (question, context)
+
+
+def summary_user_prompt(question, summaries, embeddings):
+    """
+    Build the summary-mode prompt from rows of (episodeid, title, summary) and
+    the (episodeid, title, timecode, chunk) rows of the top chunks.
+    """
+    context = ""
+
+    for val in summaries:
+        context += SUMMARY_TMPL.substitute(eid=val[0], title=val[1], summary=val[2])
+    for val in embeddings:
+        context += CONTEXT_TMPL.substitute(
+            eid=val[0], title=val[1], timecode=str(val[2]), context=val[3]
+        )
+
+    return SUMMARY_USER_PROMPT % (question, context)
@@ -0,0 +1,77 @@
+"""
+Lazily created, process-wide configuration and clients.
+
+Scripts and server workers used to read config.json and construct their
+clients at import time, so every run paid for all of them, used or not. The
+providers here build their object on first use and hand out the same one
+after that:
+
+- `get_config()`: config.json, or the file named by the `PODCAST_CONFIG`
+  environment variable,
+- `get_openai_client()`: the Azure OpenAI client from the `LLM_*` keys; the
+  openai package is only imported then,
+- `get_db_pool()`: the connection pool of db_pool.py for that config,
+- `get_tokenizer()`: the tiktoken encoding of chunker.py.
+
+A forked process (a server worker) builds its own OpenAI client rather than
+sharing its parent's HTTP connections.
+"""
+
+import json
+import os
+import threading
+
+# get_tokenizer is re-exported
+from chunker import get_tokenizer
+from db_pool import get_pool
+
+DEFAULT_CONFIG_FILE = "config.json"
+
+_config = None
+_openai_client = None
+_lock = threading.Lock()
+
+
+def config_path():
+    return os.environ.get("PODCAST_CONFIG", DEFAULT_CONFIG_FILE)
+
+
+def get_config():
+    """The parsed config file, read on first use."""
+    global _config
+    if _config is None:
+        with _lock:
+            if _config is None:
+                with open(config_path()) as config_file:
+                    _config = json.load(config_file)
+    return _config
+
+
+def get_openai_client():
+    """The shared AzureOpenAI client, created on first use."""
+    global _openai_client
+    if _openai_client is None:
+        config = get_config()
+        with _lock:
+            if _openai_client is None:
+                from openai import AzureOpenAI
+
+                _openai_client = AzureOpenAI(
+                    api_key=config["LLM_API_KEY"],
+                    api_version=config["LLM_API_VERSION"],
+                    azure_endpoint=config["LLM_TARGET_URI"],
+                )
+    return _openai_client
+
+
+def get_db_pool():
+    return get_pool(get_config())
+
+
+def _reset_after_fork():
+    global _openai_client, _lock
+    _lock = threading.Lock()
+    _openai_client = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,180 @@
+"""
+Rerank stage between retrieval and prompt assembly.
+
+ada-002 cosine ranking is noisy at the top, so a RAG context of the first k
+neighbours carries chunks that do not answer the question. With a reranker the
+hybrid retrieval over-fetches `candidates` chunks, they are scored again on the
+CPU, and the best k that fit in `token_budget` tokens go into the prompt.
+
+Rerankers are looked up by name in `RERANKERS` and score all candidates at
+once: `score(question, question_embedding, rows, vectors)` returns one score
+per row, higher is better, where `vectors` is the float32 matrix of the
+candidates' embeddings. The default `FeatureReranker` combines
+
+- the cosine similarity of question and chunk, rescaled across the candidates,
+- the share of the question's terms that occur in the chunk,
+- the share of the question's key terms (numbers, names, product terms) that
+  occur in the chunk, which is what pure vector search misses most.
+
+A small local model can be plugged in the same way.
+"""
+
+import re
+from typing import NamedTuple
+
+import numpy as np
+
+from chunker import get_tokenizer
+from vector_index import parse_vector
+
+NO_RERANK = "none"
+DEFAULT_RERANKER = "features"
+DEFAULT_CANDIDATES = 30
+MAX_CANDIDATES = 200
+DEFAULT_TOKEN_BUDGET = 4000
+# cosine, term overlap, key term overlap
+DEFAULT_WEIGHTS = (1.0, 0.5, 0.5)
+
+WORD = re.compile(r"[A-Za-z0-9][A-Za-z0-9+#]*(?:[.'-][A-Za-z0-9+#]+)*")
+STOP_WORDS = frozenset(
+    """
+    a about an and are as at be but by can did do does for from had has have how i
+    if in into is it its me my not of on or our so that the their them then there
+    these they this to was we were what when where which who why will with would
+    you your
+    """.split()
+)
+
+
+class RerankSettings(NamedTuple):
+    reranker: str = DEFAULT_RERANKER
+    candidates: int = DEFAULT_CANDIDATES
+    token_budget: int = DEFAULT_TOKEN_BUDGET
+
+
+def default_reranker(memory_index):
+    """
+    The reranker used when `RERANKER` is not set. Without the in-process
+    vector index the candidates' embeddings take another query, so reranking
+    is then off unless it is asked for.
+    """
+    return DEFAULT_RERANKER if memory_index is not None else NO_RERANK
+
+
+def rerank_settings(args, config):
+    """
+    Parse the `rerank` and `candidates` request parameters, with defaults from
+    the optional `RERANKER`, `RERANK_CANDIDATES` and `RERANK_TOKEN_BUDGET`
+    config keys. Raises ValueError on bad input.
+    """
+    reranker = args.get("rerank", config.get("RERANKER", DEFAULT_RERANKER))
+    if reranker != NO_RERANK and reranker not in RERANKERS:
+        raise ValueError(f"unknown reranker {reranker!r}")
+
+    candidates = int(
+        args.get("candidates", config.get("RERANK_CANDIDATES", DEFAULT_CANDIDATES))
+    )
+    if not 1 <= candidates <= MAX_CANDIDATES:
+        raise ValueError(f"candidates must be between 1 and {MAX_CANDIDATES}")
+
+    token_budget = int(config.get("RERANK_TOKEN_BUDGET", DEFAULT_TOKEN_BUDGET))
+    return RerankSettings(reranker, candidates, token_budget)
+
+
+def terms(text):
+    return {word.lower() for word in WORD.findall(text)} - STOP_WORDS
+
+
+def key_terms(question):
+    """Words with digits or capitals past the first word, e.g. "GPT-4o" or ".NET"."""
+    words = WORD.findall(question)[1:]
+    return {
+        word.lower()
+        for word in words
+        if any(c.isdigit() for c in word) or any(c.isupper() for c in word)
+    } - STOP_WORDS
+
+
+def overlap(query_terms, chunk_terms):
+    if not query_terms:
+        return 0.0
+    return len(query_terms & chunk_terms) / len(query_terms)
+
+
+class FeatureReranker:
+    def __init__(self, weights=DEFAULT_WEIGHTS):
+        self.weights = np.asarray(weights, dtype=np.float32)
+
+    def score(self, question, question_embedding, rows, vectors):
+        query = np.array(question_embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        norms = np.linalg.norm(vectors, axis=1)
+        norms[norms == 0] = 1.0
+        cosine = (vectors @ query) / norms
+
+        # ada-002 similarities sit in a narrow band; spread them over [0, 1]
+        spread = cosine.max() - cosine.min()
+        cosine = (cosine - cosine.min()) / spread if spread > 0 else cosine * 0
+
+        question_terms = terms(question)
+        question_keys = key_terms(question)
+        chunk_terms = [terms(row[3]) for row in rows]
+        features = np.column_stack(
+            [
+                cosine,
+                [overlap(question_terms, words) for words in chunk_terms],
+                [overlap(question_keys, words) for words in chunk_terms],
+            ]
+        ).astype(np.float32)
+        return features @ self.weights
+
+
+RERANKERS = {
+    "features": FeatureReranker,
+}
+
+
+def create_reranker(name, config):
+    """The reranker registered as `name`, weighted by `RERANK_WEIGHTS`."""
+    if name == NO_RERANK:
+        return None
+    if name == "features":
+        return FeatureReranker(config.get("RERANK_WEIGHTS", DEFAULT_WEIGHTS))
+    return RERANKERS[name]()
+
+
+def rerank(reranker, question, question_embedding, rows, embeddings, k, token_budget):
+    """
+    The best `k` of `rows` by `reranker` score whose chunks fit in
+    `token_budget` tokens together, best first. `embeddings` maps chunk IDs to
+    pgvector text or to vectors; rows whose chunk has no embedding any more are
+    dropped.
+    """
+    rows = [row for row in rows if row[5] in embeddings]
+    if not rows:
+        return []
+
+    vectors = np.vstack(
+        [
+            parse_vector(value) if isinstance(value, str) else value
+            for value in (embeddings[row[5]] for row in rows)
+        ]
+    )
+    scores = reranker.score(question, question_embedding, rows, vectors)
+
+    counts = [
+        len(encoded)
+        for encoded in get_tokenizer().encode_batch(
+            [row[3] for row in rows], disallowed_special=()
+        )
+    ]
+    selected = []
+    used = 0
+    # stable, so ties keep the retrieval order
+    for i in np.argsort(-scores, kind="stable"):
+        if used + counts[i] <= token_budget:
+            selected.append(rows[i])
+            used += counts[i]
+            if len(selected) == k:
+                break
+    return selected
@@ -0,0 +1,394 @@
+"""
+Vector, lexical and hybrid search over the transcript chunks in
+`simple_embeddings`.
+
+The RAG query used to order every chunk of every episode by `<->` after a join,
+which Postgres can only answer with a sequential scan. This module builds
+queries that
+
+- run the nearest-neighbour search on `simple_embeddings` alone, so that the
+  HNSW or IVFFlat index on `embedding` can serve the ORDER BY ... LIMIT,
+- use the distance operator that matches the embedding model (cosine for
+  text-embedding-ada-002) and therefore the index operator class,
+- push podcast and episode filters down: an episode-scoped search is an exact
+  scan of that episode's chunks through the (podcastid, episodeid) index
+  instead of a walk of the global ANN index,
+- search one podcast, a set of podcasts or all of them; a single podcast is
+  searched through its own partial ANN index when it has one, so its queries
+  do not slow down as other shows are added,
+- set the recall/latency knobs (`hnsw.ef_search`, `ivfflat.probes`) for the
+  current transaction only.
+
+Nearest neighbours miss questions that hinge on exact names, product terms or
+numbers. `lexical_chunks_query` matches the words of the question against the
+GIN-indexed `chunk_tsv` column, and `rrf_fuse` merges the vector and the
+lexical ranking with weighted reciprocal-rank fusion, so a chunk ranked well by
+either search makes it into the context.
+
+The ANN indexes are created or rebuilt with:
+```sh
+python ./retrieval.py index hnsw|ivfflat [podcastid ...]
+```
+With podcast IDs, a partial index is built for each of those podcasts.
+"""
+
+import math
+import sys
+from typing import NamedTuple
+
+import psycopg2
+
+from db_pool import connect_kwargs
+from prompts import EMBEDDING_MODEL
+
+# distance operator and matching index operator class per embedding model
+DISTANCE_OPERATORS = {
+    "text-embedding-ada-002": ("<=>", "vector_cosine_ops"),
+}
+DEFAULT_DISTANCE_OPERATOR = ("<->", "vector_l2_ops")
+
+HNSW_INDEX = "simple_embeddings_embedding_hnsw"
+IVFFLAT_INDEX = "simple_embeddings_embedding_ivfflat"
+
+SCOPE_PODCAST = "podcast"
+SCOPE_EPISODE = "episode"
+
+ALL_PODCASTS = "all"
+DEFAULT_PODCASTID = 1
+
+# must match the configuration of the chunk_tsv column in create_tables.sql
+TEXT_SEARCH_CONFIG = "english"
+
+DEFAULT_K = 5
+MAX_K = 20
+# constant of reciprocal-rank fusion; 60 is the value from the original paper
+RRF_K = 60
+# each search returns this many times k candidates for the fusion
+DEFAULT_CANDIDATES = 4
+
+
+class HybridParams(NamedTuple):
+    k: int = DEFAULT_K
+    vector_weight: float = 1.0
+    lexical_weight: float = 1.0
+
+
+def distance_operator(model=EMBEDDING_MODEL):
+    return DISTANCE_OPERATORS.get(model, DEFAULT_DISTANCE_OPERATOR)[0]
+
+
+def search_settings(config):
+    """Read the ANN tuning knobs from the optional config.json keys."""
+    return {
+        "ef_search": config.get("VECTOR_EF_SEARCH"),
+        "probes": config.get("VECTOR_PROBES"),
+        "iterative_scan": config.get("VECTOR_ITERATIVE_SCAN"),
+    }
+
+
+def podcast_ids(value, default=DEFAULT_PODCASTID):
+    """
+    Parse the `pid` request parameter: one podcast ID, a comma-separated list
+    or "all". Returns a sorted list of IDs, or None for all podcasts. Raises
+    ValueError on bad input.
+    """
+    if value is None or value == "":
+        return [default]
+    if value == ALL_PODCASTS:
+        return None
+    return sorted({int(part) for part in value.split(",")})
+
+
+def podcast_condition(podcastids):
+    """
+    The WHERE condition on `podcastid`. IDs are inlined rather than bound: a
+    partial per-podcast index is only used when the planner sees the constant.
+    """
+    if podcastids is None:
+        return "TRUE"
+    if isinstance(podcastids, int):
+        podcastids = [podcastids]
+    ids = sorted({int(podcastid) for podcastid in podcastids})
+    if not ids:
+        raise ValueError("no podcast to search")
+    if len(ids) == 1:
+        return f"podcastid = {ids[0]}"
+    return f"podcastid IN ({', '.join(str(i) for i in ids)})"
+
+
+def hybrid_params(args, config):
+    """
+    Parse the `k`, `vector_weight` and `lexical_weight` request parameters, with
+    defaults from the optional `RAG_K`, `HYBRID_VECTOR_WEIGHT` and
+    `HYBRID_LEXICAL_WEIGHT` config keys. Raises ValueError on bad input.
+    """
+    k = int(args.get("k", config.get("RAG_K", DEFAULT_K)))
+    if not 1 <= k <= MAX_K:
+        raise ValueError(f"k must be between 1 and {MAX_K}")
+
+    vector_weight = float(
+        args.get("vector_weight", config.get("HYBRID_VECTOR_WEIGHT", 1.0))
+    )
+    lexical_weight = float(
+        args.get("lexical_weight", config.get("HYBRID_LEXICAL_WEIGHT", 1.0))
+    )
+    weights = (vector_weight, lexical_weight)
+    if any(not math.isfinite(w) or w < 0 for w in weights) or not any(weights):
+        raise ValueError("fusion weights must be non-negative and not both zero")
+
+    return HybridParams(k, vector_weight, lexical_weight)
+
+
+def candidate_count(k, config):
+    """How many chunks each search contributes to the fusion."""
+    return k * int(config.get("HYBRID_CANDIDATES", DEFAULT_CANDIDATES))
+
+
+def settings_queries(ef_search=None, probes=None, iterative_scan=None):
+    """
+    Statements that tune the ANN indexes for the current transaction.
+    set_config(..., true) is used instead of SET LOCAL because it accepts
+    parameters with both psycopg2 and psycopg 3.
+    """
+    queries = []
+    if ef_search is not None:
+        queries.append(
+            (
+                "SELECT set_config('hnsw.ef_search', %s, true);",
+                (str(int(ef_search)),),
+            )
+        )
+    if probes is not None:
+        queries.append(
+            ("SELECT set_config('ivfflat.probes', %s, true);", (str(int(probes)),))
+        )
+    if iterative_scan is not None:
+        # pgvector 0.8+: keep scanning the index until enough rows pass the filters
+        queries.append(
+            (
+                "SELECT set_config('hnsw.iterative_scan', %s, true);",
+                (str(iterative_scan),),
+            )
+        )
+    return queries
+
+
+def similar_chunks_query(
+    embedding,
+    k=5,
+    podcastids=DEFAULT_PODCASTID,
+    episodeid=None,
+    scope=SCOPE_PODCAST,
+    model=EMBEDDING_MODEL,
+):
+    """
+    Return (query, params) selecting the `k` nearest chunks as rows of
+    (episodeid, title, timecode, chunk, podcastid, id), closest first.
+    `podcastids` is one ID, a list of IDs or None for all podcasts.
+    """
+    op = distance_operator(model)
+    vector = str(embedding)
+    podcasts = podcast_condition(podcastids)
+
+    if scope == SCOPE_EPISODE and episodeid is not None:
+        # exact scan of one episode's chunks, found through the btree index;
+        # MATERIALIZED keeps the planner from walking the global ANN index
+        query = f"""
+            WITH candidates AS MATERIALIZED (
+                SELECT id, podcastid, episodeid, timecode, chunk,
+                       embedding {op} %s::vector AS distance
+                FROM simple_embeddings
+                WHERE {podcasts} AND episodeid = %s
+            )
+            SELECT episodes.episodeid, episodes.title, candidates.timecode,
+                   candidates.chunk, episodes.podcastid, candidates.id
+            FROM candidates
+            JOIN episodes
+            ON candidates.episodeid = episodes.episodeid AND candidates.podcastid = episodes.podcastid
+            ORDER BY candidates.distance
+            LIMIT %s;
+            """
+        return query, (vector, int(episodeid), k)
+
+    # the inner ORDER BY ... LIMIT is what the ANN index answers; the join to
+    # episodes only happens for the k rows that come out of it
+    query = f"""
+        SELECT episodes.episodeid, episodes.title, nearest.timecode, nearest.chunk,
+               episodes.podcastid, nearest.id
+        FROM (
+            SELECT id, podcastid, episodeid, timecode, chunk,
+                   embedding {op} %s::vector AS distance
+            FROM simple_embeddings
+            WHERE {podcasts}
+            ORDER BY embedding {op} %s::vector
+            LIMIT %s
+        ) AS nearest
+        JOIN episodes
+        ON nearest.episodeid = episodes.episodeid AND nearest.podcastid = episodes.podcastid
+        ORDER BY nearest.distance;
+        """
+    return query, (vector, vector, k)
+
+
+def lexical_chunks_query(
+    text, k=5, podcastids=DEFAULT_PODCASTID, episodeid=None, scope=SCOPE_PODCAST
+):
+    """
+    Return (query, params) selecting the `k` chunks that best match the words
+    of `text` as rows of (episodeid, title, timecode, chunk, podcastid, id),
+    best first.
+    """
+    # plainto_tsquery ANDs the words of the question, which few chunks
+    # satisfy; OR them instead and let ts_rank_cd favour chunks matching more
+    words = (
+        f"SELECT replace(plainto_tsquery('{TEXT_SEARCH_CONFIG}', %s)::text, '&', '|')"
+        "::tsquery AS question"
+    )
+    params = [text]
+    episode_filter = ""
+    if scope == SCOPE_EPISODE and episodeid is not None:
+        episode_filter = "AND episodeid = %s"
+        params.append(int(episodeid))
+    params.append(k)
+
+    query = f"""
+        SELECT episodes.episodeid, episodes.title, matches.timecode, matches.chunk,
+               episodes.podcastid, matches.id
+        FROM (
+            SELECT id, podcastid, episodeid, timecode, chunk,
+                   ts_rank_cd(chunk_tsv, question) AS rank
+            FROM simple_embeddings, ({words}) AS words
+            WHERE {podcast_condition(podcastids)} {episode_filter}
+            AND chunk_tsv @@ question
+            ORDER BY rank DESC
+            LIMIT %s
+        ) AS matches
+        JOIN episodes
+        ON matches.episodeid = episodes.episodeid AND matches.podcastid = episodes.podcastid
+        ORDER BY matches.rank DESC;
+        """
+    return query, tuple(params)
+
+
+def rrf_fuse(rankings, weights, k=DEFAULT_K, rrf_k=RRF_K):
+    """
+    Merge ranked lists of chunk rows with weighted reciprocal-rank fusion:
+    a row scores sum(weight / (rrf_k + rank)) over the lists it appears in.
+    Returns the `k` best rows.
+    """
+    scores = {}
+    # chunk id -> the row, as the first ranking that found it returned it
+    rows_by_id = {}
+    for rows, weight in zip(rankings, weights):
+        for rank, row in enumerate(rows, start=1):
+            # rows end with the chunk id; hashing the whole row would hash
+            # the chunk text too
+            id = row[5]
+            rows_by_id.setdefault(id, row)
+            scores[id] = scores.get(id, 0.0) + weight / (rrf_k + rank)
+
+    fused = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    return [rows_by_id[id] for id, _ in fused[:k]]
+
+
+def search_chunks(
+    cursor,
+    embedding,
+    k=5,
+    podcastids=DEFAULT_PODCASTID,
+    episodeid=None,
+    scope=None,
+    settings=None,
+):
+    for query, params in settings_queries(**(settings or {})):
+        cursor.execute(query, params)
+
+    query, params = similar_chunks_query(
+        embedding, k, podcastids, episodeid, scope or SCOPE_PODCAST
+    )
+    cursor.execute(query, params)
+
+    return cursor.fetchall()
+
+
+def search_lexical_chunks(
+    cursor, text, k=5, podcastids=DEFAULT_PODCASTID, episodeid=None, scope=None
+):
+    query, params = lexical_chunks_query(
+        text, k, podcastids, episodeid, scope or SCOPE_PODCAST
+    )
+    cursor.execute(query, params)
+
+    return cursor.fetchall()
+
+
+def ivfflat_lists(rows):
+    # pgvector's guidance: rows / 1000 up to 1M rows, sqrt(rows) above that
+    if rows <= 1_000_000:
+        return max(10, rows // 1000)
+    return int(math.sqrt(rows))
+
+
+def create_vector_index(
+    conn, kind="hnsw", model=EMBEDDING_MODEL, m=16, ef_construction=64, podcastid=None
+):
+    """
+    (Re)build the ANN index on simple_embeddings.embedding without blocking
+    writers, and drop the index of the other kind. Rebuilding an IVFFlat index
+    after a large ingest recomputes its lists from the current data. With a
+    `podcastid`, the index is partial and only covers that podcast's chunks.
+    """
+    opclass = DISTANCE_OPERATORS.get(model, DEFAULT_DISTANCE_OPERATOR)[1]
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    conn.autocommit = True
+    cursor = conn.cursor()
+
+    suffix = ""
+    where = ""
+    if podcastid is not None:
+        suffix = f"_p{int(podcastid)}"
+        where = f" WHERE {podcast_condition(podcastid)}"
+
+    if kind == "hnsw":
+        name, other = HNSW_INDEX + suffix, IVFFLAT_INDEX + suffix
+        using = (
+            f"hnsw (embedding {opclass}) "
+            f"WITH (m = {int(m)}, ef_construction = {int(ef_construction)})"
+        )
+    elif kind == "ivfflat":
+        cursor.execute(f"SELECT count(*) FROM simple_embeddings{where};")
+        lists = ivfflat_lists(cursor.fetchone()[0])
+        name, other = IVFFLAT_INDEX + suffix, HNSW_INDEX + suffix
+        using = f"ivfflat (embedding {opclass}) WITH (lists = {lists})"
+    else:
+        raise ValueError(f"unknown vector index kind {kind!r}")
+
+    # build the replacement next to the current index so searches never run
+    # without one, then swap it in
+    cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}_new;")
+    cursor.execute(
+        f"CREATE INDEX CONCURRENTLY {name}_new ON simple_embeddings "
+        f"USING {using}{where};"
+    )
+    cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+    cursor.execute(f"ALTER INDEX {name}_new RENAME TO {name};")
+    cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {other};")
+    cursor.execute("ANALYZE simple_embeddings;")
+    cursor.close()
+
+
+# create or rebuild the ANN index
+if __name__ == "__main__":
+    from providers import get_config
+
+    if len(sys.argv) < 3 or sys.argv[1] != "index":
+        print("usage: python ./retrieval.py index hnsw|ivfflat [podcastid ...]")
+        sys.exit(1)
+
+    conn = psycopg2.connect(**connect_kwargs(get_config()))
+    try:
+        # the global index, or one partial index per given podcast
+        for podcastid in [int(p) for p in sys.argv[3:]] or [None]:
+            create_vector_index(conn, sys.argv[2], podcastid=podcastid)
+    finally:
+        conn.close()
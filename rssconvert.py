@@ -1,89 +1,375 @@
-import json
+"""
+Loads podcast episodes from an RSS feed into the episodes table.
+
+Items are read one at a time by feed_reader.py and staged in a temp table in
+batches while the feed is parsed, so memory stays flat for any feed size. A
+full load numbers the feed's items from the oldest (episode 1) to the newest
+and upserts all of them in one statement on (podcastid, episodeid), so it can
+be re-run without duplicating episodes. An incremental sync refreshes the
+feeds registered in the `feeds` table: the download is conditional on the
+ETag / Last-Modified of the previous sync, reading stops at the last synced
+item, and only items whose guid is not known yet are written, numbered after
+the newest episode.
+
+Usage:
+------
+```sh
+python ./rssconvert.py <podcastid> <rss file or feed url>
+python ./rssconvert.py --sync [--concurrency 8] [podcastid ...]
+```
+A full load from a URL registers the feed for incremental syncs.
+"""
+
+import argparse
+import logging
 import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from psycopg2.extras import execute_values
+
+from cache_events import notify_podcast_changed
+from feed_reader import UnsupportedFeed, iter_items
+from providers import get_db_pool
+
+# items are staged in batches as they are parsed, then upserted in one statement
+CREATE_STAGING_QUERY = """
+    CREATE TEMP TABLE feed_items (
+        position INT NOT NULL,
+        title VARCHAR(255) NOT NULL,
+        summary TEXT,
+        url VARCHAR(255),
+        authors VARCHAR(50),
+        published DATE,
+        duration INTERVAL,
+        guid TEXT
+    ) ON COMMIT DROP;
+    """
+STAGE_ITEMS_QUERY = """
+    INSERT INTO feed_items
+        (position, title, summary, url, authors, published, duration, guid)
+    VALUES %s;
+    """
+
+# position 0 is the newest item and gets the highest episode ID. A row that
+# already holds another item (its guid differs) is left alone: its transcript,
+# embeddings and questions belong to that item
+UPSERT_EPISODES_QUERY = """
+    INSERT INTO episodes (podcastid, episodeid, title, summary, url, authors,
+        published, duration, guid, questions, transcribed)
+    SELECT %s, %s - position, title, summary, url, authors,
+        published, duration, guid, NULL, FALSE
+    FROM feed_items
+    ON CONFLICT (podcastid, episodeid) DO UPDATE
+    SET title = EXCLUDED.title, summary = EXCLUDED.summary, url = EXCLUDED.url,
+        authors = EXCLUDED.authors, published = EXCLUDED.published,
+        duration = EXCLUDED.duration, guid = EXCLUDED.guid
+    WHERE (episodes.guid IS NULL OR episodes.guid = EXCLUDED.guid)
+    AND (episodes.title, episodes.summary, episodes.url, episodes.authors,
+           episodes.published, episodes.duration, episodes.guid)
+    IS DISTINCT FROM
+          (EXCLUDED.title, EXCLUDED.summary, EXCLUDED.url, EXCLUDED.authors,
+           EXCLUDED.published, EXCLUDED.duration, EXCLUDED.guid);
+    """
+# staged items whose episode ID is taken by a different item
+GUID_CONFLICTS_QUERY = """
+    SELECT episodes.episodeid, episodes.guid, feed_items.guid
+    FROM feed_items
+    JOIN episodes
+    ON episodes.podcastid = %s AND episodes.episodeid = %s - feed_items.position
+    WHERE episodes.guid IS NOT NULL
+    AND episodes.guid IS DISTINCT FROM feed_items.guid
+    ORDER BY episodes.episodeid;
+    """
+
+UPSERT_FEED_QUERY = """
+    INSERT INTO feeds
+        (podcastid, feed_url, etag, last_modified, last_guid, synced_at)
+    VALUES (%s, %s, %s, %s, %s, now())
+    ON CONFLICT (podcastid) DO UPDATE
+    SET feed_url = EXCLUDED.feed_url, etag = EXCLUDED.etag,
+        last_modified = EXCLUDED.last_modified,
+        last_guid = COALESCE(EXCLUDED.last_guid, feeds.last_guid),
+        synced_at = now();
+    """
+
+PAGE_SIZE = 500
+DEFAULT_CONCURRENCY = 8
+FETCH_TIMEOUT = 30
+# A good default from "Advanced Selling Podcast" :-)
+DEFAULT_AUTHORS = "Bill Caskey and Bryan Neale"
 
-import feedparser
-import psycopg2
-from psycopg2 import sql
 
+def item_guid(item):
+    # feedparser exposes <guid> as `id`; fall back to the page link
+    return item.get("id") or item.get("link")
 
-def write_to_postgresql(pid, items):
-    # Read configuration from JSON file
-    with open("config.json") as config_file:
-        config = json.load(config_file)
 
-    connection_string = f"dbname='{config["DBNAME"]}' user='{config["USER"]}' host='{config["HOST"]}' password='{config["PASS"]}' port='{config["PORT"]}'"
+def item_authors(item):
+    # the newest item's author is used for the whole feed
+    if item is not None and "author" in item.keys():
+        return item["author"]
+    return DEFAULT_AUTHORS
 
-    # Connect to the PostgreSQL database
-    conn = psycopg2.connect(connection_string)
-    cursor = conn.cursor()
 
-    # Prepare and execute an SQL INSERT statement
-    insert_query = sql.SQL(
-        "INSERT INTO episodes (podcastid, episodeid, title, summary, url, authors, published, duration, questions, transcribed, transcript) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NULL, FALSE, NULL);"
-    ).format(
-        sql.Identifier("episodes")  # Replace with the actual table name
+def episode_fields(item, authors):
+    return (
+        item["title"],
+        item["summary"],
+        item["links"][1]["href"] if len(item["links"]) > 1 else "",
+        authors,
+        item.get("published"),
+        (
+            item["itunes_duration"]
+            if "itunes_duration" in item.keys()
+            else "0 seconds"
+        ),
+        item_guid(item),
     )
 
-    running_eid = len(items)
-    authors = "Bill Caskey and Bryan Neale"  # A good default from "Advanced Selling Podcast" :-)
 
-    if len(items) > 0 and "author" in items[0].keys():
-        authors = items[0]["author"]
+def read_items(source, fallback):
+    """
+    Stream the items of the RSS feed in `source` (a file name or a binary
+    stream). Feeds in other formats are read with feedparser from `fallback`.
+    """
+    try:
+        yield from iter_items(source)
+    except UnsupportedFeed:
+        # only imported for the rare feed the streaming reader cannot handle
+        import feedparser
+
+        yield from feedparser.parse(fallback)["items"]
+
+
+def fetch_feed(feed_url, etag=None, modified=None):
+    """Start a conditional download; None when the feed has not changed."""
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if modified:
+        headers["If-Modified-Since"] = modified
+
+    response = requests.get(
+        feed_url, headers=headers, stream=True, timeout=FETCH_TIMEOUT
+    )
+    if response.status_code == 304:
+        response.close()
+        return None
+    response.raise_for_status()
+    response.raw.decode_content = True
+    return response
 
+
+def stage_items(cursor, items, batch_size=PAGE_SIZE):
+    """
+    Copy `items` (newest first) into the feed_items temp table as they are
+    read. Returns the number of items and the first one.
+    """
+    cursor.execute(CREATE_STAGING_QUERY)
+    count = 0
+    first = None
+    authors = None
+    batch = []
     for item in items:
-        entry = {
-            "podcastid": pid,
-            "episodeid": running_eid,
-            "title": item["title"],
-            "summary": item["summary"],
-            "url": item["links"][1]["href"] if len(item["links"]) > 1 else "",
-            "authors": authors,
-            "published": item["published"],
-            "duration": (
-                item["itunes_duration"]
-                if "itunes_duration" in item.keys()
-                else "0 seconds"
-            ),
-        }
-        cursor.execute(insert_query, tuple(entry.values()))
-
-        running_eid -= 1
-
-    # Commit the transaction and close the connection
-    conn.commit()
-    cursor.close()
-    conn.close()
+        if first is None:
+            first = item
+            authors = item_authors(item)
+        batch.append((count, *episode_fields(item, authors)))
+        count += 1
+        if len(batch) >= batch_size:
+            execute_values(cursor, STAGE_ITEMS_QUERY, batch, page_size=batch_size)
+            batch = []
+    if batch:
+        execute_values(cursor, STAGE_ITEMS_QUERY, batch, page_size=batch_size)
+    return count, first
+
+
+def upsert_episodes(cursor, pid, newest):
+    """Upsert the staged items, with `newest` as the first item's episode ID."""
+    cursor.execute(GUID_CONFLICTS_QUERY, (pid, newest))
+    conflicts = cursor.fetchall()
+    if conflicts:
+        # a truncated or reordered feed; numbering it would relabel episodes
+        logging.warning(
+            f"Podcast {pid}: {len(conflicts)} items not written, their episode "
+            f"IDs hold other items (episodeid, stored guid, feed guid): "
+            f"{conflicts[:10]}"
+        )
+    cursor.execute(UPSERT_EPISODES_QUERY, (pid, newest))
+    if cursor.rowcount > 0:
+        notify_podcast_changed(cursor, pid)
+
+
+def write_to_postgresql(pid, items, pool=None, feed=None):
+    """
+    Upsert `items` (any iterable, newest first as in the feed) with episode IDs
+    counting up from the oldest. `feed` is an optional (url, etag, modified) to
+    record for incremental syncs. Returns the number of items.
+    """
+    if pool is None:
+        pool = get_db_pool()
+
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        count, first = stage_items(cursor, items)
+        upsert_episodes(cursor, pid, count)
+        if feed is not None:
+            last_guid = item_guid(first) if first is not None else None
+            cursor.execute(UPSERT_FEED_QUERY, (pid, *feed, last_guid))
+        cursor.close()
+
+    return count
+
+
+def sync_feed(pool, pid, feed_url, etag=None, modified=None, last_guid=None):
+    """
+    Fetch one registered feed and write its new items. Returns the number of
+    episodes written.
+    """
+    response = fetch_feed(feed_url, etag, modified)
+    if response is None:
+        logging.info(f"Podcast {pid}: not modified")
+        with pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE feeds SET synced_at = now() WHERE podcastid = %s;", (pid,)
+            )
+            cursor.close()
+        return 0
+
+    with response:
+        feed = (
+            feed_url,
+            response.headers.get("ETag"),
+            response.headers.get("Last-Modified"),
+        )
+        items = read_items(response.raw, feed_url)
+        if last_guid is None:
+            # never synced: number the whole feed, which also backfills the
+            # guids of episodes loaded before guids were recorded
+            return write_to_postgresql(pid, items, pool, feed)
+
+        # items are newest first; stop reading (and downloading) at the last
+        # synced one
+        new_items = []
+        latest = None
+        for item in items:
+            guid = item_guid(item)
+            latest = latest or guid
+            if guid == last_guid:
+                break
+            new_items.append(item)
+
+    if latest is None:
+        logging.warning(f"Podcast {pid}: no items in {feed_url}")
+        return 0
+
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            SELECT guid FROM episodes
+            WHERE podcastid = %s AND guid = ANY(%s);
+            """,
+            (pid, [item_guid(item) for item in new_items]),
+        )
+        known = {row[0] for row in cursor.fetchall()}
+        new_items = [item for item in new_items if item_guid(item) not in known]
+
+        cursor.execute(
+            "SELECT COALESCE(MAX(episodeid), 0) FROM episodes WHERE podcastid = %s;",
+            (pid,),
+        )
+        newest = cursor.fetchone()[0]
+
+        count, _ = stage_items(cursor, new_items)
+        upsert_episodes(cursor, pid, newest + count)
+        cursor.execute(UPSERT_FEED_QUERY, (pid, *feed, latest))
+        cursor.close()
+
+    logging.info(f"Podcast {pid}: {count} new episodes")
+    return count
+
+
+def sync_feeds(pool, podcastids=None, concurrency=DEFAULT_CONCURRENCY):
+    """Incrementally sync the registered feeds (all by default) in parallel."""
+    query = "SELECT podcastid, feed_url, etag, last_modified, last_guid FROM feeds"
+    params = ()
+    if podcastids:
+        query += " WHERE podcastid = ANY(%s)"
+        params = (list(podcastids),)
+
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(query + ";", params)
+        feeds = cursor.fetchall()
+        cursor.close()
+
+    written = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(sync_feed, pool, *feed): feed[0] for feed in feeds}
+        for future, pid in futures.items():
+            try:
+                written += future.result()
+            except Exception as e:
+                logging.error(f"Podcast {pid}: sync failed: {e}")
+
+    logging.info(f"Synced {len(feeds)} feeds, {written} new episodes")
+    return written
 
 
 def parse_write_rss_feed(podcastid, file_path):
     """
-    Reads an RSS or Atom feed from a specified file path, parses it using feedparser,
-    and prints out the items listed in the feed.
+    Reads an RSS feed from a specified file path or URL item by item and
+    upserts the items into the DB in batches as they are parsed. Atom and other
+    formats are parsed with feedparser.
 
     Args:
-        file_path (str): The path to the XML file containing the RSS or Atom feed.
+        file_path (str): The path to the XML file containing the feed, or the
+            URL of the feed.
 
     Returns:
         None
     """
-    # Read the RSS/Atom feed from the specified file path
-    rss_feed = feedparser.parse(file_path)
-
-    # Check if the parsed content has an 'items' key, which is typical for both RSS and Atom feeds
-    if "items" in rss_feed:
-        # Iterate through each item in the items list
-        # for item in rss_feed["items"]:
-        #     print(item)  # Print out each item
-        write_to_postgresql(podcastid, rss_feed["items"])
+    if file_path.startswith(("http://", "https://")):
+        response = fetch_feed(file_path)
+        with response:
+            feed = (
+                file_path,
+                response.headers.get("ETag"),
+                response.headers.get("Last-Modified"),
+            )
+            items = read_items(response.raw, file_path)
+            count = write_to_postgresql(podcastid, items, feed=feed)
     else:
+        count = write_to_postgresql(podcastid, read_items(file_path, file_path))
+
+    if count == 0:
         print("The feed does not contain any items.")
 
 
 # Example usage of the function with a sample RSS file path
 if __name__ == "__main__":
-    # Specify the path to your XML file here
-    podcastid = sys.argv[1]
-    xml_file_path = sys.argv[2]
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.INFO,
+        format="%(asctime)s %(message)s",
+    )
 
-    # Call the function to parse and print the feed items
-    parse_write_rss_feed(podcastid, xml_file_path)
+    parser = argparse.ArgumentParser(description="Load podcast episodes from RSS.")
+    parser.add_argument("--sync", action="store_true", help="sync registered feeds")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument(
+        "args", nargs="*", help="podcastid and rss file, or podcastids with --sync"
+    )
+    args = parser.parse_args()
+
+    if args.sync:
+        sync_feeds(get_db_pool(), [int(p) for p in args.args], args.concurrency)
+    elif len(args.args) == 2:
+        # Call the function to parse and write the feed items
+        parse_write_rss_feed(int(args.args[0]), args.args[1])
+    else:
+        parser.print_usage()
+        sys.exit(1)
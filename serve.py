@@ -0,0 +1,122 @@
+"""
+Production entry point for the podcast server.
+
+`python ./server.py` runs Werkzeug's development server in one process. This
+script serves the app with one worker process per core:
+
+- the Flask app (server.py) on gunicorn with `gthread` workers, each serving
+  up to `SERVER_THREADS` requests at a time,
+- with `--async`, the Quart app (async_server.py) on hypercorn with asyncio
+  workers.
+
+Each worker imports the app module and initializes it after it is started,
+so every worker opens its own connection pool, OpenAI client, caches and
+change listener. On SIGTERM or SIGINT a worker stops accepting connections. It lets
+the requests in flight finish, answer streams included, for up to
+`SERVER_GRACEFUL_TIMEOUT` seconds, then closes its database connections.
+
+Usage:
+------
+```sh
+python ./serve.py [--async] [--bind 0.0.0.0:5000] [--workers 8] [--threads 16]
+```
+The defaults come from the optional config.json keys `SERVER_BIND`,
+`SERVER_WORKERS` (the number of cores), `SERVER_THREADS` and
+`SERVER_GRACEFUL_TIMEOUT`. Every worker has its own pool of up to
+`POOL_MAX_SIZE` connections, so Postgres sees up to workers times that.
+"""
+
+import argparse
+import os
+import sys
+from typing import NamedTuple
+
+from providers import get_config
+
+DEFAULT_BIND = "0.0.0.0:5000"
+DEFAULT_THREADS = 16
+# long enough for an answer that has started streaming to finish
+DEFAULT_GRACEFUL_TIMEOUT = 120
+
+
+class ServerSettings(NamedTuple):
+    bind: str
+    workers: int
+    threads: int
+    graceful_timeout: float
+
+
+def server_settings(config, args):
+    """Command-line options, falling back to the `SERVER_*` config keys."""
+    return ServerSettings(
+        args.bind or config.get("SERVER_BIND", DEFAULT_BIND),
+        int(args.workers or config.get("SERVER_WORKERS", os.cpu_count() or 1)),
+        int(args.threads or config.get("SERVER_THREADS", DEFAULT_THREADS)),
+        float(config.get("SERVER_GRACEFUL_TIMEOUT", DEFAULT_GRACEFUL_TIMEOUT)),
+    )
+
+
+def close_worker(server, worker):
+    # gunicorn's worker_exit hook: runs after the worker drained its requests
+    app_module = sys.modules.get("server")
+    if app_module is not None and app_module.pool is not None:
+        app_module.pool.close()
+
+
+def run_flask(settings):
+    from gunicorn.app.base import BaseApplication
+
+    class FlaskApplication(BaseApplication):
+        def load_config(self):
+            options = {
+                "bind": settings.bind,
+                "workers": settings.workers,
+                "worker_class": "gthread",
+                "threads": settings.threads,
+                "graceful_timeout": settings.graceful_timeout,
+                # import the app in the workers, not in the master before fork
+                "preload_app": False,
+                "worker_exit": close_worker,
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from server import app, init_app
+
+            # in the worker, before its first request
+            init_app()
+            return app
+
+    FlaskApplication().run()
+
+
+def run_async(settings):
+    from hypercorn.config import Config
+    from hypercorn.run import run
+
+    config = Config()
+    # each worker is a new process that imports the app itself
+    config.application_path = "async_server:app"
+    config.bind = [settings.bind]
+    config.workers = settings.workers
+    config.graceful_timeout = settings.graceful_timeout
+    sys.exit(run(config))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the podcast server.")
+    parser.add_argument(
+        "--async", dest="use_async", action="store_true", help="serve async_server.py"
+    )
+    parser.add_argument("--bind")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--threads", type=int, help="threads per Flask worker")
+    args = parser.parse_args()
+
+    settings = server_settings(get_config(), args)
+
+    if args.use_async:
+        run_async(settings)
+    else:
+        run_flask(settings)
@@ -16,48 +16,149 @@ release date.
 """
 
 import json
-from enum import Enum
-from string import Template
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import psycopg2
-from flask import Flask, Response, jsonify, render_template, request
+from flask import Flask, Response, g, jsonify, render_template, request, url_for
 from flask_cors import CORS
-from openai import AzureOpenAI
-from psycopg2 import sql
 
-from data_repository import DataRepository
+from answer_cache import create_answer_cache, prompt_key
+from ask import (
+    chat_messages,
+    episode_tags,
+    fulltext_prompt,
+    fuse,
+    indexed_embeddings,
+    parse_ask_request,
+    plan_retrieval,
+    summary_episodes,
+    system_prompt_tokens,
+)
+from cache_events import EpisodeChangeListener
+from context_builder import (
+    count_tokens,
+    excerpt_context,
+    fulltext_settings,
+    whole_transcript,
+)
+from data_repository import DataRepository, episode_filters
+from db_pool import connect_kwargs
+from embedding_cache import create_embedding_cache
+from episode_cache import create_episode_cache
+from metrics import (
+    ANSWER_SECONDS,
+    COMPLETION_TOKENS,
+    CONTENT_TYPE,
+    FIRST_TOKEN_SECONDS,
+    HTTP_SECONDS,
+    PROMPT_TOKENS,
+    REGISTRY,
+    span,
+    traced,
+)
+from prompts import (
+    CHAT_MODEL,
+    EMBEDDING_MODEL,
+    SYSTEM_PROMPT,
+    rag_user_prompt,
+    summary_user_prompt,
+)
+from providers import get_config, get_db_pool, get_openai_client
+from rerank import RERANKERS, create_reranker, default_reranker, rerank
+from retrieval import (
+    SCOPE_EPISODE,
+    HybridParams,
+    search_chunks,
+    search_lexical_chunks,
+    search_settings,
+)
+from timings import StageTimings
+from vector_index import create_memory_index
 
 app = Flask(__name__)
-CORS(app, origins=["http://localhost:5000"])
-app.config.from_file("config.json", load=json.load)
-client = AzureOpenAI(
-    api_key=app.config["LLM_API_KEY"],
-    api_version=app.config["LLM_API_VERSION"],
-    azure_endpoint=app.config["LLM_TARGET_URI"],
+CORS(
+    app,
+    origins=["http://localhost:5000"],
+    expose_headers=["Link", "X-Prompt-Tokens", "Server-Timing"],
 )
-db_repo_config = {
-    "DB_NAME": app.config["DBNAME"],
-    "DB_HOST": app.config["HOST"],
-    "DB_USER": app.config["USER"],
-    "DB_PASSWORD": app.config["PASS"],
-    "DB_PORT": app.config["PORT"],
-}
-
-
-class EpisodeAttributes(Enum):
-    ID = 0
-    PODCASTID = 1
-    EPISODEID = 2
-    TITLE = 3
-    SUMMARY = 4
-    URL = 5
-    AUTHORS = 6
-    PUBLISHED = 7
-    DURATION = 8
-    QUESTIONS = 9
-    TRANSCRIBED = 10
-    TRANSCRIPT = 11
-    TRANSCRIPTTEXT = 12
+# built by init_app on the first request rather than on import, so the module
+# imports without config.json or a database (a gunicorn master, a benchmark)
+pool = None
+db_repo = None
+embedding_cache = None
+answer_cache = None
+episode_cache = None
+vector_settings = None
+# None unless VECTOR_ENGINE is "memory"; the vector search then runs in process
+memory_index = None
+fulltext_budget = fulltext_spans = None
+rerankers = None
+# runs the lexical half of hybrid searches next to the vector half
+lexical_executor = None
+_initialized = False
+_init_lock = threading.Lock()
+
+
+def init_app():
+    """Read the config and open the pool, caches, index and change listener."""
+    global pool, db_repo, embedding_cache, answer_cache, episode_cache
+    global vector_settings, memory_index, fulltext_budget, fulltext_spans
+    global rerankers, lexical_executor, _initialized
+    with _init_lock:
+        if _initialized:
+            return
+        # PODCAST_CONFIG overrides the path, e.g. for benchmarks/load.py
+        app.config.from_mapping(get_config())
+        pool = get_db_pool()
+        db_repo = DataRepository(pool)
+        embedding_cache = create_embedding_cache(app.config, pool)
+        answer_cache = create_answer_cache(app.config)
+        episode_cache = create_episode_cache(app.config)
+        vector_settings = search_settings(app.config)
+        memory_index = create_memory_index(app.config, pool)
+        app.config.setdefault("RERANKER", default_reranker(memory_index))
+        fulltext_budget, fulltext_spans = fulltext_settings(app.config)
+        rerankers = {name: create_reranker(name, app.config) for name in RERANKERS}
+        lexical_executor = ThreadPoolExecutor(
+            max_workers=int(app.config.get("POOL_MAX_SIZE", 10)),
+            thread_name_prefix="lexical-search",
+        )
+
+        # drop cached answers and episode responses when an ingest script writes
+        change_callbacks = [answer_cache.invalidate_episode, episode_cache.invalidate]
+        if memory_index is not None:
+            change_callbacks.append(memory_index.refresh)
+        EpisodeChangeListener(connect_kwargs(app.config), change_callbacks).start()
+
+        # cache hit rates and pool occupancy, as gauges on /metrics
+        REGISTRY.register_stats("podcast_embedding_cache", embedding_cache.stats)
+        REGISTRY.register_stats("podcast_answer_cache", answer_cache.stats)
+        REGISTRY.register_stats("podcast_episode_cache", episode_cache.stats)
+        REGISTRY.register_stats("podcast_db_pool", pool.stats)
+        if memory_index is not None:
+            REGISTRY.register_stats("podcast_vector_index", memory_index.stats)
+        _initialized = True
+
+
+@app.before_request
+def ensure_initialized():
+    if not _initialized:
+        init_app()
+
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def record_latency(response):
+    # streamed answers are measured separately, until their last token
+    HTTP_SECONDS.observe(
+        time.perf_counter() - g.started, str(request.endpoint), response.status_code
+    )
+    return response
 
 
 @app.route("/")
@@ -85,170 +186,285 @@ A JSON response containing details of each podcast, including title, host, and r
 """
 
 
-@app.route("/podcasts/<pid>/episodes", methods=["GET"])
+@app.route("/podcasts/<int:pid>/episodes", methods=["GET"])
 def get_all_episodes(pid):
-    # retrieve all episode details from the DB
-    episodes = DataRepository(db_repo_config).get_episodes(pid)
-    return jsonify(episodes)
-
-
-@app.route("/podcasts/<pid>/episodes/<int:eid>", methods=["GET"])
-def get_episode(pid, eid):
-    # retrieve the episode details with the ID from the DB
-    episode = DataRepository(db_repo_config).get_episode(pid, eid)
-    return jsonify(episode)
-
-
-def select_from_episodes_with_episodeid(episodeid):
-    # Read configuration from JSON file
-    connection_string = f"dbname='{app.config["DBNAME"]}' user='{app.config["USER"]}' password='{app.config["PASS"]}' host='{app.config["HOST"]}' port='{app.config["PORT"]}'"
-    print(connection_string)
-
-    # Connect to the PostgreSQL database
-    conn = psycopg2.connect(connection_string)
-    cursor = conn.cursor()
+    try:
+        filters = episode_filters(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    key = ("episodes", pid, filters)
+    cached = episode_cache.get(pid, key)
+    if cached is None:
+        version = episode_cache.version(pid)
+        # retrieve one page of episode details from the DB
+        episodes, next_after = db_repo.get_episodes(pid, filters)
+        headers = {}
+        if next_after is not None:
+            # the next page keeps the same filters
+            args = {**request.args.to_dict(), "after": next_after}
+            headers["Link"] = (
+                f'<{url_for("get_all_episodes", pid=pid, **args)}>; rel="next"'
+            )
+        body = json.dumps(episodes).encode("utf-8")
+        cached = episode_cache.put(pid, key, version, body, headers)
 
-    # Prepare and execute an SQL SELECT statement
-    select_query = sql.SQL(
-        "SELECT * FROM episodes WHERE podcastid=1 AND episodeid = %s;"
-    ).format(sql.Identifier("episodes"))
+    # 304 when the client's ETag / Last-Modified is still current
+    return episode_cache.respond(Response, cached, request.headers)
 
-    cursor.execute(select_query, (episodeid,))
 
-    # Fetch and print the result of the SELECT statement
-    result = cursor.fetchall()
+@app.route("/podcasts/<int:pid>/episodes/<int:eid>", methods=["GET"])
+def get_episode(pid, eid):
+    key = ("episode", pid, eid)
+    cached = episode_cache.get(pid, key)
+    if cached is None:
+        version = episode_cache.version(pid)
+        # retrieve the episode details with the ID from the DB
+        episode = db_repo.get_episode(pid, eid)
+        if episode is None:
+            return jsonify({"error": "episode not found"}), 404
+        body = json.dumps(episode).encode("utf-8")
+        cached = episode_cache.put(pid, key, version, body)
+
+    return episode_cache.respond(Response, cached, request.headers)
+
+
+@app.route("/stats/db", methods=["GET"])
+def get_db_stats():
+    # connection pool occupancy and acquire latency for this process
+    return jsonify(pool.stats())
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    # Prometheus text format: stage latencies, token counts and cache stats
+    return Response(REGISTRY.render(), mimetype=CONTENT_TYPE)
+
+
+@app.route("/stats/cache", methods=["GET"])
+def get_cache_stats():
+    # hit rates of the in-process caches
+    return jsonify(
+        {
+            "embeddings": embedding_cache.stats(),
+            "answers": answer_cache.stats(),
+            "episodes": episode_cache.stats(),
+            "vector_index": memory_index.stats() if memory_index else None,
+        }
+    )
 
-    # Close the cursor and the connection
-    cursor.close()
-    conn.close()
 
-    return result[0]
+def select_lexical(text, k, podcastids, episodeid=None, scope=None, timings=None):
+    with span("lexical", timings), pool.connection() as conn:
+        cursor = conn.cursor()
+        results = search_lexical_chunks(
+            cursor, text, k, podcastids, episodeid, scope
+        )
+        cursor.close()
 
+    return results
 
-def select_embeddings(text):
 
-    # Generate embedding from the input text
-    embedding = (
-        client.embeddings.create(input=[text], model="text-embedding-ada-002")
-        .data[0]
-        .embedding
-    )
+@traced("select_embeddings")
+def select_embeddings(
+    text,
+    podcastids,
+    episodeid=None,
+    scope=None,
+    params=HybridParams(),
+    reranking=None,
+    timings=None,
+):
+    """
+    The top `params.k` chunks for `text`. With `reranking` (RerankSettings),
+    `reranking.candidates` chunks are fused and reranked down to k.
+    """
+    timings = timings if timings is not None else StageTimings()
+    plan = plan_retrieval(params, reranking, rerankers, app.config)
+    candidates = plan.candidates
+
+    # the lexical search does not need the embedding, so it runs while the
+    # question is embedded and the vector search runs
+    lexical = None
+    if params.lexical_weight > 0:
+        lexical = lexical_executor.submit(
+            select_lexical, text, candidates, podcastids, episodeid, scope, timings
+        )
 
-    # Read configuration from JSON file
-    connection_string = f"dbname='{app.config["DBNAME"]}' user='{app.config["USER"]}' password='{app.config["PASS"]}' host='{app.config["HOST"]}' port='{app.config["PORT"]}'"
-
-    # Connect to the PostgreSQL database
-    conn = psycopg2.connect(connection_string)
-    cursor = conn.cursor()
-
-    # Construct the SQL query with a join
-    select_query = """
-                   SELECT episodes.episodeid, episodes.title, simple_embeddings.timecode, simple_embeddings.chunk
-                   FROM simple_embeddings
-                   JOIN episodes
-                   ON simple_embeddings.episodeid = episodes.episodeid AND simple_embeddings.podcastid = episodes.podcastid
-                   WHERE episodes.podcastid = 1
-                   ORDER BY embedding <-> %s
-                   LIMIT %s
-                   """
-
-    cursor.execute(
-        select_query,
-        (
-            str(embedding),
-            5,
-        ),
-    )
+    embedding = None
+    if params.vector_weight > 0 or plan.reranker is not None:
+        # Generate embedding from the input text, unless it is already cached
+        with timings.stage("embed"):
+            embedding = embedding_cache.get_or_create(
+                get_openai_client(), EMBEDDING_MODEL, text
+            )
 
-    # Fetch and print the result of the SELECT statement
-    results = cursor.fetchall()
+    vector_results = []
+    if params.vector_weight > 0 and memory_index is not None:
+        with timings.stage("vector"):
+            vector_results = memory_index.search(
+                embedding, candidates, podcastids, episodeid, scope
+            )
+    elif params.vector_weight > 0:
+        # Borrow a connection from the shared pool
+        with timings.stage("vector"), pool.connection() as conn:
+            cursor = conn.cursor()
+
+            # nearest chunks through the ANN index, or within one episode
+            vector_results = search_chunks(
+                cursor,
+                embedding,
+                candidates,
+                podcastids,
+                episodeid,
+                scope,
+                vector_settings,
+            )
 
-    # Close the cursor and the connection
-    cursor.close()
-    conn.close()
+            cursor.close()
+
+    lexical_results = lexical.result() if lexical is not None else []
+
+    with timings.stage("fusion"):
+        results = fuse(vector_results, lexical_results, params, plan)
+
+    if plan.reranker is not None:
+        with timings.stage("chunk_embeddings"):
+            embeddings, missing = indexed_embeddings(memory_index, results)
+            if missing:
+                embeddings.update(db_repo.get_chunk_embeddings(missing))
+        with timings.stage("rerank"):
+            results = rerank(
+                plan.reranker,
+                text,
+                embedding,
+                results,
+                embeddings,
+                params.k,
+                reranking.token_budget,
+            )
 
     return results
 
 
 @app.route("/ask", methods=["GET"])
 def ask():
-    question = request.args.get("q")
-    # podcast_id = request.args.get("pid") # at this stage, its Hanselminutes
-    episode_id = request.args.get("eid")
-    request_type = request.args.get("type")  # expected: "norag", "fulltext" or "rag"
-
-    system_prompt = """
-    You are a helpful assistant that answers user questions. You will use any context
-    provided, if available, and answer the questions as truthfully as possible. You 
-    will provide your response in 200 words or less.
-    """
+    started = g.started
+    try:
+        ask = parse_ask_request(request.args, app.config)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    question, podcastids, mode = ask.question, ask.podcastids, ask.mode
+
+    system_prompt = SYSTEM_PROMPT
     user_prompt = ""
-
-    if request_type == "norag":
+    # counted while the prompt is built, when it is
+    user_tokens = None
+    # episodes the prompt was built from, to invalidate cached answers
+    tags = set()
+    # latency per retrieval stage, returned in the Server-Timing header
+    timings = StageTimings()
+
+    if ask.request_type == "norag":
         user_prompt = question
-    elif request_type == "fulltext":
+    elif ask.request_type == "fulltext":
         # retrieve transcript from DB for context
-        record = select_from_episodes_with_episodeid(episode_id)
-        title = record[EpisodeAttributes.TITLE.value]
-        transcripttext = record[EpisodeAttributes.TRANSCRIPTTEXT.value]
-
-        user_prompt = """
-        The input enclosed in backticks is the transcript of a podcast with the title "%s". 
-        Based on this transcript and in keeping with your role as a helpful assistant,
-        please answer the question "%s" from a user. You will ignore any parts of the 
-        transcript that are not relevant to the core topic such as ad reads.
-        `%s`
-        """ % (
-            title,
+        # (the transcript is only loaded here, from its own table)
+        fulltext = db_repo.get_fulltext(podcastids[0], ask.episodeid)
+        if fulltext is None:
+            return jsonify({"error": "episode not found or not transcribed"}), 404
+        title, transcripttext = fulltext
+
+        with timings.stage("transcript_tokens"):
+            context = whole_transcript(transcripttext)
+        if context.tokens > fulltext_budget:
+            # too long: the episode's chunks most relevant to the question
+            chunks = select_embeddings(
+                question,
+                podcastids,
+                ask.episodeid,
+                SCOPE_EPISODE,
+                ask.params._replace(k=fulltext_spans),
+                timings=timings,
+            )
+            with timings.stage("excerpts"):
+                context = excerpt_context(chunks, fulltext_budget, context)
+        user_prompt, user_tokens = fulltext_prompt(title, question, context)
+        app.logger.info(
+            f"fulltext {ask.episodeid}: {context.tokens} of "
+            f"{context.transcript_tokens} transcript tokens, {context.spans} spans"
+        )
+        tags = {(podcastids[0], ask.episodeid)}
+
+    elif ask.request_type == "summary":
+        # precomputed summaries of the episodes the top chunks come from
+        embeddings = select_embeddings(
             question,
-            transcripttext,
+            podcastids,
+            ask.episodeid,
+            ask.scope,
+            ask.params,
+            ask.reranking,
+            timings,
         )
+        tags = summary_episodes(ask, embeddings)
+        summaries = db_repo.get_summaries(tags)
+        user_prompt = summary_user_prompt(question, summaries, embeddings)
 
     else:  # default request type is "rag"
         # retrieve transcript from DB for context
-        embeddings = select_embeddings(question)
-
-        context_tmpl = Template(
-            "Episode ID ${eid} with the title ${title} at the timecode ${timecode} provides the context #${context}#\n"
-        )
-        context = ""
-
-        for val in embeddings:
-            context += context_tmpl.substitute(
-                eid=val[0], title=val[1], timecode=str(val[2]), context=val[3]
-            )
-
-        user_prompt = """
-        Based on the context enclosed in backticks below and in keeping with your role as 
-        a helpful assistant, please answer the question "%s" from a user. Along with the 
-        response, you will also return the episodes and timecodes from where you got context
-        inputs. You will ignore any parts of the context that are not relevant to the question 
-        such as ad reads.
-        `%s`
-        """ % (
+        embeddings = select_embeddings(
             question,
-            context,
+            podcastids,
+            ask.episodeid,
+            ask.scope,
+            ask.params,
+            ask.reranking,
+            timings,
         )
+        user_prompt = rag_user_prompt(question, embeddings)
+        tags = episode_tags(embeddings)
+
+    with timings.stage("prompt_tokens"):
+        if user_tokens is None:
+            user_tokens = count_tokens(user_prompt)
+        prompt_tokens = system_prompt_tokens(system_prompt) + user_tokens
+    PROMPT_TOKENS.observe(prompt_tokens, mode)
 
     def generate_answer(sprompt, uprompt):
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "system",
-                    "content": sprompt,
-                },
-                {"role": "user", "content": uprompt},
-            ],
-            stream=True,
-        )
-        for chunk in response:
-            yield f'data: {chunk.choices[0].delta.content or ""}\n\n'
+        def complete():
+            response = get_openai_client().chat.completions.create(
+                model=CHAT_MODEL, messages=chat_messages(sprompt, uprompt), stream=True
+            )
+            parts = []
+            for chunk in response:
+                content = chunk.choices[0].delta.content or ""
+                parts.append(content)
+                yield content
+            COMPLETION_TOKENS.inc(mode, amount=count_tokens("".join(parts)))
+
+        # replay a cached answer or join an identical request in flight
+        key = prompt_key(CHAT_MODEL, sprompt, uprompt)
+        first = True
+        for content in answer_cache.stream(key, tags, complete):
+            if first:
+                FIRST_TOKEN_SECONDS.observe(time.perf_counter() - started, mode)
+                first = False
+            yield f"data: {content}\n\n"
+        ANSWER_SECONDS.observe(time.perf_counter() - started, mode)
 
     return Response(
-        generate_answer(system_prompt, user_prompt), mimetype="text/event-stream"
+        generate_answer(system_prompt, user_prompt),
+        mimetype="text/event-stream",
+        headers={
+            "X-Prompt-Tokens": str(prompt_tokens),
+            "Server-Timing": timings.server_timing(),
+        },
     )
 
 
+# development server; production runs on workers started by serve.py. The
+# debugger is on only with "DEBUG": true in config.json.
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", debug=True)
+    init_app()
+    app.run(host="0.0.0.0")
@@ -3,48 +3,77 @@
 //     await sleep(ms);
 // }
 
+// the server sends the URL of the next page of episodes in a Link header
+function nextPageUrl(response) {
+    let link = response.headers.get('Link');
+    let match = link && link.match(/<([^>]+)>;\s*rel="next"/);
+    return match ? 'http://52.172.33.78:5000' + match[1] : null;
+}
+
 document.addEventListener("DOMContentLoaded", function(event) {
-    fetch('http://52.172.33.78:5000/podcasts/1/episodes')
-        .then(response => response.json())
-        .then(data => {
-            let episodes = document.querySelector('#episodes');
-            data.forEach(episode => {
-                let a = document.createElement('a');
-                a.href = "#";
-                a.classList.add('list-group-item', 'list-group-item-action');
-                a.innerText = `#${episode.id}: ${episode.title}`;
-                a.dataset.id = episode.id;
-                a.onclick = function(e) {
-                    e.preventDefault();
-                    document.querySelectorAll('#episodes a').forEach(node => {
-                        node.classList.remove('active');
-                        node.ariaCurrent = 'false';
-                        document.querySelector('#suggestedQs div').innerText = '';
-                    });
-                    a.classList.add('active');
-                    a.ariaCurrent = 'true';
-                    fetch(`http://52.172.33.78:5000/podcasts/1/episodes/${episode.id}`)
-                        .then(response => response.json())
-                        .then(data => {
-                            document.querySelector('#episode-summary').innerText = data.summary;
-                            sample_questions = JSON.parse(data.sample_questions).questions;
-                            sample_questions.forEach(q => {
-                                let q_node = document.createElement('p');
-                                let a_node = document.createElement('a');
-                                a_node.href = '#';
-                                a_node.innerText = q;
-                                q_node.appendChild(a_node);
-                                document.querySelector('#suggestedQs div').appendChild(q_node);
-                                a_node.addEventListener('click', function(e) {
-                                    e.preventDefault();
-                                    document.querySelector('#question').value = q;
-                                    document.querySelector('#btnAnswerMe').click();
-                                });
-                            });
-                        });
-                };
-                episodes.appendChild(a);
+    let episodes = document.querySelector('#episodes');
+
+    function loadEpisodes(url) {
+        return fetch(url).then(response => {
+            let next = nextPageUrl(response);
+            return response.json().then(data => {
+                data.forEach(addEpisode);
+                if (next) {
+                    let more = document.createElement('a');
+                    more.href = "#";
+                    more.classList.add('list-group-item', 'list-group-item-action', 'text-center');
+                    more.innerText = 'More episodes';
+                    more.onclick = function(e) {
+                        e.preventDefault();
+                        more.remove();
+                        loadEpisodes(next);
+                    };
+                    episodes.appendChild(more);
+                }
             });
+        });
+    }
+
+    function addEpisode(episode) {
+        let a = document.createElement('a');
+        a.href = "#";
+        a.classList.add('list-group-item', 'list-group-item-action');
+        a.innerText = `#${episode.id}: ${episode.title}`;
+        a.dataset.id = episode.id;
+        a.onclick = function(e) {
+            e.preventDefault();
+            document.querySelectorAll('#episodes a').forEach(node => {
+                node.classList.remove('active');
+                node.ariaCurrent = 'false';
+                document.querySelector('#suggestedQs div').innerText = '';
+            });
+            a.classList.add('active');
+            a.ariaCurrent = 'true';
+            fetch(`http://52.172.33.78:5000/podcasts/1/episodes/${episode.id}`)
+                .then(response => response.json())
+                .then(data => {
+                    document.querySelector('#episode-summary').innerText = data.summary;
+                    sample_questions = JSON.parse(data.sample_questions).questions;
+                    sample_questions.forEach(q => {
+                        let q_node = document.createElement('p');
+                        let a_node = document.createElement('a');
+                        a_node.href = '#';
+                        a_node.innerText = q;
+                        q_node.appendChild(a_node);
+                        document.querySelector('#suggestedQs div').appendChild(q_node);
+                        a_node.addEventListener('click', function(e) {
+                            e.preventDefault();
+                            document.querySelector('#question').value = q;
+                            document.querySelector('#btnAnswerMe').click();
+                        });
+                    });
+                });
+        };
+        episodes.appendChild(a);
+    }
+
+    loadEpisodes('http://52.172.33.78:5000/podcasts/1/episodes')
+        .then(() => {
             episodes.firstElementChild.click();
 
             let btnAnswerMe = document.querySelector('#btnAnswerMe');
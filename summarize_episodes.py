@@ -0,0 +1,269 @@
+"""
+Precomputes per-chunk and per-episode summaries for the `summary` mode of
+`/ask`.
+
+Summarizing is map-reduce over an episode's chunks in `simple_embeddings`: every
+chunk is summarized on its own (map), in parallel across a bounded pool of
+threads, and the episode summary is written from the chunk summaries in
+transcript order (reduce). This runs once per episode, offline, so questions
+are answered from a few hundred words of summary instead of the transcript.
+
+Chunk summaries are keyed on the md5 of the chunk text and committed as soon as
+they come back, so an interrupted run resumes where it stopped, and chunks that
+did not change when an episode is re-embedded are not summarized again. Each
+episode summary records the hash of the chunks it was built from; an episode is
+summarized again when its chunks change.
+
+Usage:
+------
+```sh
+python ./summarize_episodes.py <episodeid> [<episodeid> ...]
+python ./summarize_episodes.py --all
+```
+`--all` summarizes every embedded episode whose summary is missing or stale.
+"""
+
+import argparse
+import hashlib
+import logging
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from openai import (
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+    RateLimitError,
+)
+
+from prompts import CHAT_MODEL
+from providers import get_db_pool, get_openai_client
+
+CHUNK_SUMMARY_PROMPT = """
+    You summarize an excerpt of a podcast transcript. Write 3 to 5 sentences with the
+    topics discussed, the people, products and numbers mentioned and any conclusions.
+    Ignore ad reads. Do not refer to "the excerpt".
+    """
+
+EPISODE_SUMMARY_PROMPT = """
+    You summarize a podcast episode from the summaries of its consecutive parts. Write
+    a summary of 200 words or less covering the main topics, guests, products and
+    conclusions in the order they come up. Ignore ad reads.
+    """
+
+# the chunks of an episode in transcript order, with the hashes summaries are keyed on
+CHUNKS_QUERY = """
+    SELECT timecode, chunk, md5(chunk) FROM simple_embeddings
+    WHERE podcastid = %s AND episodeid = %s
+    ORDER BY timecode, id;
+    """
+
+# embedded episodes without a summary of their current chunks
+STALE_EPISODES_QUERY = """
+    SELECT chunks.episodeid
+    FROM (
+        SELECT podcastid, episodeid,
+               md5(string_agg(md5(chunk), '' ORDER BY timecode, id)) AS source_hash
+        FROM simple_embeddings
+        WHERE podcastid = %s
+        GROUP BY podcastid, episodeid
+    ) AS chunks
+    LEFT JOIN episode_summaries
+    ON episode_summaries.podcastid = chunks.podcastid
+    AND episode_summaries.episodeid = chunks.episodeid
+    WHERE episode_summaries.source_hash IS DISTINCT FROM chunks.source_hash
+    ORDER BY chunks.episodeid;
+    """
+
+UPSERT_CHUNK_SUMMARY_QUERY = """
+    INSERT INTO chunk_summaries (podcastid, episodeid, chunk_hash, summary)
+    VALUES (%s, %s, %s, %s)
+    ON CONFLICT (podcastid, episodeid, chunk_hash) DO UPDATE
+    SET summary = EXCLUDED.summary, created_at = now();
+    """
+
+UPSERT_EPISODE_SUMMARY_QUERY = """
+    INSERT INTO episode_summaries (podcastid, episodeid, summary, source_hash)
+    VALUES (%s, %s, %s, %s)
+    ON CONFLICT (podcastid, episodeid) DO UPDATE
+    SET summary = EXCLUDED.summary, source_hash = EXCLUDED.source_hash,
+        created_at = now();
+    """
+
+DEFAULT_CONCURRENCY = 8
+MAX_RETRIES = 6
+
+RETRYABLE_ERRORS = (
+    RateLimitError,
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+)
+
+
+def source_hash(chunk_hashes):
+    """Matches the `source_hash` computed by STALE_EPISODES_QUERY."""
+    return hashlib.md5("".join(chunk_hashes).encode("utf-8")).hexdigest()
+
+
+def complete(client, system_prompt, user_prompt, max_retries=MAX_RETRIES):
+    delay = 1.0
+    for attempt in range(max_retries + 1):
+        try:
+            response = client.chat.completions.create(
+                model=CHAT_MODEL,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt},
+                ],
+                stream=False,
+            )
+            return response.choices[0].message.content.strip()
+        except RETRYABLE_ERRORS as e:
+            if attempt == max_retries:
+                raise
+            # exponential backoff with jitter
+            pause = delay * (1 + random.random())
+            logging.info(f"Chat call failed ({e}), retrying in {pause:.1f}s")
+            time.sleep(pause)
+            delay = min(delay * 2, 60.0)
+
+
+def select_episodes_to_summarize(pool, podcastid):
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(STALE_EPISODES_QUERY, (podcastid,))
+        result = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+
+    return result
+
+
+def select_chunks(pool, podcastid, episodeid):
+    """(timecodes, chunks, chunk hashes) and the existing chunk summaries."""
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(CHUNKS_QUERY, (podcastid, episodeid))
+        rows = cursor.fetchall()
+        cursor.execute(
+            """
+            SELECT chunk_hash, summary FROM chunk_summaries
+            WHERE podcastid = %s AND episodeid = %s;
+            """,
+            (podcastid, episodeid),
+        )
+        summaries = dict(cursor.fetchall())
+        cursor.close()
+
+    return rows, summaries
+
+
+def store_chunk_summary(pool, podcastid, episodeid, chunk_hash, summary):
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            UPSERT_CHUNK_SUMMARY_QUERY, (podcastid, episodeid, chunk_hash, summary)
+        )
+        cursor.close()
+
+
+def store_episode_summary(pool, podcastid, episodeid, summary, chunk_hashes):
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            UPSERT_EPISODE_SUMMARY_QUERY,
+            (podcastid, episodeid, summary, source_hash(chunk_hashes)),
+        )
+        # summaries of chunks the episode no longer has
+        cursor.execute(
+            """
+            DELETE FROM chunk_summaries
+            WHERE podcastid = %s AND episodeid = %s AND NOT chunk_hash = ANY(%s);
+            """,
+            (podcastid, episodeid, list(chunk_hashes)),
+        )
+        cursor.close()
+
+
+def summarize_episode(client, pool, executor, podcastid, episodeid):
+    """Summarize the missing chunks of an episode, then the episode."""
+    rows, summaries = select_chunks(pool, podcastid, episodeid)
+    if not rows:
+        logging.info(f"Episode {episodeid} has no chunks, skipping")
+        return
+
+    def summarize_chunk(chunk, chunk_hash):
+        summary = complete(client, CHUNK_SUMMARY_PROMPT, chunk)
+        # committed right away, so an interrupted run keeps it
+        store_chunk_summary(pool, podcastid, episodeid, chunk_hash, summary)
+        return chunk_hash, summary
+
+    # map: overlapping or repeated chunks with the same text are summarized once
+    missing = {
+        chunk_hash: chunk
+        for _, chunk, chunk_hash in rows
+        if chunk_hash not in summaries
+    }
+    futures = [
+        executor.submit(summarize_chunk, chunk, chunk_hash)
+        for chunk_hash, chunk in missing.items()
+    ]
+    summaries.update(future.result() for future in futures)
+
+    # reduce: the episode from its chunk summaries, in transcript order
+    parts = "\n".join(
+        f"[{timecode}] {summaries[chunk_hash]}" for timecode, _, chunk_hash in rows
+    )
+    summary = complete(client, EPISODE_SUMMARY_PROMPT, parts)
+    store_episode_summary(
+        pool, podcastid, episodeid, summary, [row[2] for row in rows]
+    )
+    logging.info(
+        f"Episode {episodeid}: {len(missing)} of {len(rows)} chunks summarized"
+    )
+
+
+def summarize_episodes(client, pool, podcastid, episodeids, concurrency):
+    failed = []
+    # chunks of one episode are summarized in parallel; episodes one at a time
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for episodeid in episodeids:
+            try:
+                summarize_episode(client, pool, executor, podcastid, episodeid)
+            except Exception as e:
+                logging.error(f"Episode {episodeid} failed: {e}")
+                failed.append(episodeid)
+    return failed
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.INFO,
+        format="%(asctime)s %(message)s",
+    )
+
+    parser = argparse.ArgumentParser(description="Summarize embedded episodes.")
+    parser.add_argument("episodeids", nargs="*", type=int)
+    parser.add_argument(
+        "--all", action="store_true", help="summarize every stale episode"
+    )
+    parser.add_argument("--podcastid", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    args = parser.parse_args()
+
+    pool = get_db_pool()
+    client = get_openai_client()
+
+    episodeids = args.episodeids
+    if args.all:
+        episodeids = select_episodes_to_summarize(pool, args.podcastid)
+
+    failed = summarize_episodes(
+        client, pool, args.podcastid, episodeids, args.concurrency
+    )
+    if failed:
+        logging.error(f"Episodes not summarized: {failed}")
+        sys.exit(1)
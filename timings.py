@@ -0,0 +1,29 @@
+"""
+Per-request latency of the stages of an `/ask` request.
+
+The servers time retrieval (embedding, vector and lexical search, fusion,
+reranking) with a `StageTimings` per request and return the result in a
+`Server-Timing` header, which browsers show in their network panel next to the
+request. Each stage is also a tracing span (metrics.py), so its latency is
+exported on `/metrics` as well.
+"""
+
+from metrics import span
+
+
+class StageTimings:
+    def __init__(self):
+        # stage name -> seconds; stages that run on other threads add their own
+        self.stages = {}
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def stage(self, name):
+        return span(name, self)
+
+    def server_timing(self):
+        """The `Server-Timing` header value, durations in milliseconds."""
+        return ", ".join(
+            f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages.items()
+        )
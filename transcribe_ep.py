@@ -2,73 +2,38 @@ import json
 import logging
 import sys
 import time
-from enum import Enum
 
-import psycopg2
 import requests
-import swagger_client
-from azure.cognitiveservices.speech import AudioConfig, SpeechConfig, SpeechRecognizer
-from openai import AzureOpenAI
-from psycopg2 import sql
-
-
-class EpisodeAttributes(Enum):
-    ID = 0
-    PODCASTID = 1
-    EPISODEID = 2
-    TITLE = 3
-    SUMMARY = 4
-    URL = 5
-    AUTHORS = 6
-    PUBLISHED = 7
-    DURATION = 8
-    QUESTIONS = 9
-    TRANSCRIBED = 10
-    TRANSCRIPT = 11
-    TRANSCRIPTTEXT = 12
 
+from cache_events import notify_episode_changed
+from db_pool import get_pool
+from embedding_cache import EmbeddingCache, precompute_question_embeddings
+from prompts import EMBEDDING_MODEL
+from providers import get_config, get_db_pool, get_openai_client
+from transcripts import (
+    phrase_array,
+    read_transcript,
+    serialize_phrases,
+    transcript_text,
+)
 
-def select_from_episodes(podcastid, episodeid):
-    # Read configuration from JSON file
-    with open("config.json") as config_file:
-        config = json.load(config_file)
-
-    connection_string = f"dbname='{config["DBNAME"]}' user='{config["USER"]}' host='{config["HOST"]}' port='{config["PORT"]}' password='{config["PASS"]}'"
-
-    # Connect to the PostgreSQL database
-    conn = psycopg2.connect(connection_string)
-    cursor = conn.cursor()
-
-    # Prepare and execute an SQL SELECT statement
-    select_query = sql.SQL(
-        "SELECT * FROM episodes WHERE podcastid = %s AND episodeid = %s;"
-    ).format(sql.Identifier("episodes"))
-
-    cursor.execute(
-        select_query,
-        (
-            podcastid,
-            episodeid,
-        ),
-    )
 
-    # Fetch and print the result of the SELECT statement
-    result = cursor.fetchall()
-    print(result)
+def select_from_episodes(podcastid, episodeid):
+    """(title, url) of an episode."""
+    with get_db_pool().connection() as conn:
+        cursor = conn.cursor()
 
-    # Close the cursor and the connection
-    cursor.close()
-    conn.close()
+        cursor.execute(
+            "SELECT title, url FROM episodes WHERE podcastid = %s AND episodeid = %s;",
+            (podcastid, episodeid),
+        )
 
-    return result[0]
+        result = cursor.fetchall()
+        logging.debug(f"Episode {podcastid}/{episodeid}: {result}")
 
+        cursor.close()
 
-logging.basicConfig(
-    stream=sys.stdout,
-    level=logging.DEBUG,
-    format="%(asctime)s %(message)s",
-    datefmt="%m/%d/%Y %I:%M:%S %p %Z",
-)
+    return result[0]
 
 
 def transcribe_from_single_file(uri, properties):
@@ -76,6 +41,8 @@ def transcribe_from_single_file(uri, properties):
     Transcribe a single audio file located at `uri` using the settings specified in `properties`
     using the base model for the specified locale.
     """
+    import swagger_client
+
     transcription_definition = swagger_client.Transcription(
         display_name=NAME,
         description=DESCRIPTION,
@@ -109,13 +76,8 @@ such as ad reads.
 """
 
 
-def create_questions_list(config, title, transcript_text):
-    client = AzureOpenAI(
-        api_key=config["LLM_API_KEY"],
-        api_version=config["LLM_API_VERSION"],
-        azure_endpoint=config["LLM_TARGET_URI"],
-    )
-    response = client.chat.completions.create(
+def create_questions_list(title, transcript_text):
+    response = get_openai_client().chat.completions.create(
         model="gpt-4o",
         messages=[
             {"role": "system", "content": QUESTIONS_SYSTEM_PROMPT},
@@ -164,25 +126,134 @@ LOCALE = "en-US"
 MODEL_REFERENCE = None  # guid of a custom model
 
 
+def store_transcript(
+    config, podcastid, episodeid, title, transcript, generate_questions=True
+):
+    """
+    Save a batch transcription result (as read by transcripts.read_transcript)
+    for an episode, with the quiz questions generated from it unless
+    `generate_questions` is False, and notify the servers of the change.
+    `DEBUG_DUMPS` in config.json writes the transcript and the questions to
+    transcript_json.txt and questions_json.txt.
+    """
+    # The transcript lives in its own table, away from the episode metadata
+    transcript_query = """
+    INSERT INTO transcripts (podcastid, episodeid, phrases, text)
+    VALUES (%s, %s, %s, %s)
+    ON CONFLICT (podcastid, episodeid) DO UPDATE
+    SET phrases = EXCLUDED.phrases, text = EXCLUDED.text, updated_at = now();
+    """
+    # questions are only overwritten when new ones were generated
+    update_query = """
+    UPDATE episodes
+    SET questions = COALESCE(%s, questions), transcribed = TRUE
+    WHERE podcastid = %s AND episodeid = %s;
+    """
+
+    debug_dumps = config.get("DEBUG_DUMPS", False)
+    transcripttext = transcript_text(transcript)
+
+    # serialized once, for both the DB and the debug dump
+    transcript_json = serialize_phrases(phrase_array(transcript))
+    if debug_dumps:
+        open("transcript_json.txt", "w").write(transcript_json)
+
+    list_of_questions = None
+    if generate_questions:
+        # Get list of questions generated from openai and extract the list
+        # for inserting into the database
+        questions = create_questions_list(title, transcripttext)
+        list_of_questions = json.dumps(questions.choices[0].message.content)
+
+        if debug_dumps:
+            open("questions_json.txt", "w").write(list_of_questions)
+
+        logging.info(list_of_questions)
+
+    with get_pool(config).connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute(
+            transcript_query, (podcastid, episodeid, transcript_json, transcripttext)
+        )
+        cursor.execute(update_query, (list_of_questions, podcastid, episodeid))
+
+        # tell the servers to drop answers built from the old transcript
+        notify_episode_changed(cursor, podcastid, episodeid)
+
+        cursor.close()
+
+    if list_of_questions is not None:
+        embed_questions(config, podcastid, episodeid)
+
+
+def embed_questions(config, podcastid, episodeid):
+    # Embed the suggested questions now so that clicking one in the
+    # UI does not wait on the embeddings API
+    precompute_question_embeddings(
+        EmbeddingCache(pool=get_pool(config)),
+        get_openai_client(),
+        EMBEDDING_MODEL,
+        podcastid,
+        episodeid,
+    )
+
+
+def store_questions(config, podcastid, episodeid):
+    """
+    Generate the quiz questions of an episode from its stored transcript,
+    replacing any earlier ones, for transcripts stored with
+    `generate_questions=False`.
+    """
+    with get_pool(config).connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            SELECT episodes.title, transcripts.text
+            FROM episodes
+            JOIN transcripts
+            ON transcripts.podcastid = episodes.podcastid
+            AND transcripts.episodeid = episodes.episodeid
+            WHERE episodes.podcastid = %s AND episodes.episodeid = %s;
+            """,
+            (podcastid, episodeid),
+        )
+        row = cursor.fetchone()
+        cursor.close()
+
+    if row is None:
+        raise LookupError(f"Episode {podcastid}/{episodeid} has no transcript")
+
+    title, transcripttext = row
+    questions = create_questions_list(title, transcripttext)
+    list_of_questions = json.dumps(questions.choices[0].message.content)
+
+    with get_pool(config).connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            UPDATE episodes SET questions = %s
+            WHERE podcastid = %s AND episodeid = %s;
+            """,
+            (list_of_questions, podcastid, episodeid),
+        )
+        notify_episode_changed(cursor, podcastid, episodeid)
+        cursor.close()
+
+    embed_questions(config, podcastid, episodeid)
+
+
 def transcribe(podcastid, episodeid, title, audio_url):
+    # the generated Speech API client is slow to import and only needed here
+    import swagger_client
+
     logging.info("Starting transcription client...")
 
     if audio_url == "":
         logging.info("Returning, no audio url found...")
         return
 
-    # Read configuration from JSON file
-    with open("config.json") as config_file:
-        config = json.load(config_file)
-
-    connection_string = f"dbname='{config["DBNAME"]}' user='{config["USER"]}' host='{config["HOST"]}' port='{config["PORT"]}' password='{config["PASS"]}'"
-
-    # Prepare and execute an SQL UPDATE statement
-    update_query = """
-    UPDATE episodes
-    SET questions = %s, transcribed = TRUE, transcript = %s, transcripttext = %s
-    WHERE podcastid = %s AND episodeid = %s;
-    """
+    config = get_config()
 
     # Set up the Azure Speech configuration
     SUBSCRIPTION_KEY = config["SPEECH_KEY"]
@@ -271,48 +342,17 @@ def transcribe(podcastid, episodeid, title, audio_url):
 
                 audiofilename = file_data.name
                 results_url = file_data.links.content_url
-                results = requests.get(results_url)
-
-                # Connect to the PostgreSQL database
-                conn = psycopg2.connect(connection_string)
-                cursor = conn.cursor()
-
-                transcript_json = json.loads(results.content.decode("utf-8"))
-                transcripttext = transcript_json["combinedRecognizedPhrases"][0][
-                    "lexical"
-                ]
-
-                open("transcript_json.txt", "w").write(json.dumps(transcript_json))
+                # stream the result instead of buffering the whole document
+                with requests.get(results_url, stream=True) as results:
+                    results.raise_for_status()
+                    results.raw.decode_content = True
+                    transcript = read_transcript(results.raw)
 
-                # Get list of questions generated from openai and extract the list
-                # for inserting into the database
-                questions = create_questions_list(config, title, transcripttext)
-                list_of_questions = json.dumps(questions.choices[0].message.content)
-
-                open("questions_json.txt", "w").write(list_of_questions)
-
-                logging.info(list_of_questions)
-
-                cursor.execute(
-                    update_query,
-                    (
-                        list_of_questions,
-                        results.content.decode("utf-8"),
-                        transcripttext,
-                        podcastid,
-                        episodeid,
-                    ),
-                )
-
-                # Commit the transaction
-                conn.commit()
-
-                # Close the cursor and the connection
-                cursor.close()
-                conn.close()
+                store_transcript(config, podcastid, episodeid, title, transcript)
 
                 logging.info(
-                    f"Results for {audiofilename}:\n{results.content.decode('utf-8')}"
+                    f"Results for {audiofilename}: "
+                    f"{len(transcript['recognizedPhrases'])} phrases"
                 )
         elif transcription.status == "Failed":
             logging.info(
@@ -322,15 +362,19 @@ def transcribe(podcastid, episodeid, title, audio_url):
 
 # accept the episode ID, transcribe, create question list and update in DB
 if __name__ == "__main__":
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.DEBUG,
+        format="%(asctime)s %(message)s",
+        datefmt="%m/%d/%Y %I:%M:%S %p %Z",
+    )
 
     # accept from command line as input, the episodeid to transcribe
     podcastid = sys.argv[1]
     episodeid = sys.argv[2]
 
     # Call the function to select the episode from the database
-    result = select_from_episodes(podcastid, episodeid)
-    audio_url = result[EpisodeAttributes.URL.value]
-    title = result[EpisodeAttributes.TITLE.value]
+    title, audio_url = select_from_episodes(podcastid, episodeid)
     # transcribe_episode_from_audio_url(audio_url)
 
     transcribe(podcastid, episodeid, title, audio_url)
@@ -0,0 +1,401 @@
+"""
+Transcribes many episodes concurrently with Azure batch transcription.
+
+transcribe_ep.py handles one episode per process and polls its job every 20
+seconds. The orchestrator instead
+
+- submits episodes in groups, each group as one batch job with several
+  `contentUrls`,
+- polls every open job from a single scheduler loop, backing off per job while
+  its status does not change,
+- downloads result files on a thread pool and writes each episode to the DB as
+  soon as its result is in (via transcribe_ep.store_transcript),
+- records every submission in the `transcription_jobs` table, so a restarted
+  run resumes polling the open jobs and never resubmits finished work.
+
+The speech service is called through its REST API (v3.2). `SPEECH_ENDPOINT` in
+config.json overrides the regional endpoint, for example to run against the
+local fake in fakes/speech_api.py.
+
+Usage:
+------
+```sh
+python ./transcription_orchestrator.py [--podcastid 1] [episodeid ...]
+```
+Without episode IDs every episode that is not transcribed yet is submitted.
+"""
+
+import argparse
+import heapq
+import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from db_pool import get_pool
+from providers import get_config
+from transcribe_ep import DESCRIPTION, LOCALE, NAME, store_transcript
+from transcripts import read_transcript
+
+DEFAULT_BATCH_SIZE = 20
+DEFAULT_DOWNLOAD_CONCURRENCY = 4
+MIN_POLL_INTERVAL = 10.0
+MAX_POLL_INTERVAL = 300.0
+POLL_BACKOFF = 1.5
+# consecutive failed polls after which a job is given up
+MAX_POLL_ERRORS = 10
+
+
+class SpeechClient:
+    """Minimal client for the batch transcription REST API."""
+
+    def __init__(self, host, subscription_key, timeout=60):
+        self.host = host.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers["Ocp-Apim-Subscription-Key"] = subscription_key
+
+    def _request(self, method, url, **kwargs):
+        response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def create(self, content_urls, properties=None):
+        """Submit one batch job for all `content_urls` and return its ID."""
+        transcription = {
+            "displayName": NAME,
+            "description": DESCRIPTION,
+            "locale": LOCALE,
+            "contentUrls": content_urls,
+            "properties": properties or {},
+        }
+        response = self._request(
+            "POST", f"{self.host}/transcriptions", json=transcription
+        )
+        location = response.headers.get("location") or response.json()["self"]
+        return location.rstrip("/").split("/")[-1]
+
+    def get(self, transcription_id):
+        url = f"{self.host}/transcriptions/{transcription_id}"
+        return self._request("GET", url).json()
+
+    def list_files(self, transcription_id):
+        url = f"{self.host}/transcriptions/{transcription_id}/files"
+        while url:
+            page = self._request("GET", url).json()
+            yield from page.get("values", [])
+            url = page.get("@nextLink")
+
+    def download(self, url):
+        """Stream a result file and parse it as it arrives."""
+        # result files are served from blob storage with a SAS token, not the API key
+        with requests.get(url, timeout=self.timeout, stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            return read_transcript(response.raw)
+
+
+def speech_client(config):
+    region = config["SERVICE_REGION"]
+    host = config.get(
+        "SPEECH_ENDPOINT",
+        f"https://{region}.api.cognitive.microsoft.com/speechtotext/v3.2",
+    )
+    return SpeechClient(host, config["SPEECH_KEY"])
+
+
+def select_episodes_to_transcribe(pool, podcastid, episodeids=None):
+    """(episodeid, title, url) of episodes not transcribed and not already submitted."""
+    query = """
+        SELECT episodes.episodeid, episodes.title, episodes.url
+        FROM episodes
+        LEFT JOIN transcription_jobs
+        ON transcription_jobs.podcastid = episodes.podcastid
+        AND transcription_jobs.episodeid = episodes.episodeid
+        WHERE episodes.podcastid = %s
+        AND episodes.transcribed IS NOT TRUE
+        AND COALESCE(episodes.url, '') <> ''
+        AND (transcription_jobs.status IS NULL OR transcription_jobs.status = 'Failed')
+        """
+    params = [podcastid]
+    if episodeids:
+        query += " AND episodes.episodeid = ANY(%s)"
+        params.append(list(episodeids))
+
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(query + " ORDER BY episodes.episodeid;", params)
+        rows = cursor.fetchall()
+        cursor.close()
+
+    return rows
+
+
+class Job:
+    def __init__(self, transcription_id, episodes):
+        self.transcription_id = transcription_id
+        # content url -> (podcastid, episodeid, title)
+        self.episodes = episodes
+        self.status = None
+        self.interval = MIN_POLL_INTERVAL
+        # consecutive polls that failed, reset by the next one that succeeds
+        self.poll_errors = 0
+
+
+class TranscriptionOrchestrator:
+    def __init__(
+        self,
+        config,
+        speech=None,
+        pool=None,
+        batch_size=DEFAULT_BATCH_SIZE,
+        download_concurrency=DEFAULT_DOWNLOAD_CONCURRENCY,
+        min_poll_interval=MIN_POLL_INTERVAL,
+        max_poll_interval=MAX_POLL_INTERVAL,
+        generate_questions=True,
+    ):
+        self.config = config
+        self.speech = speech or speech_client(config)
+        self.pool = pool or get_pool(config)
+        self.batch_size = batch_size
+        self.download_concurrency = download_concurrency
+        self.min_poll_interval = min_poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.generate_questions = generate_questions
+
+    def _execute(self, query, params):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            rows = cursor.fetchall() if cursor.description else None
+            cursor.close()
+        return rows
+
+    def _mark(self, podcastid, episodeid, status, error=None):
+        self._execute(
+            """
+            UPDATE transcription_jobs
+            SET status = %s, error = %s, completed_at = now()
+            WHERE podcastid = %s AND episodeid = %s;
+            """,
+            (status, error, podcastid, episodeid),
+        )
+
+    def resume(self):
+        """Jobs submitted by an earlier run that have not been stored yet."""
+        rows = self._execute(
+            """
+            SELECT transcription_jobs.transcription_id, transcription_jobs.content_url,
+                   episodes.podcastid, episodes.episodeid, episodes.title
+            FROM transcription_jobs
+            JOIN episodes
+            ON transcription_jobs.podcastid = episodes.podcastid
+            AND transcription_jobs.episodeid = episodes.episodeid
+            WHERE transcription_jobs.status = 'Submitted';
+            """,
+            (),
+        )
+        jobs = {}
+        for transcription_id, url, podcastid, episodeid, title in rows:
+            jobs.setdefault(transcription_id, {})[url] = (podcastid, episodeid, title)
+        return [Job(tid, episodes) for tid, episodes in jobs.items()]
+
+    def submit(self, podcastid, episodes):
+        """Submit (episodeid, title, url) rows in batch jobs of `batch_size` files."""
+        jobs = []
+        for start in range(0, len(episodes), self.batch_size):
+            batch = episodes[start : start + self.batch_size]
+            by_url = {
+                url: (podcastid, episodeid, title)
+                for episodeid, title, url in batch
+            }
+            transcription_id = self.speech.create(list(by_url.keys()))
+
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                for url, (_, episodeid, _) in by_url.items():
+                    cursor.execute(
+                        """
+                        INSERT INTO transcription_jobs (podcastid, episodeid,
+                            transcription_id, content_url, status)
+                        VALUES (%s, %s, %s, %s, 'Submitted')
+                        ON CONFLICT (podcastid, episodeid) DO UPDATE
+                        SET transcription_id = EXCLUDED.transcription_id,
+                            content_url = EXCLUDED.content_url,
+                            status = 'Submitted', error = NULL,
+                            submitted_at = now(), completed_at = NULL;
+                        """,
+                        (podcastid, episodeid, transcription_id, url),
+                    )
+                cursor.close()
+
+            logging.info(
+                f"Submitted transcription {transcription_id} for {len(by_url)} episodes"
+            )
+            jobs.append(Job(transcription_id, by_url))
+        return jobs
+
+    def _store(self, job, file_data):
+        transcript = self.speech.download(file_data["links"]["contentUrl"])
+        source = transcript.get("source")
+        # the result may name the audio URL after redirects; a job of one
+        # episode needs no match
+        url = source
+        if url not in job.episodes and len(job.episodes) == 1:
+            url = next(iter(job.episodes))
+        if url not in job.episodes:
+            logging.warning(f"No episode for result {file_data.get('name')} ({source})")
+            return None
+
+        podcastid, episodeid, title = job.episodes[url]
+        store_transcript(
+            self.config,
+            podcastid,
+            episodeid,
+            title,
+            transcript,
+            self.generate_questions,
+        )
+        self._mark(podcastid, episodeid, "Stored")
+        logging.info(f"Stored transcript of episode {episodeid}")
+        # the job's key for the episode, which collect checks off
+        return url
+
+    def collect(self, job, executor):
+        """Download and store every result of a succeeded job."""
+        files = [
+            f for f in self.speech.list_files(job.transcription_id)
+            if f.get("kind") == "Transcription"
+        ]
+        futures = [executor.submit(self._store, job, f) for f in files]
+
+        stored = set()
+        for future in futures:
+            try:
+                stored.add(future.result())
+            except Exception as e:
+                logging.error(f"Storing a result of {job.transcription_id} failed: {e}")
+
+        for url, (podcastid, episodeid, _) in job.episodes.items():
+            if url not in stored:
+                self._mark(podcastid, episodeid, "Failed", "no transcription result")
+
+    def check(self, job):
+        """
+        Poll `job` once and return its status. The episodes of a failed job are
+        marked Failed. A job the service no longer knows (a 4xx other than 429)
+        counts as failed, as does one whose last `MAX_POLL_ERRORS` polls
+        errored; a poll that errors otherwise returns the last known status.
+        """
+        try:
+            transcription = self.speech.get(job.transcription_id)
+        except requests.RequestException as e:
+            logging.warning(f"Polling {job.transcription_id} failed: {e}")
+            job.poll_errors += 1
+            code = getattr(e.response, "status_code", None)
+            if code is not None and 400 <= code < 500 and code != 429:
+                self._fail(job, f"transcription not available ({code})")
+                return "Failed"
+            if job.poll_errors >= MAX_POLL_ERRORS:
+                self._fail(job, f"{job.poll_errors} polls failed: {e}")
+                return "Failed"
+            return job.status
+
+        job.poll_errors = 0
+        status = transcription.get("status")
+        if status == "Failed":
+            error = transcription.get("properties", {}).get("error", {})
+            self._fail(job, error.get("message", "transcription failed"))
+        return status
+
+    def _fail(self, job, message):
+        logging.error(f"Transcription {job.transcription_id}: {message}")
+        for podcastid, episodeid, _ in job.episodes.values():
+            self._mark(podcastid, episodeid, "Failed", message)
+
+    def run(self, jobs):
+        """Poll `jobs` until all of them have finished and their results are stored."""
+        # (next poll time, sequence, job); the sequence keeps the heap ordering stable
+        schedule = [(time.monotonic(), i, job) for i, job in enumerate(jobs)]
+        heapq.heapify(schedule)
+        sequence = len(schedule)
+        collecting = []
+
+        # downloads run on `executor`; each finished job gets a collector thread
+        # that fans its files out to it
+        executor = ThreadPoolExecutor(max_workers=self.download_concurrency)
+        collectors = ThreadPoolExecutor(max_workers=self.download_concurrency)
+        try:
+            while schedule:
+                due, _, job = heapq.heappop(schedule)
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+                status = self.check(job)
+                if status == "Succeeded":
+                    logging.info(f"Transcription {job.transcription_id} succeeded")
+                    collecting.append(collectors.submit(self.collect, job, executor))
+                    continue
+                if status == "Failed":
+                    continue
+
+                # adaptive backoff: poll less often while nothing changes
+                if status == job.status:
+                    job.interval = min(
+                        job.interval * POLL_BACKOFF, self.max_poll_interval
+                    )
+                else:
+                    job.interval = self.min_poll_interval
+                job.status = status
+
+                next_poll = time.monotonic() + job.interval
+                heapq.heappush(schedule, (next_poll, sequence, job))
+                sequence += 1
+
+            for future in collecting:
+                future.result()
+        finally:
+            collectors.shutdown()
+            executor.shutdown()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.INFO,
+        format="%(asctime)s %(message)s",
+        datefmt="%m/%d/%Y %I:%M:%S %p %Z",
+    )
+
+    parser = argparse.ArgumentParser(description="Transcribe many episodes.")
+    parser.add_argument("episodeids", nargs="*", type=int)
+    parser.add_argument("--podcastid", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument(
+        "--concurrency", type=int, default=DEFAULT_DOWNLOAD_CONCURRENCY
+    )
+    parser.add_argument(
+        "--no-questions", action="store_true", help="skip quiz question generation"
+    )
+    args = parser.parse_args()
+
+    orchestrator = TranscriptionOrchestrator(
+        get_config(),
+        batch_size=args.batch_size,
+        download_concurrency=args.concurrency,
+        generate_questions=not args.no_questions,
+    )
+
+    jobs = orchestrator.resume()
+    if jobs:
+        logging.info(f"Resuming {len(jobs)} open transcription jobs")
+
+    episodes = select_episodes_to_transcribe(
+        orchestrator.pool, args.podcastid, args.episodeids
+    )
+    jobs += orchestrator.submit(args.podcastid, episodes)
+
+    orchestrator.run(jobs)
@@ -0,0 +1,112 @@
+"""
+Streaming reader for Azure batch transcription results.
+
+A result file holds the whole episode: every recognized phrase with its n-best
+alternatives and per-word timings, plus the combined text per channel. For a
+multi-hour episode that is a very large document, and reading it with
+`requests.get(...).content` and `json.loads` keeps several copies of it in
+memory. `read_transcript` instead parses the HTTP body incrementally with ijson
+and keeps a compact transcript:
+
+- the top-level metadata (`source`, `timestamp`, `duration`, ...),
+- `combinedRecognizedPhrases` with `channel`, `lexical` and `display`,
+- every `recognizedPhrases` entry with its timing, `speaker` and only the best
+  alternative, without the per-word arrays.
+
+The compact transcript has the same shape as the service's result. What is
+stored in the `transcripts` table is smaller still: the flat lexical text, for
+fulltext answers, and one [offset, speaker, display] triple per phrase, which
+is all chunker.py needs.
+"""
+
+import json
+
+import ijson
+
+# bytes read from the response per parser step
+CHUNK_SIZE = 64 * 1024
+
+TOP_LEVEL_FIELDS = ("source", "timestamp", "duration", "durationInTicks")
+COMBINED_FIELDS = ("channel", "lexical", "display")
+PHRASE_FIELDS = (
+    "recognitionStatus",
+    "channel",
+    "speaker",
+    "offset",
+    "duration",
+    "offsetInTicks",
+    "durationInTicks",
+)
+BEST_FIELDS = ("confidence", "lexical", "display")
+
+PHRASE_PREFIX = "recognizedPhrases.item"
+COMBINED_PREFIX = "combinedRecognizedPhrases.item"
+SCALAR_EVENTS = ("string", "number", "boolean", "null")
+
+
+def compact_phrase(phrase):
+    compact = {field: phrase[field] for field in PHRASE_FIELDS if field in phrase}
+    n_best = phrase.get("nBest") or [{}]
+    compact["nBest"] = [
+        {field: n_best[0][field] for field in BEST_FIELDS if field in n_best[0]}
+    ]
+    return compact
+
+
+def read_transcript(stream, chunk_size=CHUNK_SIZE):
+    """
+    Parse a batch transcription result from a binary file-like object (for
+    example `response.raw` of a streamed download) into a compact transcript.
+    Only one phrase is materialized at a time.
+    """
+    transcript = {"combinedRecognizedPhrases": [], "recognizedPhrases": []}
+    combined = transcript["combinedRecognizedPhrases"]
+    phrases = transcript["recognizedPhrases"]
+    builder = None
+
+    events = ijson.parse(stream, buf_size=chunk_size, use_float=True)
+    for prefix, event, value in events:
+        if builder is not None:
+            if prefix == PHRASE_PREFIX and event == "end_map":
+                phrases.append(compact_phrase(builder.value))
+                builder = None
+            else:
+                builder.event(event, value)
+        elif prefix == PHRASE_PREFIX and event == "start_map":
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+        elif prefix == COMBINED_PREFIX and event == "start_map":
+            combined.append({})
+        elif event in SCALAR_EVENTS:
+            parent, _, field = prefix.rpartition(".")
+            if parent == COMBINED_PREFIX and field in COMBINED_FIELDS:
+                combined[-1][field] = value
+            elif not parent and field in TOP_LEVEL_FIELDS:
+                transcript[field] = value
+
+    return transcript
+
+
+def phrase_array(transcript):
+    """
+    The compact form stored in the transcripts table: one [offset, speaker,
+    display] triple per recognized phrase.
+    """
+    return [
+        [
+            phrase.get("offset", "PT0S"),
+            phrase.get("speaker"),
+            phrase["nBest"][0]["display"],
+        ]
+        for phrase in transcript["recognizedPhrases"]
+    ]
+
+
+def transcript_text(transcript):
+    """The lexical text of the first channel, as stored in `transcripttext`."""
+    combined = transcript["combinedRecognizedPhrases"]
+    return combined[0]["lexical"] if combined else ""
+
+
+def serialize_phrases(phrases):
+    return json.dumps(phrases, separators=(",", ":"))
@@ -0,0 +1,407 @@
+"""
+In-process vector search over `simple_embeddings`.
+
+The catalog's embeddings fit in memory, so the nearest-neighbour search can run
+in the server process instead of as a pgvector query per question. For each
+podcast, the index keeps
+
+- a snapshot: the embeddings as one contiguous float32 matrix, normalized so
+  a dot product is the cosine similarity, saved in `VECTOR_SNAPSHOT_DIR`. It is
+  memory-mapped, so every worker on the host shares the same pages,
+- the rows added since the snapshot was written, loaded from the database into
+  a small private matrix,
+- which snapshot rows still exist, so episodes that gen-embeddings-simple.py
+  re-embedded (delete, then insert) are not returned twice.
+
+A search is an exact scan: one matrix-vector product per podcast and a partial
+sort. Only the chunk details of the k results are then read from Postgres, by
+primary key. The index is refreshed incrementally from the `episode_changed`
+notifications gen-embeddings-simple.py sends, and picks up a newer snapshot
+file when there is one. Snapshots are (re)written with:
+```sh
+python ./vector_index.py snapshot [podcastid ...]
+```
+`VECTOR_ENGINE` in config.json selects `memory` (this index) or `pgvector`
+(the default).
+"""
+
+import fcntl
+import glob
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from typing import NamedTuple
+
+import numpy as np
+
+from db_pool import get_pool
+from retrieval import SCOPE_EPISODE, podcast_ids
+
+ENGINE_PGVECTOR = "pgvector"
+ENGINE_MEMORY = "memory"
+DEFAULT_SNAPSHOT_DIR = "snapshots"
+DIMENSIONS = 1536
+FETCH_SIZE = 2000
+
+# rows of a podcast added after the `id` watermark
+ROWS_QUERY = """
+    SELECT id, episodeid, embedding::text FROM simple_embeddings
+    WHERE podcastid = %s AND id > %s
+    ORDER BY id;
+    """
+LIVE_IDS_QUERY = """
+    SELECT id FROM simple_embeddings WHERE podcastid = %s AND id <= %s;
+    """
+PODCASTS_QUERY = "SELECT DISTINCT podcastid FROM simple_embeddings;"
+# same columns as the pgvector queries in retrieval.py
+DETAILS_QUERY = """
+    SELECT episodes.episodeid, episodes.title, chunks.timecode, chunks.chunk,
+           chunks.podcastid, chunks.id
+    FROM simple_embeddings AS chunks
+    JOIN episodes
+    ON chunks.episodeid = episodes.episodeid AND chunks.podcastid = episodes.podcastid
+    WHERE chunks.id = ANY(%s);
+    """
+
+
+class Segment(NamedTuple):
+    # float32 (n, DIMENSIONS), rows of unit length
+    vectors: np.ndarray
+    ids: np.ndarray
+    episodeids: np.ndarray
+
+
+EMPTY = Segment(
+    np.empty((0, DIMENSIONS), dtype=np.float32),
+    np.empty(0, dtype=np.int64),
+    np.empty(0, dtype=np.int64),
+)
+
+
+def parse_vector(value):
+    # pgvector's text form, '[0.1,0.2,...]'
+    return np.fromstring(value.strip("[]"), dtype=np.float32, sep=",")
+
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def read_rows(pool, podcastid, after_id=0):
+    """The podcast's rows with an id above `after_id`, as a Segment."""
+    vectors, ids, episodeids = [], [], []
+    with pool.connection() as conn:
+        # a named cursor streams the rows instead of buffering the result
+        cursor = conn.cursor(name=f"vector_index_{podcastid}")
+        cursor.itersize = FETCH_SIZE
+        cursor.execute(ROWS_QUERY, (podcastid, after_id))
+        for id, episodeid, embedding in cursor:
+            ids.append(id)
+            episodeids.append(episodeid)
+            vectors.append(parse_vector(embedding))
+        cursor.close()
+
+    if not ids:
+        return EMPTY
+    return Segment(
+        normalize(np.vstack(vectors)).astype(np.float32),
+        np.asarray(ids, dtype=np.int64),
+        np.asarray(episodeids, dtype=np.int64),
+    )
+
+
+# Snapshot files are never modified: each version is written to new files
+# and `podcast-<id>.json` is then switched to it atomically.
+def snapshot_base(snapshot_dir, podcastid):
+    return os.path.join(snapshot_dir, f"podcast-{int(podcastid)}")
+
+
+def snapshot_version(snapshot_dir, podcastid):
+    try:
+        with open(snapshot_base(snapshot_dir, podcastid) + ".json") as f:
+            return json.load(f)["version"]
+    except FileNotFoundError:
+        return None
+
+
+def write_snapshot(snapshot_dir, podcastid, segment):
+    """Write and publish a new version of the snapshot. Returns the version."""
+    os.makedirs(snapshot_dir, exist_ok=True)
+    base = snapshot_base(snapshot_dir, podcastid)
+    # one writer per podcast at a time, so that no worker removes the version
+    # another one has just published
+    with open(base + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        version = f"{time.time_ns()}-{os.getpid()}"
+        np.save(f"{base}.{version}.npy", segment.vectors)
+        np.save(
+            f"{base}.{version}.ids.npy", np.vstack([segment.ids, segment.episodeids])
+        )
+
+        tmp = f"{base}.json.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"version": version, "rows": len(segment.ids)}, f)
+        os.replace(tmp, base + ".json")
+
+        # processes that mapped an old version keep reading it until they refresh
+        for path in glob.glob(f"{glob.escape(base)}.*.npy"):
+            if f".{version}." not in path:
+                os.remove(path)
+    return version
+
+
+def load_snapshot(snapshot_dir, podcastid):
+    """(Segment with memory-mapped vectors, version) or None."""
+    base = snapshot_base(snapshot_dir, podcastid)
+    for _ in range(3):
+        version = snapshot_version(snapshot_dir, podcastid)
+        if version is None:
+            return None
+        try:
+            ids = np.load(f"{base}.{version}.ids.npy")
+            vectors = np.load(f"{base}.{version}.npy", mmap_mode="r")
+        except FileNotFoundError:
+            # replaced by a newer version in the meantime
+            continue
+        return Segment(vectors, ids[0], ids[1]), version
+    return None
+
+
+def top_k(scores, k):
+    """Indices of the `k` highest scores, best first."""
+    if len(scores) > k:
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+class PodcastVectors(NamedTuple):
+    """One podcast's snapshot, the rows added since, and which rows still exist."""
+
+    snapshot: Segment
+    version: str
+    added: Segment
+    live: np.ndarray
+    added_live: np.ndarray
+
+    @classmethod
+    def from_snapshot(cls, snapshot, version):
+        live = np.ones(len(snapshot.ids), dtype=bool)
+        return cls(snapshot, version, EMPTY, live, np.ones(0, dtype=bool))
+
+    @property
+    def watermark(self):
+        # ids are ascending within each segment
+        ids = [s.ids[-1] for s in (self.snapshot, self.added) if len(s.ids)]
+        return int(max(ids)) if ids else 0
+
+    def search(self, query, k, episodeid=None):
+        """[(score, id)] of the `k` best live rows, optionally of one episode."""
+        results = []
+        segments = ((self.snapshot, self.live), (self.added, self.added_live))
+        for segment, live in segments:
+            rows = live
+            if episodeid is not None:
+                rows = live & (segment.episodeids == int(episodeid))
+            rows = np.flatnonzero(rows)
+            if len(rows) == 0:
+                continue
+            if len(rows) == len(segment.ids):
+                scores = segment.vectors @ query
+            else:
+                scores = segment.vectors[rows] @ query
+            for i in top_k(scores, k):
+                results.append((float(scores[i]), int(segment.ids[rows[i]])))
+        results.sort(reverse=True)
+        return results[:k]
+
+
+class VectorIndex:
+    def __init__(self, pool, snapshot_dir=DEFAULT_SNAPSHOT_DIR):
+        self.pool = pool
+        self.snapshot_dir = snapshot_dir
+
+        self._lock = threading.Lock()
+        # podcastid -> PodcastVectors; replaced as a whole on refresh, so
+        # searches read it without the lock
+        self._podcasts = {}
+        self._all_podcasts = None
+
+        self.searches = 0
+        self.refreshes = 0
+
+    def _load(self, podcastid):
+        loaded = load_snapshot(self.snapshot_dir, podcastid)
+        if loaded is None:
+            # first use: build the snapshot for the other workers too
+            segment = read_rows(self.pool, podcastid)
+            version = write_snapshot(self.snapshot_dir, podcastid, segment)
+            loaded = load_snapshot(self.snapshot_dir, podcastid)
+            if loaded is None:
+                # the files kept changing under us; the rows just read will do
+                loaded = segment, version
+        vectors = PodcastVectors.from_snapshot(*loaded)
+        logging.info(f"Vector index: podcast {podcastid}, {len(loaded[0].ids)} rows")
+        # rows written since the snapshot
+        return self._refreshed(podcastid, vectors)
+
+    def _refreshed(self, podcastid, vectors):
+        if snapshot_version(self.snapshot_dir, podcastid) != vectors.version:
+            loaded = load_snapshot(self.snapshot_dir, podcastid)
+            if loaded is not None:
+                vectors = PodcastVectors.from_snapshot(*loaded)
+
+        watermark = vectors.watermark
+        new = read_rows(self.pool, podcastid, watermark)
+        added = Segment(
+            np.vstack([vectors.added.vectors, new.vectors]),
+            np.concatenate([vectors.added.ids, new.ids]),
+            np.concatenate([vectors.added.episodeids, new.episodeids]),
+        )
+
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(LIVE_IDS_QUERY, (podcastid, watermark))
+            live_ids = np.asarray([row[0] for row in cursor.fetchall()], np.int64)
+            cursor.close()
+
+        return PodcastVectors(
+            vectors.snapshot,
+            vectors.version,
+            added,
+            np.isin(vectors.snapshot.ids, live_ids),
+            np.concatenate(
+                [
+                    np.isin(vectors.added.ids, live_ids),
+                    np.ones(len(new.ids), dtype=bool),
+                ]
+            ),
+        )
+
+    def podcast(self, podcastid):
+        vectors = self._podcasts.get(podcastid)
+        if vectors is None:
+            with self._lock:
+                vectors = self._podcasts.get(podcastid)
+                if vectors is None:
+                    vectors = self._podcasts[podcastid] = self._load(podcastid)
+        return vectors
+
+    def all_podcasts(self):
+        if self._all_podcasts is None:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(PODCASTS_QUERY)
+                self._all_podcasts = {row[0] for row in cursor.fetchall()}
+                cursor.close()
+        return sorted(self._all_podcasts)
+
+    def refresh(self, podcastid, episodeid=None):
+        """Callback for EpisodeChangeListener: load the podcast's new rows."""
+        podcastid = int(podcastid)
+        if self._all_podcasts is not None:
+            self._all_podcasts.add(podcastid)
+        with self._lock:
+            vectors = self._podcasts.get(podcastid)
+            if vectors is not None:
+                self._podcasts[podcastid] = self._refreshed(podcastid, vectors)
+                self.refreshes += 1
+
+    def search(self, embedding, k=5, podcastids=1, episodeid=None, scope=None):
+        """
+        The `k` nearest chunks as rows of (episodeid, title, timecode, chunk,
+        podcastid, id), like retrieval.search_chunks.
+        """
+        self.searches += 1
+        query = normalize(np.asarray(embedding, dtype=np.float32))
+        if podcastids is None:
+            podcastids = self.all_podcasts()
+        elif isinstance(podcastids, int):
+            podcastids = [podcastids]
+        if scope != SCOPE_EPISODE:
+            episodeid = None
+
+        results = []
+        for podcastid in podcastids:
+            results.extend(self.podcast(int(podcastid)).search(query, k, episodeid))
+        results.sort(reverse=True)
+        ids = [id for _, id in results[:k]]
+        if not ids:
+            return []
+
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(DETAILS_QUERY, (ids,))
+            rows = {row[5]: row for row in cursor.fetchall()}
+            cursor.close()
+
+        return [rows[id] for id in ids if id in rows]
+
+    def vectors(self, ids):
+        """{id: vector} of the given chunks, for the reranker."""
+        wanted = np.unique(np.asarray(list(ids), dtype=np.int64))
+        found = {}
+        for vectors in list(self._podcasts.values()):
+            for segment in (vectors.snapshot, vectors.added):
+                if len(segment.ids) == 0:
+                    continue
+                positions = np.searchsorted(segment.ids, wanted)
+                positions[positions == len(segment.ids)] = 0
+                hits = segment.ids[positions] == wanted
+                for id, position in zip(wanted[hits], positions[hits]):
+                    found[int(id)] = segment.vectors[position]
+        return found
+
+    def stats(self):
+        podcasts = dict(self._podcasts)
+        return {
+            "podcasts": len(podcasts),
+            "rows": sum(
+                int(v.live.sum()) + int(v.added_live.sum()) for v in podcasts.values()
+            ),
+            "added_rows": sum(len(v.added.ids) for v in podcasts.values()),
+            "searches": self.searches,
+            "refreshes": self.refreshes,
+        }
+
+
+def create_memory_index(config, pool=None):
+    """The in-process index if `VECTOR_ENGINE` is "memory", else None."""
+    if config.get("VECTOR_ENGINE", ENGINE_PGVECTOR) != ENGINE_MEMORY:
+        return None
+    return VectorIndex(
+        pool or get_pool(config),
+        config.get("VECTOR_SNAPSHOT_DIR", DEFAULT_SNAPSHOT_DIR),
+    )
+
+
+# write the snapshots of the given podcasts, or of all of them
+if __name__ == "__main__":
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.INFO,
+        format="%(asctime)s %(message)s",
+    )
+
+    if len(sys.argv) < 2 or sys.argv[1] != "snapshot":
+        print("usage: python ./vector_index.py snapshot [podcastid ...]")
+        sys.exit(1)
+
+    from providers import get_config, get_db_pool
+
+    index = VectorIndex(
+        get_db_pool(),
+        get_config().get("VECTOR_SNAPSHOT_DIR", DEFAULT_SNAPSHOT_DIR),
+    )
+
+    podcastids = podcast_ids(",".join(sys.argv[2:]) or "all") or index.all_podcasts()
+    for podcastid in podcastids:
+        segment = read_rows(index.pool, podcastid)
+        write_snapshot(index.snapshot_dir, podcastid, segment)
+        logging.info(f"Podcast {podcastid}: {len(segment.ids)} rows written")